@@ -0,0 +1,154 @@
+"""
+    kampach.aggregate
+    ~~~~~~~~~~~~~~~~~
+
+    Breakdowns of the costs and amounts of a model (by activity type, by
+    activity name, by building, by kind of material...), accumulated during
+    a single evaluation.
+
+    Each valuable of the evaluated tree adds its amount and its own cost to
+    a cell keyed by its fields:
+
+    - 'class': the class of the valuable, e.g. 'TransportActivity'
+    - 'name': the name of the valuable
+    - 'building': the name of the closest building containing it, or ''
+    - 'dimension': the dimension of its amount, e.g. '[length] ** 3' for
+      volumes of earth or '[mass]', or '' for valuables without amount
+
+    The instances counts of the buildings are applied. The pivot tables sum
+    the cells, so that any breakdown is computed without walking the tree
+    again.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .site import Building
+from .valuable import QuantitativeValuable, iter_evaluation
+from collections import OrderedDict
+import csv
+
+FIELDS = ('class', 'name', 'building', 'dimension')
+
+
+def dimension(amount):
+    """Dimension of an amount, as a string.
+    """
+    units = getattr(amount, 'units', ureg.dimensionless)
+    return str((1*units).dimensionality)
+
+
+def to_base_units(amount):
+    """Converts an amount to base units, so that amounts of the same
+    dimension given in different units are summed in the same units.
+    """
+    units = getattr(amount, 'units', None)
+    if units is None:
+        return amount
+    return amount.to((1*units).to_base_units().units)
+
+
+def as_list(val):
+    """[lower, mean, upper] magnitudes of a cost or amount.
+    """
+    if isinstance(val, BoundedQuantity):
+        return val.as_list()
+    val = getattr(val, 'magnitude', val)
+    return [val, val, val]
+
+
+class Aggregates:
+    """Sums of the amounts and costs of the valuables of a model, by class,
+    name, building and dimension.
+    """
+    
+    def __init__(self):
+        self.total_cost = 0
+        # (class, name, building, dimension) -> [amount, cost]
+        self.cells = OrderedDict()
+    
+    def add(self, item, building, amount, cost):
+        """Adds the amount and own cost of a valuable (scaled by its number of
+        instances).
+        """
+        key = (type(item).__name__, item.name, building,
+               '' if amount is None else dimension(amount))
+        cell = self.cells.setdefault(key, [0, 0])
+        if amount is not None:
+            cell[0] = cell[0] + to_base_units(amount)
+        cell[1] = cell[1] + cost
+        self.total_cost = self.total_cost + cost
+    
+    def _key(self, key, fields):
+        return tuple(key[FIELDS.index(field)] for field in fields)
+    
+    def pivot(self, rows, columns=(), value='cost'):
+        """Sums the amounts or the costs by some fields.
+
+        :param rows: fields of the rows, e.g. ('building',)
+        :param columns: fields of the columns, e.g. ('class',)
+        :param value: 'cost' or 'amount'. Amounts of different dimensions
+            can't be added, so 'dimension' must be in rows or columns.
+        :return: ordered dict mapping row keys (tuples) to ordered dicts
+            mapping column keys (tuples) to sums
+        """
+        for field in tuple(rows) + tuple(columns):
+            if field not in FIELDS:
+                raise ValueError('Unknown field: ' + field)
+        if value not in ('amount', 'cost'):
+            raise ValueError('Unknown value: ' + value)
+        if value == 'amount' and 'dimension' not in tuple(rows) + tuple(columns):
+            raise ValueError('Amounts must be grouped by dimension')
+        index = 0 if value == 'amount' else 1
+        table = OrderedDict()
+        for key, cell in self.cells.items():
+            if value == 'amount' and not key[3]:
+                continue
+            row = table.setdefault(self._key(key, rows), OrderedDict())
+            column = self._key(key, columns)
+            row[column] = row.get(column, 0) + cell[index]
+        return table
+    
+    def write_csv(self, f, rows):
+        """Writes the amounts (in base units) and costs summed by some fields
+        and by dimension, with the columns of
+        QuantitativeValuable.make_cost_csv_header().
+        """
+        fields = tuple(rows)
+        if 'dimension' not in fields:
+            fields += ('dimension',)
+        writer = csv.writer(f)
+        writer.writerow([field.capitalize() for field in fields] + ['Units']
+                        + QuantitativeValuable.make_cost_csv_header()[1:])
+        amounts = self.pivot(fields, value='amount')
+        for key, columns in self.pivot(fields).items():
+            amount = amounts.get(key, {}).get((), 0)
+            units = str(getattr(amount, 'units', ''))
+            writer.writerow(list(key) + [units] + as_list(amount)
+                            + as_list(columns[()]))
+
+
+def aggregate(root):
+    """Evaluates root without printing, and sums the amounts and costs of its
+    valuables.
+
+    :return: an Aggregates
+    """
+    aggregates = Aggregates()
+    # Name of the building of each valuable, in evaluation order
+    buildings = []
+    for item, cost, count, parent in iter_evaluation(root):
+        if isinstance(item, Building):
+            building = item.name
+        else:
+            building = buildings[parent] if parent >= 0 else ''
+        buildings.append(building)
+        amount = getattr(item, 'amount', None)
+        if count != 1:
+            cost = cost*count
+            if amount is not None:
+                amount = amount*count
+        aggregates.add(item, building, amount, cost)
+    return aggregates
@@ -13,6 +13,7 @@ from numbers import Number
 from . import ureg
 import operator
 import copy
+import numpy as np
 
 
 def parse_quantity(string):
@@ -34,6 +35,30 @@ def parse_quantity(string):
     return val
 
 
+def dump_quantity(val):
+    """Returns a plain form of a BoundedQuantity, Quantity or number, made of
+    tuples, floats and strings, that can be pickled or serialized to JSON
+    independently of the unit registry.
+    """
+    if isinstance(val, BoundedQuantity):
+        return ('bounded', float(val.mean.magnitude), str(val.units),
+                float(val.lower), float(val.upper))
+    if isinstance(val, ureg.Quantity):
+        return ('quantity', float(val.magnitude), str(val.units))
+    return ('number', val)
+
+
+def load_quantity(data):
+    """Inverse of dump_quantity().
+    """
+    if data[0] == 'bounded':
+        _, magnitude, units, lower, upper = data
+        return BoundedQuantity(ureg.Quantity(magnitude, units), (lower, upper))
+    if data[0] == 'quantity':
+        return ureg.Quantity(data[1], data[2])
+    return data[1]
+
+
 class BoundedQuantity:
     """Represents a quantity with mean value, lower and upper bounds 
     """
@@ -65,7 +90,7 @@ class BoundedQuantity:
                                              self.lower, self.upper)
     
     def __eq__(self, other):
-        if isinstance(other, type(self)):
+        if isinstance(other, BoundedQuantity):
             return (self.mean == other.mean
                     and self.lower == other.lower
                     and self.upper == other.upper) 
@@ -75,6 +100,12 @@ class BoundedQuantity:
     def __ne__(self, other):
         return not self.__eq__(other)
     
+    def __hash__(self):
+        # Value-based hash, consistent with __eq__, which compares the means
+        # in any units (0 meter == 0 centimeter)
+        mean = self.mean.to_base_units()
+        return hash((mean.magnitude, str(mean.units)))
+    
     @property
     def mean(self):
         return self._mean
@@ -150,6 +181,11 @@ class BoundedQuantity:
         :type other: BoundedQuantity, Quantity or numeric type
         :param op: operator function, (e.g. operator.add)
         """
+        if (isinstance(other, ureg.Quantity) and not isinstance(other.magnitude, Number)
+                and self.lower == self.upper == self.mean.magnitude):
+            # An exact value combined with an array of values or intervals,
+            # e.g. in the vectorized evaluations of kampach.bounds
+            return op(self.mean, other)
         return self.__copy__()._iop(other, op)
     
     def __add__(self, other):
@@ -195,10 +231,12 @@ class BoundedQuantity:
             return self._iop(other, operator.pow)
     
     def __abs__(self):
+        if self.lower < 0 < self.upper:
+            return type(self)(abs(self.mean), (0, max(-self.lower, self.upper)))
         return type(self)(abs(self.mean), (abs(self.lower), abs(self.upper)))
     
     def __neg__(self):
-        return type(self)(-self, (-self.upper, -self.lower))
+        return type(self)(-self.mean, (-self.upper, -self.lower))
     
     def ito(self, units):
         """Inplace rescale to different units.
@@ -223,22 +261,131 @@ class BoundedQuantity:
         return self.__copy__().ito(units)
 
 
+class FrozenBoundedQuantity(BoundedQuantity):
+    """BoundedQuantity shared by several objects (see xmlio.SharingTable).
+    Its in-place operations return a new BoundedQuantity rather than
+    modifying it, so that they don't alter the other objects.
+    """
+    
+    def __copy__(self):
+        return BoundedQuantity(copy.copy(self.mean), (self.lower, self.upper))
+    
+    def _iop(self, other, op):
+        return self.__copy__()._iop(other, op)
+    
+    def ito(self, units):
+        return self.to(units)
 
 
+def bounded_magnitudes(val, units):
+    """(lower, mean, upper) magnitudes of a number, Quantity (possibly of
+    bounded arrays, see kampach.inventory) or BoundedQuantity in units.
+    """
+    if isinstance(val, BoundedQuantity):
+        factor = (1*val.units).to(units).magnitude
+        return val.lower*factor, val.mean.magnitude*factor, val.upper*factor
+    if isinstance(val, ureg.Quantity):
+        val = val.to(units).magnitude
+    elif units != ureg.dimensionless:
+        raise TypeError('a quantity in {} is required'.format(units))
+    if hasattr(val, 'lower'):
+        return val.lower, val.mean, val.upper
+    return val, val, val
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+class PiecewiseLinear:
+    """Piecewise-linear function given by points (x, y), extended linearly
+    beyond the first and last points. The y values may be bounded, giving a
+    lower, a mean and an upper curve.
+    
+    Applied to a bounded value, the mean of the result is the mean curve at
+    the mean value, and its bounds are the minimum of the lower curve and
+    the maximum of the upper curve between the bounds of the value. The
+    tables are precomputed, so that a lookup is a few np.interp calls, also
+    on the bounded arrays of kampach.inventory.
+    
+    :param points: list of (x, y) numbers, Quantity or BoundedQuantity
+    """
+    
+    def __init__(self, points):
+        if not points:
+            raise ValueError('A piecewise-linear function needs points')
+        self.x_units = getattr(points[0][0], 'units', ureg.dimensionless)
+        self.y_units = getattr(points[0][1], 'units', ureg.dimensionless)
+        x = np.array([bounded_magnitudes(x, self.x_units)[1] for x, _ in points], dtype=float)
+        order = np.argsort(x, kind='stable')
+        self.points = tuple(tuple(points[i]) for i in order)
+        self.x = x[order]
+        # Rows: lower, mean and upper curves
+        self.y = np.array([bounded_magnitudes(y, self.y_units) for _, y in self.points],
+                          dtype=float).T
+        if len(self.x) > 1:
+            dx = self.x[[1, -1]] - self.x[[0, -2]]
+            dy = self.y[:, [1, -1]] - self.y[:, [0, -2]]
+            self.slopes = np.divide(dy, dx, out=np.zeros_like(dy), where=dx != 0)
+        else:
+            self.slopes = np.zeros((3, 2))
+        # The extrema of a monotone curve on an interval are at its ends
+        steps = np.diff(self.y, axis=1)
+        self.monotone = [bool((s >= 0).all() or (s <= 0).all()) for s in steps]
+    
+    def __repr__(self):
+        return "<PiecewiseLinear({})>".format(self.points)
+    
+    @property
+    def bounded(self):
+        """Whether some y values have distinct bounds.
+        """
+        return bool((self.y[0] != self.y[2]).any())
+    
+    def _curve(self, i, x):
+        """Value of the curve i (0: lower, 1: mean, 2: upper) at x.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.interp(x, self.x, self.y[i])
+        below, above = self.slopes[i]
+        y = y + np.where(x < self.x[0], below*(x - self.x[0]), 0.)
+        return y + np.where(x > self.x[-1], above*(x - self.x[-1]), 0.)
+    
+    def _extremum(self, i, lower, upper, reduce):
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+        ends = reduce(self._curve(i, lower), self._curve(i, upper))
+        if self.monotone[i]:
+            return ends
+        # Points of the table between the bounds
+        inside = (self.x > lower[..., None]) & (self.x < upper[..., None])
+        points = np.where(inside, self.y[i], ends[..., None])
+        return reduce.reduce(points, axis=-1)
+    
+    def _slope(self, i, x):
+        """Slope of the curve i at a number x.
+        """
+        if len(self.x) < 2:
+            return 0.
+        k = int(np.clip(np.searchsorted(self.x, x, side='right') - 1,
+                        0, len(self.x) - 2))
+        dx = self.x[k+1] - self.x[k]
+        return float((self.y[i, k+1] - self.y[i, k])/dx) if dx else 0.
+    
+    def __call__(self, val):
+        lower, mean, upper = bounded_magnitudes(val, self.x_units)
+        # Magnitudes recording their derivatives (see kampach.gradient) are
+        # looked up by value, and the derivative is the slope of the curve
+        variable = mean
+        lower, mean, upper = [getattr(m, 'value', m) for m in (lower, mean, upper)]
+        y_mean = self._curve(1, mean)
+        y_lower = np.minimum(self._extremum(0, lower, upper, np.minimum), y_mean)
+        y_upper = np.maximum(self._extremum(2, lower, upper, np.maximum), y_mean)
+        if isinstance(val, ureg.Quantity) and hasattr(val.magnitude, 'lower'):
+            # Bounded arrays
+            return ureg.Quantity(type(val.magnitude)(y_mean, y_lower, y_upper),
+                                 self.y_units)
+        if np.ndim(y_mean):
+            # Arrays of samples (see kampach.montecarlo)
+            return ureg.Quantity(y_mean, self.y_units)
+        y_mean = float(y_mean)
+        if variable is not mean:
+            y_mean = y_mean + self._slope(1, mean)*(variable - mean)
+        return BoundedQuantity(y_mean*self.y_units,
+                               (float(y_lower), float(y_upper)))
@@ -0,0 +1,279 @@
+"""
+    kampach.bounds
+    ~~~~~~~~~~~~~~
+
+    Tight bounds of computations using several times the same parameter.
+
+    BoundedQuantity arithmetic treats every operand as independent, so that
+    formulas like (W-w)*l give bounds wider than the actual range. The tight
+    bounds are computed by evaluating the formula on all the corners of the
+    parameters box at once, for the methods declared exact on the corners by
+    their class (formulas that are multilinear or monotonic in each parameter,
+    like the volume of a truncated pyramid), or by interval subdivision for
+    the other methods (e.g. areas using abs() and square roots) and when
+    there are too many parameters.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+import numpy as np
+import heapq
+import copy
+
+"""Maximum number of bounded parameters for which all the corners are
+evaluated (2**n evaluations).
+"""
+MAX_VERTEX_PARAMETERS = 12
+
+
+def bounded_parameters(obj):
+    """Returns the names of the attributes of obj that are BoundedQuantity
+    objects with distinct lower and upper bounds.
+    """
+    return [name for name, val in vars(obj).items()
+            if isinstance(val, BoundedQuantity) and val.lower != val.upper]
+
+
+def evaluate(obj, method, values):
+    """Calls method on a copy of obj whose attributes are replaced by values.
+
+    :param method: name of the method, e.g. 'compute_total_volume'
+    :type method: str
+    :param values: new values of the attributes
+    :type values: dict
+    """
+    clone = copy.copy(obj)
+    clone.tight_bounds = False
+    for name, val in values.items():
+        setattr(clone, name, val)
+    return getattr(clone, method)()
+
+
+def _magnitudes(result, units):
+    if isinstance(result, BoundedQuantity):
+        result = result.mean
+    if isinstance(result, ureg.Quantity):
+        return np.asarray(result.to(units).magnitude, dtype=float)
+    return np.asarray(result, dtype=float)
+
+
+def _mean_values(obj):
+    """Mean values replacing the BoundedQuantity attributes of obj in a
+    vectorized evaluation, where the parameters are replaced by arrays. The
+    other attributes are kept as scalars, e.g. the top angle of a MeshShape
+    that classifies its faces.
+    """
+    return {name: val.mean for name, val in vars(obj).items()
+            if isinstance(val, BoundedQuantity)}
+
+
+def vertex_extrema(obj, method, names, units):
+    """Minimum and maximum of the method over the corners of the parameters
+    box, evaluated as a single vectorized call.
+    """
+    n = len(names)
+    corners = (np.arange(2**n)[:, np.newaxis] >> np.arange(n)) & 1
+    values = _mean_values(obj)
+    for i, name in enumerate(names):
+        param = getattr(obj, name)
+        values[name] = ureg.Quantity(np.where(corners[:, i], param.upper,
+                                              param.lower), param.units)
+    mags = _magnitudes(evaluate(obj, method, values), units)
+    return mags.min(), mags.max()
+
+
+class _Intervals:
+    """Vectorized interval arithmetic on arrays of lower and upper bounds,
+    used as the magnitude of a Quantity to bound the result of a formula over
+    many boxes at once.
+    """
+    
+    def __init__(self, lower, upper):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+    
+    @staticmethod
+    def _bounds(other):
+        if isinstance(other, _Intervals):
+            return other.lower, other.upper
+        return other, other
+    
+    def __add__(self, other):
+        lower, upper = self._bounds(other)
+        return _Intervals(self.lower + lower, self.upper + upper)
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        lower, upper = self._bounds(other)
+        return _Intervals(self.lower - upper, self.upper - lower)
+    
+    def __rsub__(self, other):
+        return -self.__sub__(other)
+    
+    def __mul__(self, other):
+        lower, upper = self._bounds(other)
+        products = (self.lower*lower, self.lower*upper,
+                    self.upper*lower, self.upper*upper)
+        return _Intervals(np.minimum.reduce(products),
+                          np.maximum.reduce(products))
+    
+    __rmul__ = __mul__
+    
+    @staticmethod
+    def _inverse(lower, upper):
+        """Bounds of 1/x for x in [lower, upper], unbounded when the interval
+        contains 0.
+        """
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        zero = (lower <= 0) & (upper >= 0)
+        with np.errstate(divide='ignore'):
+            return _Intervals(np.where(zero, -np.inf, 1/upper),
+                              np.where(zero, np.inf, 1/lower))
+    
+    def __truediv__(self, other):
+        return self*self._inverse(*self._bounds(other))
+    
+    def __rtruediv__(self, other):
+        return self._inverse(self.lower, self.upper)*other
+    
+    def __pow__(self, other):
+        values = (self.lower**other, self.upper**other)
+        lower = np.minimum(*values)
+        if other % 2 == 0:
+            lower = np.where((self.lower < 0) & (self.upper > 0), 0, lower)
+        return _Intervals(lower, np.maximum(*values))
+    
+    def __neg__(self):
+        return _Intervals(-self.upper, -self.lower)
+    
+    def __abs__(self):
+        straddle = (self.lower < 0) & (self.upper > 0)
+        lower = np.minimum(abs(self.lower), abs(self.upper))
+        return _Intervals(np.where(straddle, 0, lower),
+                          np.maximum(abs(self.lower), abs(self.upper)))
+
+
+def _enclosures(obj, method, names, boxes, units):
+    """Bounds of the method over each box, evaluated with vectorized interval
+    arithmetic.
+    """
+    values = _mean_values(obj)
+    boxes = np.array(boxes, dtype=float)
+    for i, name in enumerate(names):
+        values[name] = ureg.Quantity(_Intervals(boxes[:, i, 0], boxes[:, i, 1]),
+                                     getattr(obj, name).units)
+    result = evaluate(obj, method, values)
+    if isinstance(result, BoundedQuantity):
+        # Independent of the parameters
+        result = result.mean
+    if isinstance(result, ureg.Quantity):
+        result = result.to(units).magnitude
+    lower, upper = _Intervals._bounds(result)
+    return (np.broadcast_to(lower, (len(boxes),)),
+            np.broadcast_to(upper, (len(boxes),)))
+
+
+def _midpoints(obj, method, names, boxes, units):
+    """Values of the method at the center of the boxes, evaluated as a single
+    vectorized call.
+    """
+    values = _mean_values(obj)
+    centers = np.array([[(lo+hi)/2 for lo, hi in box] for box in boxes])
+    for i, name in enumerate(names):
+        values[name] = ureg.Quantity(centers[:, i], getattr(obj, name).units)
+    mags = _magnitudes(evaluate(obj, method, values), units)
+    return np.broadcast_to(mags, (len(boxes),))
+
+
+def _subdivision_minimum(obj, method, names, units, sign, tolerance,
+                         max_boxes, batch=256):
+    """Lower bound of sign*method, refined by splitting the boxes whose
+    enclosure may contain a value below the best known one. Boxes that can't
+    improve it by more than the tolerance are pruned, keeping their bound.
+    """
+    box = tuple((getattr(obj, name).lower, getattr(obj, name).upper)
+                for name in names)
+    widths = [hi - lo for lo, hi in box]
+    best = sign*float(_midpoints(obj, method, names, [box], units)[0])
+    lower, upper = _enclosures(obj, method, names, [box], units)
+    heap = [(min(sign*lower[0], sign*upper[0]), 0, box)]
+    # Lowest bound of the pruned boxes
+    pruned = best
+    counter = 1
+    while heap and counter < max_boxes:
+        if heap[0][0] >= best - tolerance*abs(best):
+            break
+        parents = [heapq.heappop(heap)[2] for _ in range(min(batch, len(heap)))]
+        children = []
+        for box in parents:
+            # Split along the widest dimension, relative to the initial box
+            i = max(range(len(box)), key=lambda k: (box[k][1]-box[k][0])/widths[k])
+            lo, hi = box[i]
+            mid = (lo+hi)/2
+            children.append(box[:i] + ((lo, mid),) + box[i+1:])
+            children.append(box[:i] + ((mid, hi),) + box[i+1:])
+        best = min(best, (sign*_midpoints(obj, method, names, children, units)).min())
+        lower, upper = _enclosures(obj, method, names, children, units)
+        for box, bound in zip(children, np.minimum(sign*lower, sign*upper)):
+            if bound < best - tolerance*abs(best):
+                heapq.heappush(heap, (bound, counter, box))
+                counter += 1
+            else:
+                pruned = min(pruned, bound)
+    if heap:
+        return min(best, pruned, heap[0][0])
+    return min(best, pruned)
+
+
+def subdivision_extrema(obj, method, names, units, tolerance=1e-4,
+                        max_boxes=20000):
+    """Minimum and maximum of the method over the parameters box, by interval
+    subdivision. The result always contains the actual range.
+    """
+    lower = _subdivision_minimum(obj, method, names, units, 1, tolerance,
+                                 max_boxes)
+    upper = -_subdivision_minimum(obj, method, names, units, -1, tolerance,
+                                  max_boxes)
+    return lower, upper
+
+
+def tight_bounds(obj, method):
+    """Computes the result of a method of obj with tight bounds.
+
+    :param obj: object whose BoundedQuantity attributes are the parameters,
+        e.g. a BuildingShape
+    :param method: name of the method, e.g. 'compute_total_volume'
+    :type method: str
+    """
+    result = evaluate(obj, method, {})
+    names = bounded_parameters(obj)
+    if not names or not isinstance(result, BoundedQuantity):
+        return result
+    if (method in getattr(obj, 'vertex_methods', ())
+            and len(names) <= MAX_VERTEX_PARAMETERS):
+        lower, upper = vertex_extrema(obj, method, names, result.units)
+    else:
+        lower, upper = subdivision_extrema(obj, method, names, result.units)
+    return BoundedQuantity(result.mean, (float(lower), float(upper)))
+
+
+def set_tight_bounds(root, value=True):
+    """Sets the tight bounds mode of all the shapes of the buildings under
+    root (a Site, a Building or any Valuable).
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if hasattr(node, 'input_valuable'):
+            stack.append(node.input_valuable)
+            continue
+        shapes = list(getattr(node, 'substructures', []))
+        if getattr(node, 'shape', None) is not None:
+            shapes.append(node.shape)
+        for shape in shapes:
+            shape.tight_bounds = value
+        stack.extend(node.inputs)
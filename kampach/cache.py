@@ -0,0 +1,326 @@
+"""
+    kampach.cache
+    ~~~~~~~~~~~~~
+
+    Results cache across runs, keyed by content hashes of the subtrees of a
+    model.
+
+    The hash of a valuable, input or shape covers its class, its parameters
+    and the hashes of its children (inputs, input valuable, shape and
+    substructures), like a Merkle tree: editing one building changes the
+    hashes of this building and of its ancestors only. The costs of the
+    valuables and the geometric results of the shapes are stored in a SQLite
+    file under these hashes, so that re-evaluating an edited model only
+    recomputes the subtrees that changed.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from .arithmetic import BoundedQuantity, dump_quantity, load_quantity
+from .geometry import BuildingShape
+from .valuable import Valuable, QuantitativeValuable, QuantitativeValuableInput,\
+    cycle_error
+from . import ureg
+from numbers import Number
+import numpy as np
+import hashlib
+import json
+import os
+import sqlite3
+
+"""Attributes that are not part of the content of an object: back
+references and evaluation state.
+"""
+IGNORED_ATTRIBUTES = ('_target_valuable', '_results', '_amount', '_fields')
+
+"""Attributes holding the data loaded from the file of their object
+(filename attribute), covered by the signature of the file. They are
+hashed by content when the object has no file, e.g. an in-memory terrain.
+"""
+FILE_DATA_ATTRIBUTES = ('mesh', 'elevations')
+
+NODE_TYPES = (Valuable, QuantitativeValuableInput, BuildingShape)
+
+
+def _file_signature(filename):
+    """Size and modification time of a file, so that editing a file referred
+    to by the model changes the hashes.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _is_ignored(obj, name):
+    """Whether an attribute of obj is not part of its content.
+    """
+    if name in FILE_DATA_ATTRIBUTES:
+        return bool(getattr(obj, 'filename', ''))
+    return name in IGNORED_ATTRIBUTES
+
+
+def _is_node(val):
+    """Whether an attribute holds children nodes rather than parameters.
+    """
+    if isinstance(val, list):
+        return all(isinstance(v, NODE_TYPES) for v in val)
+    return isinstance(val, NODE_TYPES)
+
+
+def _value_repr(name, val):
+    if isinstance(val, list):
+        # Auxiliary objects, e.g. the legs of a fleet transport activity
+        return repr([_value_repr(name, v) for v in val])
+    if isinstance(val, np.ndarray):
+        data = hashlib.sha256(np.ascontiguousarray(val).tobytes()).hexdigest()
+        return repr((val.shape, str(val.dtype), data))
+    if isinstance(val, (BoundedQuantity, ureg.Quantity, Number, str,
+                        tuple, type(None))):
+        if name.lstrip('_') == 'filename' and val:
+            return repr((val, _file_signature(val)))
+        return repr(val)
+    if hasattr(val, '__dict__'):
+        # Auxiliary objects, e.g. the terrain of a transport activity
+        return repr((type(val).__name__,
+                     [(k, _value_repr(k, v)) for k, v in sorted(vars(val).items())
+                      if not _is_ignored(val, k)]))
+    return type(val).__name__
+
+
+def _children(obj):
+    """Children nodes of obj, in a deterministic order.
+    """
+    children = []
+    for name, val in sorted(vars(obj).items()):
+        if _is_ignored(obj, name):
+            continue
+        if isinstance(val, NODE_TYPES):
+            children.append((name, val))
+        elif isinstance(val, list):
+            children.extend((name, v) for v in val if isinstance(v, NODE_TYPES))
+    return children
+
+
+def subtree_hashes(root):
+    """Computes the content hashes of root and of all the nodes below it.
+
+    :return: dict mapping id(node) to the hexadecimal hash
+    """
+    hashes = {}
+    # Nodes whose children are being hashed, to detect the cycles
+    active = set()
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if id(node) in hashes:
+            continue
+        children = _children(node)
+        if not expanded:
+            if id(node) in active:
+                raise cycle_error(node)
+            active.add(id(node))
+            stack.append((node, True))
+            stack.extend((child, False) for _, child in children
+                         if id(child) not in hashes)
+            continue
+        active.discard(id(node))
+        h = hashlib.sha256(type(node).__qualname__.encode())
+        for name, val in sorted(vars(node).items()):
+            if not _is_ignored(node, name) and not _is_node(val):
+                h.update(repr((name, _value_repr(name, val))).encode())
+        for name, child in children:
+            h.update(name.encode())
+            h.update(hashes[id(child)].encode())
+        hashes[id(node)] = h.hexdigest()
+    return hashes
+
+
+class ResultCache:
+    """Persistent storage of results, in a SQLite file.
+
+    :param filename: path of the file, or ':memory:'
+    """
+    
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                '(key TEXT PRIMARY KEY, value TEXT)')
+        self.hits = 0
+        self.misses = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def get(self, key):
+        """Returns the value stored under key (a JSON-serializable object), or
+        None.
+        """
+        row = self.connection.execute('SELECT value FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+    
+    def put(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                                (key, json.dumps(value)))
+    
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def _restore_shape_results(shape, cache, key):
+    """Fills the cached results of a shape (see geometry.cached_result) from
+    the persistent cache.
+    """
+    stored = cache.get('shape:' + key)
+    if stored is not None:
+        results = shape.__dict__.setdefault('_results', {})
+        for name, val in stored.items():
+            results.setdefault(name, load_quantity(val))
+
+
+def _store_shape_results(shape, cache, key):
+    results = {}
+    for name, val in vars(shape).get('_results', {}).items():
+        if isinstance(val, (BoundedQuantity, ureg.Quantity, Number)):
+            results[name] = dump_quantity(val)
+    if results:
+        cache.put('shape:' + key, results)
+
+
+def compute_total_cost(root, cache):
+    """Computes the total cost of root like root.compute_total_cost(),
+    without printing, reusing the costs of the subtrees stored in cache and
+    storing the new ones.
+
+    The amounts of the valuables below a cached subtree are not updated.
+    """
+    hashes = subtree_hashes(root)
+    shapes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for _, child in _children(node):
+            if isinstance(child, BuildingShape):
+                shapes.append(child)
+            else:
+                stack.append(child)
+    for shape in shapes:
+        _restore_shape_results(shape, cache, hashes[id(shape)])
+    cost = _cached_cost(root, cache, hashes)
+    for shape in shapes:
+        _store_shape_results(shape, cache, hashes[id(shape)])
+    cache.connection.commit()
+    return cost
+
+
+def _cost_key(valuable, hashes):
+    key = 'cost:' + hashes[id(valuable)]
+    if isinstance(valuable, QuantitativeValuable):
+        # The cost also depends on the amount set by the target
+        key += ':' + repr(valuable.amount)
+    return key
+
+
+def _cached_cost(root, cache, hashes):
+    """Computes the total cost of root like Valuable.compute_total_cost(),
+    with an explicit stack, skipping the subtrees whose cost is stored.
+    """
+    # Frames of the valuables being evaluated:
+    # [valuable, key, cost so far, remaining inputs]
+    stack = []
+    item = root
+    while True:
+        cost = None
+        if item is not None:
+            key = _cost_key(item, hashes)
+            stored = cache.get(key)
+            if stored is None:
+                own_cost = item.compute_own_cost(quiet=True)
+                stack.append([item, key, own_cost, iter(item.inputs)])
+            else:
+                cost = load_quantity(stored)
+        if cost is None:
+            frame = stack[-1]
+            item = next(frame[3], None)
+            if item is not None:
+                if isinstance(item, QuantitativeValuableInput):
+                    item.input_valuable.amount = item.compute_input_amount()
+                    item = item.input_valuable
+                continue
+            stack.pop()
+            valuable, key, cost, _ = frame
+            count = getattr(valuable, 'count', 1)
+            if count != 1:
+                cost = cost*count
+            cache.put(key, dump_quantity(cost))
+        if not stack:
+            return cost
+        stack[-1][2] = stack[-1][2] + cost
+        item = None
+
+
+def _label(node):
+    if isinstance(node, QuantitativeValuableInput):
+        node = node.input_valuable
+    return getattr(node, 'name', '') or type(node).__name__
+
+
+def _child_path(path, attribute, child):
+    if isinstance(child, BuildingShape):
+        return '{0}/{1}'.format(path, attribute.lstrip('_'))
+    return '{0}/{1}'.format(path, _label(child))
+
+
+def _parameters(obj):
+    return sorted((name, _value_repr(name, val))
+                  for name, val in vars(obj).items()
+                  if not _is_ignored(obj, name)
+                  and not _is_node(val))
+
+
+def diff(old, new):
+    """Compares two versions of a model, only descending into the subtrees
+    whose hashes differ. Children are matched by name.
+
+    :return: sorted list of (path, change), change being 'changed' (for a
+        node whose own parameters changed), 'added' or 'removed'
+    """
+    old_hashes = subtree_hashes(old)
+    new_hashes = subtree_hashes(new)
+    changes = []
+    stack = [(_label(new), old, new)]
+    while stack:
+        path, a, b = stack.pop()
+        if old_hashes[id(a)] == new_hashes[id(b)]:
+            continue
+        if type(a) is not type(b):
+            changes.append((path, 'changed'))
+            continue
+        if _parameters(a) != _parameters(b):
+            changes.append((path, 'changed'))
+        matched = {}
+        for attribute, child in _children(a):
+            matched.setdefault((attribute, _label(child)), []).append(child)
+        for attribute, child in _children(b):
+            child_path = _child_path(path, attribute, child)
+            candidates = matched.get((attribute, _label(child)))
+            if candidates:
+                stack.append((child_path, candidates.pop(0), child))
+            else:
+                changes.append((child_path, 'added'))
+        for (attribute, _), children in matched.items():
+            for child in children:
+                changes.append((_child_path(path, attribute, child), 'removed'))
+    changes.sort()
+    return changes
@@ -0,0 +1,443 @@
+"""
+    kampach.csg
+    ~~~~~~~~~~~
+
+    Composite (constructive solid geometry) shapes, e.g. the successive
+    phases of a building, partly overlapping each other or sticking out of
+    the building.
+
+    The primitives are building shapes (truncated pyramids, cuboids, prisms,
+    stairs and cylinders) placed at a position, the center of their base,
+    and possibly rotated around the vertical axis. They are combined by
+    Union, Intersection and Difference operators.
+
+    The volumes are exact where the bounding boxes show a closed form: the
+    volume of a primitive, the sum of the volumes of the children of a union
+    whose boxes don't overlap, a primitive entirely inside another one... The
+    other parts (the groups of overlapping boxes) are integrated on a grid of
+    voxels covering their common box only, and each point is only tested
+    against the solids whose box contains it, so that a building with
+    hundreds of phases is evaluated quickly. The integration is deterministic
+    (voxel centers rather than random points), so that an unchanged model
+    gives the same volumes.
+
+    The volumes are monotonic in the dimensions of the primitives (growing
+    with the solids of unions and intersections, decreasing with the
+    subtracted solids of differences), so that their bounds are the volumes
+    with the dimensions at their bounds. The positions and rotations are
+    taken at their mean.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg, xmlio
+from .arithmetic import BoundedQuantity, parse_quantity
+from .geometry import Cylinder, TruncatedPyramid, null
+from abc import ABCMeta, abstractmethod
+import xml.etree.ElementTree as ET
+import itertools
+import copy
+import numpy as np
+
+BOUNDS = ('lower', 'mean', 'upper')
+
+"""Bound of the dimensions of the subtracted solids giving a bound of a
+difference
+"""
+FLIPPED = {'lower': 'upper', 'mean': 'mean', 'upper': 'lower'}
+
+
+def _at_bound(val, bound):
+    if isinstance(val, BoundedQuantity):
+        if bound == 'mean':
+            return val.mean
+        return getattr(val, bound)*val.units
+    return val
+
+
+def _magnitude(val, units=ureg.meter):
+    return float(_at_bound(val, 'mean').to(units).magnitude)
+
+
+def parse_position(string):
+    """Parses a position given as 'x; y; z', e.g. '2 m; 0 m; 1.5 m'.
+    """
+    coordinates = string.split(';')
+    if len(coordinates) != 3:
+        raise ValueError('A position must have three coordinates: ' + string)
+    return tuple(ureg(c) for c in coordinates)
+
+
+def format_position(position):
+    return '{0}; {1}; {2}'.format(*position)
+
+
+def is_supported(shape):
+    """Whether a building shape can be placed in a composite shape.
+    """
+    return isinstance(shape, (TruncatedPyramid, Cylinder))
+
+
+def _in_box(points, low, high):
+    return ((points >= low) & (points <= high)).all(axis=1)
+
+
+def _corners(low, high):
+    return np.array(list(itertools.product(*zip(low, high))), dtype=float)
+
+
+def _overlap_groups(boxes):
+    """Groups the indices of boxes (low, high) whose boxes overlap, directly
+    or through other boxes.
+    """
+    if not boxes:
+        return []
+    low = np.array([b[0] for b in boxes])
+    high = np.array([b[1] for b in boxes])
+    overlap = ((low[:, None] < high[None, :])
+               & (low[None, :] < high[:, None])).all(axis=2)
+    groups = []
+    unvisited = np.ones(len(boxes), dtype=bool)
+    for start in range(len(boxes)):
+        if not unvisited[start]:
+            continue
+        unvisited[start] = False
+        group, frontier = [start], [start]
+        while frontier:
+            found = np.flatnonzero(overlap[frontier].any(axis=0) & unvisited)
+            unvisited[found] = False
+            frontier = list(found)
+            group.extend(frontier)
+        groups.append(sorted(group))
+    return groups
+
+
+def _union_contains(solids, boxes, points, bound):
+    result = np.zeros(len(points), dtype=bool)
+    for solid, (low, high) in zip(solids, boxes):
+        mask = ~result & _in_box(points, low, high)
+        if mask.any():
+            result[mask] = solid.contains(points[mask], bound)
+    return result
+
+
+def _voxel_size(low, high, samples):
+    return (np.prod(np.maximum(high - low, 0))/samples)**(1/3)
+
+
+def integrate(contains, low, high, step):
+    """Integrates the volume of a solid in a box on a grid of voxels.
+
+    :param contains: function returning whether each point of an array is in
+        the solid
+    :param low, high: corners of the box
+    :param step: size of the voxels, reduced so that there are at least
+        Solid.min_samples voxels
+    :return: the volume, in the units of the coordinates cubed
+    """
+    low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+    extent = high - low
+    if (extent <= 0).any():
+        return 0.
+    step = min(step, _voxel_size(low, high, Solid.min_samples))
+    counts = np.maximum(np.ceil(extent/step).astype(int), 1)
+    axes = [low[i] + (np.arange(counts[i]) + 0.5)*extent[i]/counts[i]
+            for i in range(3)]
+    points = np.stack([a.ravel() for a in np.meshgrid(*axes, indexing='ij')],
+                      axis=1)
+    return np.count_nonzero(contains(points))*extent.prod()/counts.prod()
+
+
+class Solid(metaclass=ABCMeta):
+    """Abstract class describing a positioned solid. The coordinates are in
+    meters, in the frame of the building (origin at the center of the base of
+    its shape, x along its length, z upwards).
+    """
+    
+    # Approximate number of voxels in the box of the solid evaluated, and
+    # minimum number of voxels of each integrated part of it
+    samples = 100000
+    min_samples = 4096
+    
+    @abstractmethod
+    def bounding_box(self, bound='mean'):
+        """Returns the corners (low, high) of the bounding box of the solid,
+        with its dimensions at a bound ('lower', 'mean' or 'upper').
+        """
+        pass
+    
+    @abstractmethod
+    def contains(self, points, bound='mean'):
+        """Returns whether each point (row of an array) is in the solid.
+        """
+        pass
+    
+    @abstractmethod
+    def compute_volume(self, bound='mean'):
+        """Computes the volume in cubic meters.
+        """
+        pass
+    
+    def compute_total_volume(self):
+        """Computes the volume, with its bounds.
+        """
+        lower, mean, upper = [self.compute_volume(bound) for bound in BOUNDS]
+        return BoundedQuantity(mean*ureg.meter**3, (lower, upper))
+    
+    def export_to_xml(self, parent):
+        return ET.SubElement(parent, xmlio.get_tag_from_class(type(self)))
+    
+    def add_data_from_xml_element(self, elem):
+        pass
+
+
+class Placed(Solid):
+    """A building shape placed in a composite shape.
+
+    :param shape: a TruncatedPyramid (or a subclass) or a Cylinder
+    :param position: point (x, y, z) of the center of the base
+    :param rotation: angle of the length of the shape from the x axis
+    """
+    
+    def __init__(self, shape=None, position=None, rotation=0*ureg.degree):
+        self.shape = shape
+        self.position = position or (null, null, null)
+        self.rotation = rotation
+    
+    def __setattr__(self, name, value):
+        # Any change invalidates the cached frame
+        self.__dict__.pop('_results', None)
+        super().__setattr__(name, value)
+    
+    def _dimensions(self, bound):
+        """Magnitudes in meters of the dimensions of the shape at a bound
+        ((radius, height) of a cylinder, (bottom_length, bottom_width,
+        top_length, top_width, height) of a pyramid) and its volume. They are
+        cached with the results of the shape, cleared when it is modified.
+        """
+        if not is_supported(self.shape):
+            raise ValueError('A {} cannot be placed in a composite shape'
+                             .format(type(self.shape).__name__))
+        results = self.shape.__dict__.setdefault('_results', {})
+        key = 'Placed._dimensions.' + bound
+        if key not in results:
+            shape = copy.copy(self.shape)
+            shape.tight_bounds = False
+            for name, val in vars(self.shape).items():
+                if isinstance(val, BoundedQuantity):
+                    setattr(shape, name, _at_bound(val, bound))
+            if isinstance(shape, Cylinder):
+                names = ('radius', 'height')
+            else:
+                names = ('bottom_length', 'bottom_width', 'top_length',
+                         'top_width', 'height')
+            results[key] = ([_magnitude(getattr(shape, name)) for name in names],
+                            _magnitude(shape.compute_total_volume(), ureg.meter**3))
+        return results[key]
+    
+    def _frame(self):
+        """Position and rotation matrix of the shape.
+        """
+        results = self.__dict__.setdefault('_results', {})
+        if 'frame' not in results:
+            angle = _magnitude(self.rotation, ureg.radian)
+            cos, sin = np.cos(angle), np.sin(angle)
+            results['frame'] = (np.array([_magnitude(c) for c in self.position]),
+                                np.array([[cos, -sin, 0.], [sin, cos, 0.],
+                                          [0., 0., 1.]]))
+        return results['frame']
+    
+    def bounding_box(self, bound='mean'):
+        dimensions, _ = self._dimensions(bound)
+        if isinstance(self.shape, Cylinder):
+            r, height = dimensions
+            half_length = half_width = r
+        else:
+            length, width, top_length, top_width, height = dimensions
+            half_length, half_width = max(length, top_length)/2, max(width, top_width)/2
+        position, rotation = self._frame()
+        corners = _corners([-half_length, -half_width, 0.],
+                           [half_length, half_width, height]) @ rotation.T + position
+        return corners.min(axis=0), corners.max(axis=0)
+    
+    def contains(self, points, bound='mean'):
+        dimensions, _ = self._dimensions(bound)
+        position, rotation = self._frame()
+        # Coordinates in the frame of the shape
+        x, y, z = ((np.asarray(points, dtype=float) - position) @ rotation).T
+        height = dimensions[-1]
+        inside = (z >= 0) & (z <= height)
+        if isinstance(self.shape, Cylinder):
+            return inside & (x*x + y*y <= dimensions[0]**2)
+        length, width, top_length, top_width, _ = dimensions
+        t = z/height if height > 0 else z
+        half_length = (length*(1 - t) + top_length*t)/2
+        half_width = (width*(1 - t) + top_width*t)/2
+        return inside & (np.abs(x) <= half_length) & (np.abs(y) <= half_width)
+    
+    def compute_volume(self, bound='mean'):
+        return self._dimensions(bound)[1]
+    
+    def export_to_xml(self, parent):
+        elem = super().export_to_xml(parent)
+        elem.set('position', format_position(self.position))
+        if self.rotation != 0:
+            elem.set('rotation', str(self.rotation))
+        self.shape.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        if 'position' in elem.attrib:
+            self.position = parse_position(elem.get('position'))
+        if 'rotation' in elem.attrib:
+            self.rotation = parse_quantity(elem.get('rotation'))
+        self.shape = xmlio.create_object_from_xml_element(elem[0])
+
+
+class Union(Solid):
+    """Union of solids.
+    """
+    
+    def __init__(self, children=None):
+        self.children = children or []
+    
+    def bounding_box(self, bound='mean'):
+        boxes = [child.bounding_box(bound) for child in self.children]
+        if not boxes:
+            return np.zeros(3), np.zeros(3)
+        return (np.min([b[0] for b in boxes], axis=0),
+                np.max([b[1] for b in boxes], axis=0))
+    
+    def contains(self, points, bound='mean'):
+        boxes = [child.bounding_box(bound) for child in self.children]
+        return _union_contains(self.children, boxes, points, bound)
+    
+    def compute_volume(self, bound='mean'):
+        boxes = [child.bounding_box(bound) for child in self.children]
+        step = _voxel_size(*self.bounding_box(bound), self.samples)
+        volume = 0.
+        for group in _overlap_groups(boxes):
+            if len(group) == 1:
+                volume += self.children[group[0]].compute_volume(bound)
+                continue
+            members = [self.children[i] for i in group]
+            member_boxes = [boxes[i] for i in group]
+            volume += integrate(
+                lambda points: _union_contains(members, member_boxes, points,
+                                               bound),
+                np.min([b[0] for b in member_boxes], axis=0),
+                np.max([b[1] for b in member_boxes], axis=0), step)
+        return volume
+    
+    def export_to_xml(self, parent):
+        elem = super().export_to_xml(parent)
+        for child in self.children:
+            child.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        self.children = [xmlio.create_object_from_xml_element(e) for e in elem]
+
+
+class Intersection(Union):
+    """Intersection of solids.
+    """
+    
+    def bounding_box(self, bound='mean'):
+        boxes = [child.bounding_box(bound) for child in self.children]
+        if not boxes:
+            return np.zeros(3), np.zeros(3)
+        low = np.max([b[0] for b in boxes], axis=0)
+        return low, np.maximum(np.min([b[1] for b in boxes], axis=0), low)
+    
+    def contains(self, points, bound='mean'):
+        result = _in_box(points, *self.bounding_box(bound))
+        for child in self.children:
+            inside = np.flatnonzero(result)
+            result[inside] = child.contains(points[inside], bound)
+        return result
+    
+    def compute_volume(self, bound='mean'):
+        low, high = self.bounding_box(bound)
+        if not self.children or (high <= low).any():
+            return 0.
+        # A child inside all the other (convex) children
+        for child in self.children:
+            corners = _corners(*child.bounding_box(bound))
+            if all(isinstance(other, Placed) and other.contains(corners, bound).all()
+                   for other in self.children if other is not child):
+                return child.compute_volume(bound)
+        return integrate(lambda points: self.contains(points, bound),
+                         low, high, _voxel_size(low, high, self.samples))
+
+
+class Difference(Solid):
+    """A solid (base) without other solids (subtracted).
+    """
+    
+    def __init__(self, base=None, subtracted=None):
+        self.base = base
+        self.subtracted = subtracted or []
+    
+    def bounding_box(self, bound='mean'):
+        return self.base.bounding_box(bound)
+    
+    def contains(self, points, bound='mean'):
+        result = self.base.contains(points, bound)
+        flipped = FLIPPED[bound]
+        for solid in self.subtracted:
+            mask = result & _in_box(points, *solid.bounding_box(flipped))
+            if mask.any():
+                result[mask] = ~solid.contains(points[mask], flipped)
+        return result
+    
+    def _removed_volume(self, base_bound, bound):
+        """Volume of the parts of the subtracted solids (at bound) inside the
+        base (at base_bound).
+        """
+        base_low, base_high = self.base.bounding_box(base_bound)
+        boxes, solids = [], []
+        for solid in self.subtracted:
+            low, high = solid.bounding_box(bound)
+            if (np.maximum(low, base_low) < np.minimum(high, base_high)).all():
+                boxes.append((low, high))
+                solids.append(solid)
+        step = _voxel_size(base_low, base_high, self.samples)
+        volume = 0.
+        for group in _overlap_groups(boxes):
+            if (len(group) == 1 and isinstance(self.base, Placed) and self.base
+                    .contains(_corners(*boxes[group[0]]), base_bound).all()):
+                volume += solids[group[0]].compute_volume(bound)
+                continue
+            members = [solids[i] for i in group]
+            member_boxes = [boxes[i] for i in group]
+            volume += integrate(
+                lambda points: self.base.contains(points, base_bound)
+                & _union_contains(members, member_boxes, points, bound),
+                np.maximum(np.min([b[0] for b in member_boxes], axis=0), base_low),
+                np.minimum(np.max([b[1] for b in member_boxes], axis=0), base_high),
+                step)
+        return volume
+    
+    def compute_volume(self, bound='mean'):
+        return self.base.compute_volume(bound) \
+            - self._removed_volume(bound, FLIPPED[bound])
+    
+    def compute_removed_volume(self):
+        """Computes the volume of the parts of the subtracted solids inside
+        the base, with its bounds.
+        """
+        lower, mean, upper = [self._removed_volume(bound, bound) for bound in BOUNDS]
+        return BoundedQuantity(mean*ureg.meter**3, (lower, upper))
+    
+    def export_to_xml(self, parent):
+        elem = super().export_to_xml(parent)
+        self.base.export_to_xml(elem)
+        for solid in self.subtracted:
+            solid.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        solids = [xmlio.create_object_from_xml_element(e) for e in elem]
+        self.base, self.subtracted = solids[0], solids[1:]
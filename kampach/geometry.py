@@ -8,34 +8,90 @@
     :license: CeCILL, see LICENSE for more details.
 """
 
-from . import ureg, xmlio
+from . import ureg, xmlio, bounds
 from .arithmetic import parse_quantity
 from abc import ABCMeta, abstractmethod
 import xml.etree.ElementTree as ET
+import functools
+import copy
 import math
 
 null = 0*ureg.meter
 
 
+def cached_result(method):
+    """Decorator caching the result of a shape computation until one of the
+    shape parameters is modified. A copy of the result is returned, so that
+    in-place operations of the caller do not alter the cache.
+    
+    In tight bounds mode, the result is computed by bounds.tight_bounds().
+    """
+    @functools.wraps(method)
+    def wrapper(self):
+        results = self.__dict__.setdefault('_results', {})
+        if method.__qualname__ not in results:
+            if self.tight_bounds:
+                result = bounds.tight_bounds(self, method.__name__)
+            else:
+                result = method(self)
+            results[method.__qualname__] = result
+        return copy.copy(results[method.__qualname__])
+    return wrapper
+
+
 class BuildingShape(metaclass=ABCMeta):
     """Abstract class describing a building shape, gathering the methods to
     compute volumes and areas.
     """
     
+    # Compute exact bounds instead of propagating independent bounds
+    tight_bounds = False
+    
+    # Methods whose extrema are on the corners of the parameters box
+    # (multilinear or monotonic in each parameter), evaluated on the corners
+    # only in tight bounds mode. The bounds of the other methods are computed
+    # by interval subdivision.
+    vertex_methods = ()
+    
     def __init__(self, finish_thickness=null):
         self.finish_thickness = finish_thickness
     
+    def __setattr__(self, name, value):
+        # Any parameter change invalidates the cached results
+        self.__dict__.pop('_results', None)
+        super().__setattr__(name, value)
+    
+    def _key(self):
+        """Value-based identity of the shape: its type and its parameters.
+        """
+        params = sorted((k, v) for k, v in vars(self).items() if k != '_results')
+        return (type(self), tuple(params))
+    
+    def __eq__(self, other):
+        if isinstance(other, BuildingShape):
+            return self._key() == other._key()
+        else:
+            return False
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    # Shapes are mutable: they are compared by value, but not hashable
+    __hash__ = None
+    
     @abstractmethod
     def compute_total_volume(self):
         """Computes the total volume of the building.
         """
         pass
     
+    @cached_result
     def compute_fill_volume(self):
         """Computes the (inner) fill volume of the building.
         """
         return self.compute_total_volume()-self.compute_finish_volume()
     
+    @cached_result
     def compute_finish_volume(self):
         """Computes the (outer) finish volume of the building.
         """
@@ -53,6 +109,7 @@ class BuildingShape(metaclass=ABCMeta):
         """
         pass
     
+    @cached_result
     def compute_total_finish_area(self):
         """Computes the total (outer) finish area of the building.
         """
@@ -72,6 +129,10 @@ class TruncatedPyramid(BuildingShape):
     """A symmetric truncated pyramid with rectangular base.
     """
     
+    # The trapezoid areas are not monotonic: the slant height is minimal
+    # when the top and bottom widths are equal
+    vertex_methods = ('compute_total_volume', 'compute_top_finish_area')
+    
     def __init__(self, finish_thickness=null, bottom_length=null, bottom_width=null,
                  top_length=null, top_width=null, height=null):
         super().__init__(finish_thickness)
@@ -81,6 +142,7 @@ class TruncatedPyramid(BuildingShape):
         self.top_length = top_length
         self.height = height
     
+    @cached_result
     def compute_total_volume(self):
         """Computes the volume of the pyramid.
         """
@@ -97,6 +159,7 @@ class TruncatedPyramid(BuildingShape):
         vol *= self.height
         return vol 
     
+    @cached_result
     def compute_length_trapezoid_area(self):
         """Computes the area of the trapezoidal face along the length.
         """
@@ -105,6 +168,7 @@ class TruncatedPyramid(BuildingShape):
         height = (self.height*self.height + foot*foot)**.5
         return 0.5 * (self.bottom_length + self.top_length) * height
     
+    @cached_result
     def compute_width_trapezoid_area(self):
         """Computes the area of the trapezoidal face along the width.
         """
@@ -113,6 +177,7 @@ class TruncatedPyramid(BuildingShape):
         height = (self.height*self.height + foot*foot)**.5
         return 0.5 * (self.bottom_width + self.top_width) * height
     
+    @cached_result
     def compute_walls_finish_area(self):
         """Computes the area of the four trapezoidal faces of the pyramid.
         """
@@ -121,6 +186,7 @@ class TruncatedPyramid(BuildingShape):
         area *= 2 # There are 4 faces
         return area
     
+    @cached_result
     def compute_top_finish_area(self):
         """Computes the area of the top base.
         """
@@ -205,6 +271,7 @@ class Stairs(TruncatedPyramid):
                          top_length, top_width, height)
         self.depth = depth
     
+    @cached_result
     def compute_finish_volume_base_area(self):
         """Computes the area of the two trapezoidal side faces of the stairs,
         plus the area of the countersteps (area of the finish volume).
@@ -213,6 +280,7 @@ class Stairs(TruncatedPyramid):
         area += 0.5*(self.bottom_length+self.top_length)*self.height
         return area
     
+    @cached_result
     def compute_finish_volume(self):
         """For stairs, the finish volume is not the walls finish area times
         the finish thickness, because the horizontal steps are not taken into
@@ -220,6 +288,7 @@ class Stairs(TruncatedPyramid):
         """
         return self.compute_finish_volume_base_area()*self.finish_thickness
     
+    @cached_result
     def compute_walls_finish_area(self):
         """Computes the area covered by plaster: add the horizontal steps to
         the base area of the finish volume.
@@ -242,21 +311,28 @@ class Cylinder(BuildingShape):
     """A cylinder.
     """
     
+    vertex_methods = ('compute_total_volume', 'compute_walls_finish_area',
+                      'compute_top_finish_area', 'compute_total_finish_area',
+                      'compute_finish_volume')
+    
     def __init__(self, finish_thickness=null, diameter=null, height=null):
         super().__init__(finish_thickness)
         self.radius = diameter/2.
         self.height = height
     
+    @cached_result
     def compute_total_volume(self):
         """Computes the volume of the cylinder.
         """
         return self.height * math.pi * self.radius * self.radius
     
+    @cached_result
     def compute_walls_finish_area(self):
         """Computes the area of the vertical face.
         """
         return 2 * math.pi * self.radius * self.height
     
+    @cached_result
     def compute_top_finish_area(self):
         """Computes the area of the top base.
         """
@@ -280,6 +356,8 @@ class Superstructure(BuildingShape):
     """A superstructure like the ones on top of pyramids.
     """
     
+    vertex_methods = ('compute_top_finish_area',)
+    
     def __init__(self, finish_thickness=null, number_of_rooms=2, depth=null,
                  width=null, walls_thickness=null, door_width=null, door_height=null,
                  ceiling_height=null, outer_height=null):
@@ -302,6 +380,7 @@ class Superstructure(BuildingShape):
     def compute_room_width(self):
         return self.width-2*self.walls_thickness
     
+    @cached_result
     def compute_total_volume(self):
         prism = Prism(width=self.compute_room_width(),
                       depth=self.compute_room_depth(),
@@ -316,6 +395,7 @@ class Superstructure(BuildingShape):
         vol = self.outer_height*self.width*self.depth
         return vol-vol_sub
     
+    @cached_result
     def compute_walls_finish_area(self):
         outer_area = self.outer_height*(2*(self.width+self.depth)-self.door_width)
         
@@ -323,7 +403,7 @@ class Superstructure(BuildingShape):
         inner_walls_area += self.width-2*self.walls_thickness
         l = self.width-2*self.walls_thickness-self.door_width
         inner_walls_area += l*(1+2*(self.number_of_rooms-1))
-        inner_walls_area *= self.door_height
+        inner_walls_area = inner_walls_area*self.door_height
         
         prism = Prism(width=self.compute_room_width(),
                       depth=self.compute_room_depth(),
@@ -332,6 +412,7 @@ class Superstructure(BuildingShape):
         
         return outer_area+inner_walls_area+ceiling_area
     
+    @cached_result
     def compute_top_finish_area(self):
         return self.width*self.depth
     
@@ -0,0 +1,196 @@
+"""
+    kampach.gradient
+    ~~~~~~~~~~~~~~~~
+
+    Reverse-mode differentiation of the total cost with respect to all the
+    parameters of a model.
+
+    The parameters are replaced by Variable objects, that record the
+    operations of one evaluation of the model on a tape. A single backward
+    pass on the tape then gives the derivatives of the cost with respect to
+    every parameter, with their units.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .parameters import iter_parameters
+from collections import OrderedDict
+from numbers import Number
+
+
+class Tape:
+    """Ordered record of the variables created during an evaluation. The
+    creation order is a topological order of the evaluation graph.
+    """
+    
+    def __init__(self):
+        self.variables = []
+    
+    def backward(self, output):
+        """Computes the derivative of output with respect to all the
+        variables of the tape.
+        """
+        for var in self.variables:
+            var.adjoint = 0.
+        output.adjoint = 1.
+        for var in reversed(self.variables):
+            if var.adjoint == 0:
+                continue
+            for parent, derivative in var.parents:
+                parent.adjoint += var.adjoint*derivative
+
+
+class Variable:
+    """A magnitude of the evaluation graph, with the derivatives of this
+    magnitude with respect to the variables it was computed from.
+    
+    Variables are used as the magnitude of quantities, so that Pint handles
+    the units (unit conversions are recorded as multiplications).
+    Variables are immutable: in-place operators return new variables.
+    """
+    
+    def __init__(self, value, parents=(), tape=None):
+        self.value = value
+        self.parents = parents
+        self.adjoint = 0.
+        self.tape = tape if tape is not None else parents[0][0].tape
+        self.tape.variables.append(self)
+    
+    def __repr__(self):
+        return "<Variable({})>".format(self.value)
+    
+    def __format__(self, spec):
+        return format(self.value, spec)
+    
+    def __copy__(self):
+        return self
+    
+    def __eq__(self, other):
+        # Needed by Pint to detect additions of zero
+        return self.value == _value(other)
+    
+    __hash__ = object.__hash__
+    
+    def __lt__(self, other):
+        return self.value < _value(other)
+    
+    def __le__(self, other):
+        return self.value <= _value(other)
+    
+    def __gt__(self, other):
+        return self.value > _value(other)
+    
+    def __ge__(self, other):
+        return self.value >= _value(other)
+    
+    def _new(self, value, *parents):
+        parents = tuple((p, d) for p, d in parents if isinstance(p, Variable))
+        return Variable(value, parents, self.tape)
+    
+    def __add__(self, other):
+        if not isinstance(other, (Variable, Number)):
+            return NotImplemented
+        return self._new(self.value + _value(other), (self, 1.), (other, 1.))
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        if not isinstance(other, (Variable, Number)):
+            return NotImplemented
+        return self._new(self.value - _value(other), (self, 1.), (other, -1.))
+    
+    def __rsub__(self, other):
+        return self._new(other - self.value, (self, -1.))
+    
+    def __mul__(self, other):
+        if not isinstance(other, (Variable, Number)):
+            return NotImplemented
+        return self._new(self.value*_value(other), (self, _value(other)),
+                         (other, self.value))
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other):
+        if not isinstance(other, (Variable, Number)):
+            return NotImplemented
+        other_value = _value(other)
+        return self._new(self.value/other_value, (self, 1/other_value),
+                         (other, -self.value/other_value**2))
+    
+    def __rtruediv__(self, other):
+        return self._new(other/self.value, (self, -other/self.value**2))
+    
+    def __pow__(self, other):
+        return self._new(self.value**other, (self, other*self.value**(other-1)))
+    
+    def __neg__(self):
+        return self._new(-self.value, (self, -1.))
+    
+    def __abs__(self):
+        return self._new(abs(self.value), (self, 1. if self.value >= 0 else -1.))
+
+
+# Variables can be used where numbers are expected, e.g. as the bounds of a
+# BoundedQuantity
+Number.register(Variable)
+
+
+def _value(obj):
+    if isinstance(obj, Variable):
+        return obj.value
+    return obj
+
+
+def _variable(val, tape):
+    """Replaces the magnitude of a parameter value by a variable.
+    """
+    if isinstance(val, BoundedQuantity):
+        val = val.mean
+    if isinstance(val, ureg.Quantity):
+        var = Variable(float(val.magnitude), tape=tape)
+        return var, ureg.Quantity(var, val.units)
+    var = Variable(val, tape=tape)
+    return var, var
+
+
+def compute_gradient(root):
+    """Computes the total cost of root and its derivatives with respect to all
+    the parameters of the model (see kampach.parameters), using the mean
+    values of the parameters.
+    
+    :return: the total cost and an ordered dict mapping parameter paths to
+        derivatives
+    """
+    tape = Tape()
+    params = list(iter_parameters(root))
+    originals = [param.value for param in params]
+    variables = []
+    try:
+        for param, val in zip(params, originals):
+            var, param.value = _variable(val, tape)
+            variables.append(var)
+        cost = root.compute_total_cost(quiet=True)
+    finally:
+        for param, val in zip(params, originals):
+            param.value = val
+    if isinstance(cost, BoundedQuantity):
+        cost = cost.mean
+    if isinstance(cost, ureg.Quantity):
+        units = cost.units
+        output = cost.magnitude
+    else:
+        units = ureg.dimensionless
+        output = cost
+    if isinstance(output, Variable):
+        tape.backward(output)
+        value = output.value*units
+    else:
+        value = output*units
+    gradients = OrderedDict()
+    for param, val, var in zip(params, originals, variables):
+        param_units = getattr(val, 'units', ureg.dimensionless)
+        gradients[param.path] = var.adjoint*units/param_units
+    return value, gradients
@@ -4,22 +4,42 @@
 
     Graphical user interface.
 
+    The parameters panel lists the bounded parameters of the valuable
+    selected in the tree of the model, with a slider moving their mean
+    between their bounds and an entry box for any value. The changes are
+    debounced, and only the subtrees of the changed valuables are evaluated
+    again (see kampach.incremental) to update the costs.
+
     :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
     :license: CeCILL, see LICENSE for more details.
 """
 
 import tkinter as tk
 from tkinter import filedialog as fd
+from tkinter import ttk
 from .xmlio import load_xml_file
 from .site import Building
 from .valuable import QuantitativeValuable
+from .arithmetic import BoundedQuantity, parse_quantity
+from .incremental import IncrementalEvaluation
 import csv
+import time
+
+"""Delay (ms) of the evaluation after the last change of a parameter
+"""
+DEBOUNCE_DELAY = 50
+
+"""Number of steps of the sliders between the bounds of a parameter
+"""
+SLIDER_STEPS = 100
 
 class KampachUI(tk.Frame):
     def __init__(self, master=None):
         super().__init__(master)
         self.master = master
-        self.pack()
+        self.evaluation = None
+        self._pending = None
+        self.pack(fill="both", expand=True)
         self.create_widgets()
 
     def create_widgets(self):
@@ -32,6 +52,16 @@ class KampachUI(tk.Frame):
                               command=self.master.destroy)
         self.quit.pack(side="bottom")
 
+        self.total_label = tk.Label(self, anchor="w", justify="left")
+        self.total_label.pack(side="bottom", fill="x")
+
+        self.tree = ttk.Treeview(self, show="tree", selectmode="browse")
+        self.tree.bind("<<TreeviewSelect>>", self.select_node)
+        self.tree.pack(side="left", fill="both", expand=True)
+
+        self.parameters_frame = tk.Frame(self)
+        self.parameters_frame.pack(side="right", fill="both", expand=True)
+
     def load_file(self):
         file_name = fd.askopenfilename(filetypes=[("XML files", "*.xml")])
         if file_name:
@@ -45,6 +75,96 @@ class KampachUI(tk.Frame):
                     geom_csv.writerow(Building.make_geom_csv_header())
                     cost_csv.writerow(QuantitativeValuable.make_cost_csv_header())
                     self.root_valuable.compute_total_cost(geom_csv=geom_csv, cost_csv=cost_csv)
+            self.evaluation = IncrementalEvaluation(self.root_valuable)
+            self.fill_tree()
+            self.show_costs()
+
+    def fill_tree(self):
+        self.tree.delete(*self.tree.get_children())
+        evaluation = self.evaluation
+        for index, path in enumerate(evaluation.paths):
+            parent = evaluation.parents[index]
+            self.tree.insert("" if parent < 0 else str(parent), "end",
+                             iid=str(index), text=path.rsplit("/", 1)[-1],
+                             open=parent < 0)
+
+    def selected_node(self):
+        selection = self.tree.selection()
+        return int(selection[0]) if selection else None
+
+    def select_node(self, event=None):
+        """Lists the bounded parameters of the selected valuable.
+        """
+        for widget in self.parameters_frame.winfo_children():
+            widget.destroy()
+        index = self.selected_node()
+        if index is None:
+            return
+        for param in self.evaluation.node_parameters(index):
+            value = param.value
+            if isinstance(value, BoundedQuantity) and value.lower != value.upper:
+                self.add_parameter_row(param, value)
+        self.show_costs()
+
+    def add_parameter_row(self, param, value):
+        row = tk.Frame(self.parameters_frame)
+        row.pack(side="top", fill="x")
+        tk.Label(row, text=param.path.rsplit("/", 1)[-1]).pack(side="left")
+        entry = tk.Entry(row, width=30)
+        entry.insert(0, str(value))
+        lower, upper = value.lower, value.upper
+        scale = tk.Scale(row, from_=lower, to=upper, orient="horizontal",
+                         resolution=(upper - lower)/SLIDER_STEPS, showvalue=False)
+        scale.set(value.mean.magnitude)
+
+        def move(position):
+            # The bounds of the parameter are kept
+            new = BoundedQuantity(float(position)*value.units, (lower, upper))
+            entry.delete(0, "end")
+            entry.insert(0, str(new))
+            self.change_parameter(param, new)
+
+        def enter(event):
+            try:
+                new = parse_quantity(entry.get())
+            except Exception:
+                entry.configure(fg="red")
+                return
+            entry.configure(fg="black")
+            self.change_parameter(param, new)
+
+        scale.configure(command=move)
+        entry.bind("<Return>", enter)
+        scale.pack(side="left", fill="x", expand=True)
+        entry.pack(side="left")
+
+    def change_parameter(self, param, value):
+        """Changes a parameter and schedules the evaluation, cancelling the
+        one scheduled by the previous change.
+        """
+        self.evaluation.set_parameter(param, value)
+        if self._pending is not None:
+            self.after_cancel(self._pending)
+        self._pending = self.after(DEBOUNCE_DELAY, self.recalculate)
+
+    def recalculate(self):
+        self._pending = None
+        start = time.perf_counter()
+        evaluated = self.evaluation.update()
+        self.show_costs("{0} valuables evaluated in {1:.0f} ms".format(
+            evaluated, 1000*(time.perf_counter() - start)))
+
+    def show_costs(self, status=""):
+        if self.evaluation is None:
+            return
+        lines = ["Total cost: {}".format(self.evaluation.total_cost())]
+        index = self.selected_node()
+        if index is not None and index > 0:
+            lines.append("{0}: {1}".format(self.evaluation.paths[index],
+                                           self.evaluation.total_cost(index)))
+        if status:
+            lines.append(status)
+        self.total_label["text"] = "\n".join(lines)
 
 def start():
     root = tk.Tk()
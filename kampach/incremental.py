@@ -0,0 +1,154 @@
+"""
+    kampach.incremental
+    ~~~~~~~~~~~~~~~~~~~
+
+    Incremental evaluation of a model whose parameters are changed one at a
+    time, e.g. from the sliders of the GUI.
+
+    The model is evaluated once like compute_total_cost(), keeping the
+    amount and the own cost of each occurrence of a valuable in the tree
+    (the nodes, in evaluation order, so that the subtree of a node is a range
+    of nodes). A changed parameter only marks the nodes of its owner (a
+    valuable, its input or its shapes) as changed: update() evaluates again
+    their subtrees only, whose amounts may depend on the parameter, and the
+    total costs are sums of the own costs of ranges of nodes, kept in an
+    array with their bounds.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity, bounded_magnitudes
+from .parameters import _segments, iter_parameters
+from .valuable import QuantitativeValuable, QuantitativeValuableInput,\
+    cycle_error
+from numbers import Number
+import numpy as np
+
+"""Marker of the end of a subtree in the walk of the tree
+"""
+_END = object()
+
+
+def _cost_magnitudes(cost):
+    if isinstance(cost, Number):
+        return (cost, cost, cost)
+    return bounded_magnitudes(cost, ureg.work_day)
+
+
+class IncrementalEvaluation:
+    """Evaluation of root, updated after changes of its parameters. Like
+    compute_total_cost(), a ValueError is raised if root has a cycle of
+    references.
+
+    :param root: the model, e.g. a Site
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        # Nodes: input (or None), valuable, path, parent index, end of the
+        # subtree (exclusive) and number of instances
+        self.inputs, self.valuables, self.paths = [], [], []
+        self.parents, self.ends, self.counts = [], [], []
+        stack = [(None, root, root.name or type(root).__name__, -1, 1)]
+        # Valuables from the root down to the current one
+        active = set()
+        while stack:
+            item, valuable, path, parent, count = stack.pop()
+            if item is _END:
+                self.ends[parent] = len(self.valuables)
+                active.discard(id(self.valuables[parent]))
+                continue
+            if id(valuable) in active:
+                raise cycle_error(valuable)
+            active.add(id(valuable))
+            index = len(self.valuables)
+            count *= getattr(valuable, 'count', 1)
+            for values, value in ((self.inputs, item), (self.valuables, valuable),
+                                  (self.paths, path), (self.parents, parent),
+                                  (self.counts, count), (self.ends, None)):
+                values.append(value)
+            stack.append((_END, None, None, index, None))
+            children = [(i, getattr(i, 'input_valuable', i)) for i in valuable.inputs]
+            segments = _segments([child for _, child in children])
+            for segment, (i, child) in reversed(list(zip(segments, children))):
+                stack.append((i, child, path + '/' + segment, index, count))
+        self.counts = np.array(self.counts, dtype=float)
+        self.amounts = [None]*len(self.valuables)
+        # Own costs of the nodes (all instances), lower, mean and upper
+        self.costs = np.zeros((len(self.valuables), 3))
+        # Nodes of the owners of the parameters
+        self._owner_nodes = {}
+        for index, (item, valuable) in enumerate(zip(self.inputs, self.valuables)):
+            owners = [item, valuable, getattr(valuable, 'shape', None)]
+            owners.extend(getattr(valuable, 'substructures', []))
+            for owner in owners:
+                if owner is not None:
+                    self._owner_nodes.setdefault(id(owner), []).append(index)
+        self.parameters = list(iter_parameters(root))
+        self._changed = set()
+        self._evaluate(0, len(self.valuables))
+    
+    def __len__(self):
+        return len(self.valuables)
+    
+    def _evaluate(self, start, stop):
+        """Evaluates the nodes start:stop (whole subtrees), in order.
+        """
+        for k in range(start, stop):
+            item, valuable = self.inputs[k], self.valuables[k]
+            if isinstance(item, QuantitativeValuableInput):
+                parent = self.parents[k]
+                # The parent may be shared, and evaluated elsewhere since
+                if isinstance(self.valuables[parent], QuantitativeValuable):
+                    self.valuables[parent].amount = self.amounts[parent]
+                valuable.amount = item.compute_input_amount()
+            elif self.amounts[k] is not None:
+                valuable.amount = self.amounts[k]
+            self.amounts[k] = getattr(valuable, 'amount', None)
+            self.costs[k] = _cost_magnitudes(valuable.compute_own_cost(quiet=True))
+            self.costs[k] *= self.counts[k]
+    
+    def node_parameters(self, index):
+        """Returns the parameters of the node index: the ones of its
+        valuable, its input and its shapes.
+        """
+        return [param for param in self.parameters
+                if index in self._owner_nodes.get(id(param.owner), ())]
+    
+    def set_parameter(self, param, value):
+        """Changes the value of a parameter. The costs are updated by the
+        next update().
+        """
+        param.value = value
+        self._changed.update(self._owner_nodes.get(id(param.owner), ()))
+    
+    def update(self):
+        """Evaluates the subtrees of the nodes changed since the last update.
+
+        :return: the number of nodes evaluated
+        """
+        evaluated = 0
+        stop = 0
+        for index in sorted(self._changed):
+            # Subtrees of changed nodes are already evaluated
+            if index >= stop:
+                stop = self.ends[index]
+                self._evaluate(index, stop)
+                evaluated += stop - index
+        self._changed.clear()
+        return evaluated
+    
+    def own_cost(self, index):
+        """Own cost of the node index, for all its instances.
+        """
+        lower, mean, upper = self.costs[index]
+        return BoundedQuantity(mean*ureg.work_day, (lower, upper))
+    
+    def total_cost(self, index=0):
+        """Cost of the node index and its inputs, for all its instances (the
+        total cost of the model for the root).
+        """
+        lower, mean, upper = self.costs[index:self.ends[index]].sum(axis=0)
+        return BoundedQuantity(mean*ureg.work_day, (lower, upper))
@@ -0,0 +1,225 @@
+"""
+    kampach.index
+    ~~~~~~~~~~~~~
+
+    Random access to the elements of large XML files.
+
+    The index of a file records the byte offset and length of every named
+    element (sites, buildings, activities...) and of the Templates elements,
+    by path, e.g. 'Valley/Sector 2/House 12' (names of the named ancestors
+    and of the element, with an index when siblings have the same name, e.g.
+    'House 12[1]'). The characters '/', '[', '#' and '\\' of the names are
+    escaped by a '\\' (see escape_name()). The index is built once by
+    streaming the file through expat, and stored in a SQLite sidecar file
+    (<file>.index), rebuilt when the file changes.
+
+    An indexed element is loaded by parsing only its bytes, read from the
+    memory-mapped file in the encoding declared by the file, with the
+    templates of its ancestors.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import xmlio
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import contextlib
+import mmap
+import os
+import re
+import sqlite3
+
+"""Size of the chunks of the file given to the parser.
+"""
+CHUNK_SIZE = 2**20
+
+"""Encoding declaration at the start of an XML file.
+"""
+ENCODING = re.compile(rb'<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+
+def escape_name(name):
+    """Path segment of a name: the separator '/', the sibling index '[', the
+    '#' of '#Templates' and the escape character are escaped by a '\\'.
+    """
+    for c in '\\/[#':
+        name = name.replace(c, '\\' + c)
+    return name
+
+
+def split_path(path):
+    """Splits a path into its (escaped) segments.
+    """
+    segments = ['']
+    escaped = False
+    for c in path:
+        if c == '/' and not escaped:
+            segments.append('')
+            continue
+        segments[-1] += c
+        escaped = c == '\\' and not escaped
+    return segments
+
+
+def _signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class _IndexBuilder:
+    """Expat handlers recording the offsets of the named elements.
+    """
+    
+    def __init__(self, data, parser):
+        self.data = data
+        self.parser = parser
+        # Elements being parsed: [path, name, tag, start, has children]
+        self.open = []
+        # Paths of the named elements being parsed
+        self.scopes = ['']
+        # Numbers of the siblings of each path, to make the paths unique
+        self.siblings = {}
+        self.entries = []
+    
+    def _path(self, name):
+        parent = self.scopes[-1]
+        path = parent + '/' + name if parent else name
+        number = self.siblings.get(path, 0)
+        self.siblings[path] = number + 1
+        if number:
+            path = '{0}[{1}]'.format(path, number)
+        return path
+    
+    def start(self, tag, attrib):
+        if self.open:
+            self.open[-1][4] = True
+        name = attrib.get('name')
+        path = None
+        if name is not None:
+            path = self._path(escape_name(name))
+        elif tag == 'Templates':
+            name = '#Templates'
+            path = self._path(name)
+        if path is not None:
+            self.scopes.append(path)
+        self.open.append([path, name, tag, self.parser.CurrentByteIndex, False])
+    
+    def end(self, tag):
+        path, name, tag, start, has_children = self.open.pop()
+        if path is None:
+            return
+        self.scopes.pop()
+        end = self.parser.CurrentByteIndex
+        data = self.data
+        empty = (not has_children and data[end-2:end] == b'/>'
+                 and data.find(b'>', start, end-1) == -1)
+        if not empty:
+            # Skip the end tag
+            end = data.find(b'>', end) + 1
+        self.entries.append((path, name, tag, start, end - start))
+
+
+class XMLIndex:
+    """Index of the named elements of an XML file.
+
+    :param filename: the XML file
+    :param rebuild: rebuild the index even if it is up to date
+    """
+    
+    def __init__(self, filename, rebuild=False):
+        self.filename = os.path.abspath(filename)
+        self.connection = sqlite3.connect(self.index_filename(self.filename))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS file '
+                                '(size INTEGER, mtime_ns INTEGER)')
+        self._file = open(self.filename, 'rb')
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        # The sliced elements have no declaration: UTF-8 unless declared
+        match = ENCODING.match(self.data[:256])
+        self.encoding = match.group(1).decode() if match else None
+        if rebuild or not self.is_up_to_date():
+            self.build()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    @staticmethod
+    def index_filename(filename):
+        return filename + '.index'
+    
+    def is_up_to_date(self):
+        row = self.connection.execute('SELECT size, mtime_ns FROM file').fetchone()
+        return row is not None and tuple(row) == _signature(self.filename)
+    
+    def build(self):
+        """Indexes the file by streaming it through expat.
+        """
+        parser = xml.parsers.expat.ParserCreate()
+        builder = _IndexBuilder(self.data, parser)
+        parser.StartElementHandler = builder.start
+        parser.EndElementHandler = builder.end
+        for start in range(0, len(self.data), CHUNK_SIZE):
+            parser.Parse(self.data[start:start+CHUNK_SIZE], False)
+        parser.Parse(b'', True)
+        with self.connection:
+            self.connection.execute('DELETE FROM file')
+            self.connection.execute('DROP TABLE IF EXISTS elements')
+            self.connection.execute('CREATE TABLE elements (path TEXT, name TEXT, '
+                                    'tag TEXT, offset INTEGER, length INTEGER)')
+            self.connection.executemany('INSERT INTO elements VALUES (?, ?, ?, ?, ?)',
+                                        builder.entries)
+            self.connection.execute('CREATE UNIQUE INDEX paths ON elements (path)')
+            self.connection.execute('CREATE INDEX names ON elements (name)')
+            self.connection.execute('INSERT INTO file VALUES (?, ?)',
+                                    _signature(self.filename))
+    
+    def find(self, name=None, tag=None):
+        """Returns the paths of the elements with the given name and/or tag,
+        in document order.
+        """
+        query = 'SELECT path FROM elements WHERE 1'
+        args = []
+        if name is not None:
+            query += ' AND name = ?'
+            args.append(name)
+        if tag is not None:
+            query += ' AND tag = ?'
+            args.append(tag)
+        query += ' ORDER BY offset'
+        return [row[0] for row in self.connection.execute(query, args)]
+    
+    def get_element(self, path):
+        """Parses the element with the given path.
+        """
+        row = self.connection.execute('SELECT offset, length FROM elements '
+                                      'WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            raise KeyError('Unknown element: ' + path)
+        offset, length = row
+        parser = ET.XMLParser(encoding=self.encoding)
+        parser.feed(self.data[offset:offset+length])
+        return parser.close()
+    
+    def load_object(self, path):
+        """Creates the object of the element with the given path, with the
+        templates of its ancestors.
+        """
+        elem = self.get_element(path)
+        segments = split_path(path)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(xmlio.directory(os.path.dirname(self.filename)))
+            for i in range(len(segments)):
+                templates = '/'.join(segments[:i] + ['#Templates'])
+                try:
+                    stack.enter_context(xmlio.templates(self.get_element(templates)))
+                except KeyError:
+                    pass
+            return xmlio.create_object_from_xml_element(elem)
+    
+    def close(self):
+        self.connection.close()
+        self.data.close()
+        self._file.close()
@@ -0,0 +1,338 @@
+"""
+    kampach.inventory
+    ~~~~~~~~~~~~~~~~~
+
+    Import of building inventories from CSV files, with one row per
+    building:
+
+        name,shape,count,finish_thickness,length,width,height,height_min,height_max
+        House 1,Cuboid,1,0.2,5,4,3,2.5,3.5
+        Tower,Cylinder,2,0.3,,,12,,
+
+    The shape parameters are the arguments of the shape class, in the given
+    length units. A parameter may have bounds in the <name>_min and
+    <name>_max columns. Empty cells take the default value of the shape.
+
+    The rows are read in chunks into one column store per shape type, and
+    each shape type is evaluated at once: the shape methods and the inputs
+    of a template building run on arrays holding the mean, lower and upper
+    values of all the rows, with the same bounds as BoundedQuantity.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg, xmlio
+from .arithmetic import BoundedQuantity
+from .parameters import iter_parameters
+from .site import Building
+from .valuable import QuantitativeValuable, iter_evaluation
+from collections import OrderedDict
+from numbers import Number
+import inspect
+import itertools
+import operator
+import csv
+import numpy as np
+
+
+class BoundedArray:
+    """Mean values with lower and upper bounds for many rows, used as the
+    magnitude of a Quantity. The operators follow the rules of
+    BoundedQuantity, element-wise.
+    """
+    
+    def __init__(self, mean, lower=None, upper=None):
+        self.mean = np.asarray(mean, dtype=float)
+        self.lower = self.mean if lower is None else np.asarray(lower, dtype=float)
+        self.upper = self.mean if upper is None else np.asarray(upper, dtype=float)
+    
+    def __repr__(self):
+        return "<BoundedArray({0}, [{1} - {2}])>".format(self.mean, self.lower,
+                                                         self.upper)
+    
+    def _op(self, other, op):
+        if isinstance(other, BoundedArray):
+            other_m, other_l, other_u = other.mean, other.lower, other.upper
+        elif isinstance(other, (Number, np.ndarray)):
+            other_m = other_l = other_u = other
+        else:
+            # e.g. Quantity: let it handle the units
+            return NotImplemented
+        mean = op(self.mean, other_m)
+        bounds = (op(self.upper, other_l), op(self.lower, other_u),
+                  op(self.upper, other_u), op(self.lower, other_l))
+        return BoundedArray(mean, np.minimum(np.minimum.reduce(bounds), mean),
+                            np.maximum(np.maximum.reduce(bounds), mean))
+    
+    def __add__(self, other):
+        return self._op(other, operator.add)
+    
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        return self._op(other, operator.sub)
+    
+    def __rsub__(self, other):
+        return -self.__sub__(other)
+    
+    def __mul__(self, other):
+        return self._op(other, operator.mul)
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other):
+        return self._op(other, operator.truediv)
+    
+    def __rtruediv__(self, other):
+        return self.__truediv__(other)**(-1)
+    
+    def __pow__(self, other):
+        return self._op(other, operator.pow)
+    
+    def __neg__(self):
+        return BoundedArray(-self.mean, -self.upper, -self.lower)
+    
+    def __abs__(self):
+        straddle = (self.lower < 0) & (self.upper > 0)
+        lower = np.minimum(abs(self.lower), abs(self.upper))
+        upper = np.maximum(abs(self.lower), abs(self.upper))
+        mean = abs(self.mean)
+        return BoundedArray(mean, np.minimum(np.where(straddle, 0, lower), mean),
+                            np.maximum(upper, mean))
+    
+    def __getitem__(self, index):
+        return BoundedArray(self.mean[index], self.lower[index], self.upper[index])
+    
+    def __len__(self):
+        return len(self.mean)
+
+
+def _columns(bounded, units, size):
+    """(lower, mean, upper) arrays of a quantity of the evaluation.
+    """
+    if isinstance(bounded, ureg.Quantity):
+        bounded = bounded.to(units).magnitude
+    if not isinstance(bounded, BoundedArray):
+        bounded = BoundedArray(np.broadcast_to(float(bounded), (size,)))
+    return [np.broadcast_to(a, (size,)) for a in
+            (bounded.lower, bounded.mean, bounded.upper)]
+
+
+def _floats(cells, default, size):
+    """Converts a column of strings to floats, empty cells taking the default
+    value(s).
+    """
+    if cells is None:
+        return np.broadcast_to(np.asarray(default, dtype=float), (size,)).copy()
+    empty = cells == ''
+    values = np.where(empty, '0', cells).astype(float)
+    return np.where(empty, default, values)
+
+
+def shape_parameters(cls):
+    """Parameters of a shape class and their default values.
+    """
+    params = inspect.signature(cls.__init__).parameters
+    return OrderedDict((name, p.default) for name, p in params.items()
+                       if name != 'self')
+
+
+class ShapeTable:
+    """Column store of the buildings of a shape type.
+
+    :param cls: the BuildingShape class
+    """
+    
+    def __init__(self, cls, units='meter'):
+        self.cls = cls
+        self.units = units
+        self.parameters = shape_parameters(cls)
+        self.rows = []
+        self.names = []
+        # Chunks of instances counts
+        self.counts = []
+        # Parameter name -> list of (mean, lower, upper) chunks
+        self.chunks = {name: [] for name in self.parameters}
+        self.columns = None
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def append_chunk(self, rows, columns):
+        """Appends a chunk of rows.
+
+        :param rows: indices of the rows in the inventory
+        :param columns: dict mapping column names to arrays of strings
+        """
+        size = len(rows)
+        self.rows.extend(rows)
+        self.names.extend(columns.get('name', [''] * size))
+        self.counts.append(_floats(columns.get('count'), 1, size).astype(int))
+        for name, default in self.parameters.items():
+            if isinstance(default, ureg.Quantity):
+                default = default.to(self.units).magnitude
+            mean = _floats(columns.get(name), default, size)
+            lower = _floats(columns.get(name + '_min'), mean, size)
+            upper = _floats(columns.get(name + '_max'), mean, size)
+            self.chunks[name].append((mean, np.minimum(lower, mean),
+                                      np.maximum(upper, mean)))
+        self.columns = None
+    
+    def get_columns(self):
+        """Returns the parameters as quantities of bounded arrays.
+        """
+        if self.columns is None:
+            self.columns = {}
+            for name, default in self.parameters.items():
+                arrays = tuple(np.concatenate(c) for c in zip(*self.chunks[name]))
+                self.chunks[name] = [arrays]
+                val = BoundedArray(*arrays)
+                if isinstance(default, ureg.Quantity):
+                    val = ureg.Quantity(val, self.units)
+                self.columns[name] = val
+        return self.columns
+    
+    def create_shape(self):
+        """Returns a shape whose parameters are the columns of the table.
+        """
+        return self.cls(**self.get_columns())
+
+
+class BuildingInventory:
+    """Buildings imported from a CSV file, stored by shape type.
+    """
+    
+    def __init__(self, units='meter'):
+        self.units = units
+        self.tables = OrderedDict()
+        self.size = 0
+    
+    def read_csv(self, filename, chunk_size=10000):
+        """Reads an inventory file in chunks of rows.
+        """
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            while True:
+                rows = list(itertools.islice(reader, chunk_size))
+                if not rows:
+                    break
+                self.add_rows(header, rows)
+    
+    def add_rows(self, header, rows):
+        """Adds rows given as lists of strings, in the order of header.
+        """
+        cells = np.array(rows, dtype=str).reshape(len(rows), len(header))
+        shapes = cells[:, header.index('shape')]
+        for tag in np.unique(shapes):
+            if tag not in self.tables:
+                self.tables[tag] = ShapeTable(xmlio.get_class_from_tag(tag),
+                                              self.units)
+            selected = np.flatnonzero(shapes == tag)
+            columns = {name: cells[selected, i] for i, name in enumerate(header)}
+            self.tables[tag].append_chunk(list(selected + self.size), columns)
+        self.size += len(rows)
+    
+    def evaluate(self, template):
+        """Evaluates all the buildings with the inputs of the template
+        building.
+
+        :param template: a Building whose inputs are applied to every row
+        :return: an InventoryResults
+        """
+        results = InventoryResults(self)
+        shape = template.shape
+        # The bounded parameters of the template become bounded arrays too
+        params = [p for p in iter_parameters(template)
+                  if isinstance(p.value, BoundedQuantity)]
+        values = [p.value for p in params]
+        try:
+            for param, val in zip(params, values):
+                param.value = ureg.Quantity(BoundedArray(val.mean.magnitude,
+                                                         val.lower, val.upper),
+                                            val.units)
+            for tag, table in self.tables.items():
+                template.shape = table.create_shape()
+                results.add_table(table, template)
+        finally:
+            template.shape = shape
+            for param, val in zip(params, values):
+                param.value = val
+        return results
+
+
+class InventoryResults:
+    """Per-row geometry and costs of an inventory.
+    """
+    
+    GEOMETRY = (('fill_volume', 'meter ** 3'), ('finish_volume', 'meter ** 3'),
+                ('total_finish_area', 'meter ** 2'),
+                ('top_finish_area', 'meter ** 2'),
+                ('walls_finish_area', 'meter ** 2'))
+    
+    def __init__(self, inventory):
+        self.inventory = inventory
+        # Rows of each table and their results
+        self.tables = []
+        self.cost_units = ureg.work_day
+    
+    def add_table(self, table, building):
+        size = len(table)
+        geometry = [_columns(getattr(building, name), units, size)
+                    for name, units in self.GEOMETRY]
+        counts = np.concatenate(table.counts)
+        activities = []
+        total = np.zeros((3, size))
+        for item, cost, _, _ in iter_evaluation(building):
+            cost = _columns(cost, self.cost_units, size)
+            total += cost
+            if isinstance(item, QuantitativeValuable):
+                amount = item.amount
+                units = getattr(amount, 'units', ureg.dimensionless)
+                activities.append((item.name, _columns(amount, units, size),
+                                   cost))
+        self.tables.append((table, geometry, activities, total*counts))
+    
+    def compute_total_cost(self):
+        """Computes the total cost of the inventory, with its bounds.
+        """
+        lower, mean, upper = sum((total.sum(axis=1) for _, _, _, total in self.tables),
+                                 np.zeros(3))
+        return BoundedQuantity(mean*self.cost_units, (lower, upper))
+    
+    def _rows(self):
+        """Yields (row, table, index) in the order of the inventory file.
+        """
+        order = []
+        for t, (table, _, _, _) in enumerate(self.tables):
+            order.extend((row, t, i) for i, row in enumerate(table.rows))
+        order.sort()
+        return order
+    
+    def write_geom_csv(self, f):
+        """Writes the geometry of the buildings, with the columns of
+        Building.make_geom_csv_header().
+        """
+        writer = csv.writer(f)
+        writer.writerow(Building.make_geom_csv_header())
+        for _, t, i in self._rows():
+            table, geometry, _, _ = self.tables[t]
+            row = [table.names[i]]
+            for columns in geometry:
+                row += [float(c[i]) for c in columns]
+            writer.writerow(row)
+    
+    def write_cost_csv(self, f):
+        """Writes the amounts and costs of the activities of the buildings
+        (for one instance), with the columns of
+        QuantitativeValuable.make_cost_csv_header().
+        """
+        writer = csv.writer(f)
+        writer.writerow(QuantitativeValuable.make_cost_csv_header())
+        for _, t, i in self._rows():
+            table, _, activities, _ = self.tables[t]
+            writer.writerow([table.names[i]])
+            for name, amount, cost in activities:
+                writer.writerow([name] + [float(c[i]) for c in amount]
+                                + [float(c[i]) for c in cost])
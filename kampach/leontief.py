@@ -0,0 +1,312 @@
+"""
+    kampach.leontief
+    ~~~~~~~~~~~~~~~~
+
+    Input-output (Leontief) evaluation of linear models.
+
+    The linear valuables of a model are the sectors of an input-output
+    table: a linear input of a valuable i needing marginal_amount of a
+    valuable j per unit of its amount is the coefficient A[j, i], and the
+    inputs of the buildings (and their other constant inputs) give the final
+    demand d. The amounts x of the valuables are the solution of
+
+        (I - A) x = d
+
+    and their costs are x*marginal_cost + fixed_cost. Unlike the tree
+    evaluation, the inputs may refer to valuables defined elsewhere in the
+    model (see LinearQuantitativeValuableInput.reference), forming cycles,
+    e.g. tool making needing transport needing tools:
+
+        <LinearInput marginal_amount="0.01" ref="Tool making"/>
+
+    The coefficient matrix is stored sparse, and the system is solved by
+    strongly connected components in topological order: the acyclic parts
+    are solved by substitution, and each cycle by a dense solve of its own
+    block. Several demand vectors (scenarios) are solved at once.
+
+    The fixed costs and fixed amounts are counted once per instance of
+    their valuable in the tree (with the instances counts of the
+    buildings), so that a model without cycles gives the costs of the tree
+    evaluation. The coefficients must be non-negative, so that the bounds
+    of the amounts are the solutions for the lower and upper coefficients.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity, bounded_magnitudes
+from .valuable import LinearQuantitativeValuable,\
+    LinearQuantitativeValuableInput, QuantitativeValuable,\
+    QuantitativeValuableInput
+from numbers import Number
+import numpy as np
+
+BOUNDS = ('lower', 'mean', 'upper')
+
+
+def _magnitudes(val, units):
+    """(lower, mean, upper) magnitudes of a value in units. Numbers are
+    taken as magnitudes in units, e.g. a fixed cost of 0.
+    """
+    if isinstance(val, Number):
+        return np.array([val, val, val], dtype=float)
+    return np.array(bounded_magnitudes(val, units), dtype=float)
+
+
+def _base_units(val, units=ureg.dimensionless):
+    """Base units of the product of units and of the units of val.
+    """
+    units = units*getattr(val, 'units', ureg.dimensionless)
+    return (1*units).to_base_units().units
+
+
+def _components(n, rows, columns):
+    """Strongly connected components of the graph with edges columns ->
+    rows, in topological order (Tarjan's algorithm, without recursion).
+    """
+    successors = [[] for _ in range(n)]
+    for i, j in zip(columns, rows):
+        successors[i].append(j)
+    index = [-1]*n
+    low = [0]*n
+    on_stack = [False]*n
+    stack = []
+    components = []
+    counter = 0
+    for start in range(n):
+        if index[start] >= 0:
+            continue
+        work = [(start, iter(successors[start]))]
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = True
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is None:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+            elif index[child] < 0:
+                index[child] = low[child] = counter
+                counter += 1
+                stack.append(child)
+                on_stack[child] = True
+                work.append((child, iter(successors[child])))
+            elif on_stack[child]:
+                low[node] = min(low[node], index[child])
+    # Tarjan's algorithm finds the components in reverse topological order
+    components.reverse()
+    return components
+
+
+class InputOutputModel:
+    """Input-output form of a model.
+
+    :param root: the model, e.g. a Site
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        self.sectors = []
+        self._index = {}
+        # Final demand, instances (for the fixed costs) and constant costs
+        demands = []
+        self.instances = []
+        self.constant_cost = np.zeros(3)
+        links = []
+        seen_links = set()
+        stack = [(root, 1)]
+        while stack:
+            node, count = stack.pop()
+            if isinstance(node, QuantitativeValuable):
+                i = self._sector(node, demands)
+                self.instances[i] += count
+            else:
+                count *= getattr(node, 'count', 1)
+                self.constant_cost += count*_magnitudes(
+                    node.compute_own_cost(quiet=True), ureg.work_day)
+            for item in node.inputs:
+                if not isinstance(item, QuantitativeValuableInput):
+                    if isinstance(item, QuantitativeValuable):
+                        # Direct input, with its own amount
+                        demands.append((self._sector(item, demands), count,
+                                        item.amount))
+                    stack.append((item, count))
+                    continue
+                if not isinstance(item, LinearQuantitativeValuableInput):
+                    raise ValueError('Not a linear input of: ' + node.name)
+                j = self._sector(item.input_valuable, demands)
+                if (isinstance(node, QuantitativeValuable)
+                        and item.target_amount == 'amount'):
+                    if id(item) not in seen_links:
+                        seen_links.add(id(item))
+                        links.append((self._index[id(node)], j, item))
+                    if item.fixed_amount != 0:
+                        demands.append((j, count, item.fixed_amount))
+                else:
+                    demands.append((j, count, item.compute_input_amount()))
+                if not item.reference:
+                    stack.append((item.input_valuable, count))
+        self._set_units(demands, links)
+        n = len(self.sectors)
+        self.demand = np.zeros((3, n))
+        for j, count, amount in demands:
+            self.demand[:, j] += count*_magnitudes(amount, self.units[j])
+        self.rows = np.array([j for _, j, _ in links], dtype=np.int64)
+        self.columns = np.array([i for i, _, _ in links], dtype=np.int64)
+        self.values = np.zeros((3, len(links)))
+        for k, (i, j, item) in enumerate(links):
+            self.values[:, k] = _magnitudes(item.marginal_amount,
+                                            self.units[j]/self.units[i])
+        if (self.values < 0).any():
+            raise ValueError('The marginal amounts must be non-negative')
+        self.marginal_costs = np.zeros((3, n))
+        self.fixed_costs = np.zeros((3, n))
+        for i, sector in enumerate(self.sectors):
+            self.marginal_costs[:, i] = _magnitudes(
+                sector.marginal_cost, ureg.work_day/self.units[i])
+            self.fixed_costs[:, i] = _magnitudes(sector.fixed_cost, ureg.work_day)
+        self.instances = np.array(self.instances, dtype=float)
+        self._blocks = self._make_blocks()
+    
+    def _sector(self, valuable, demands):
+        if id(valuable) not in self._index:
+            if not isinstance(valuable, LinearQuantitativeValuable):
+                raise ValueError('Not a linear valuable: ' + valuable.name)
+            self._index[id(valuable)] = len(self.sectors)
+            self.sectors.append(valuable)
+            self.instances.append(0)
+        return self._index[id(valuable)]
+    
+    def _set_units(self, demands, links):
+        """Chooses the units of the amount of each sector: the base units of
+        its demand, or of the amount required by the sectors needing it.
+        """
+        self.units = [None]*len(self.sectors)
+        for j, _, amount in demands:
+            if self.units[j] is None:
+                self.units[j] = _base_units(amount)
+        changed = True
+        while changed:
+            changed = False
+            for i, j, item in links:
+                if self.units[i] is not None and self.units[j] is None:
+                    self.units[j] = _base_units(item.marginal_amount,
+                                                 self.units[i])
+                    changed = True
+        self.units = [ureg.dimensionless if units is None else units
+                      for units in self.units]
+    
+    def _make_blocks(self):
+        """Strongly connected components in topological order, with their
+        members, their internal coefficients (dense, for each bound) and
+        their outgoing coefficients.
+        """
+        n = len(self.sectors)
+        component_of = np.empty(n, dtype=np.int64)
+        components = _components(n, self.rows, self.columns)
+        for c, members in enumerate(components):
+            component_of[members] = c
+        source = component_of[self.columns]
+        internal = source == component_of[self.rows]
+        blocks = []
+        order = np.argsort(source, kind='stable')
+        starts = np.searchsorted(source[order], np.arange(len(components) + 1))
+        for c, members in enumerate(components):
+            edges = order[starts[c]:starts[c+1]]
+            inside, outside = edges[internal[edges]], edges[~internal[edges]]
+            block = None
+            if inside.size:
+                position = {m: p for p, m in enumerate(members)}
+                block = np.zeros((3, len(members), len(members)))
+                for k in inside:
+                    block[:, position[self.rows[k]], position[self.columns[k]]] \
+                        += self.values[:, k]
+            blocks.append((np.array(members), block, outside))
+        return blocks
+    
+    def index(self, valuable):
+        """Index of the sector of a valuable.
+        """
+        try:
+            return self._index[id(valuable)]
+        except KeyError:
+            raise KeyError('Not a sector of the model: ' + valuable.name)
+    
+    def solve(self, demands=None, bound='mean'):
+        """Solves the amounts of the sectors.
+
+        :param demands: final demands, in the units of the sectors (see
+            units), as an array with one row per sector and one column per
+            scenario, or a vector. By default the demand of the model.
+        :param bound: coefficients used: 'lower', 'mean' or 'upper'
+        :return: array of the amounts, of the shape of demands
+        """
+        b = BOUNDS.index(bound)
+        if demands is None:
+            demands = self.demand[b]
+        demands = np.asarray(demands, dtype=float)
+        shape = demands.shape
+        remaining = demands.reshape(len(self.sectors), -1).copy()
+        amounts = np.zeros_like(remaining)
+        for members, block, outside in self._blocks:
+            if block is None:
+                amounts[members] = remaining[members]
+            else:
+                matrix = np.eye(len(members)) - block[b]
+                try:
+                    x = np.linalg.solve(matrix, remaining[members])
+                except np.linalg.LinAlgError:
+                    x = None
+                if x is None or (x < -1e-9*np.abs(x).max()).any():
+                    raise ValueError('A cycle needs more than it produces: '
+                                     + ', '.join(self.sectors[m].name
+                                                 for m in members))
+                amounts[members] = x
+            if outside.size:
+                np.add.at(remaining, self.rows[outside],
+                          self.values[b, outside, None]*amounts[self.columns[outside]])
+        return amounts.reshape(shape)
+    
+    def compute_costs(self, amounts, bound='mean'):
+        """Costs of the sectors in work days, for amounts given like the
+        result of solve().
+        """
+        b = BOUNDS.index(bound)
+        amounts = np.asarray(amounts, dtype=float)
+        extra = (slice(None),) + (None,)*(amounts.ndim - 1)
+        return amounts*self.marginal_costs[b][extra] \
+            + (self.instances*self.fixed_costs[b])[extra]
+    
+    def compute_total_costs(self, demands=None, bound='mean'):
+        """Total costs of the model in work days, for one or several demand
+        vectors (see solve()).
+        """
+        costs = self.compute_costs(self.solve(demands, bound), bound)
+        return costs.sum(axis=0) + self.constant_cost[BOUNDS.index(bound)]
+    
+    def evaluate(self):
+        """Solves the model with its demand, sets the amounts of the sectors
+        and returns the total cost.
+        """
+        amounts = np.array([self.solve(bound=bound) for bound in BOUNDS])
+        for i, sector in enumerate(self.sectors):
+            lower, mean, upper = amounts[:, i]
+            sector.amount = BoundedQuantity(mean*self.units[i], (lower, upper))
+        lower, mean, upper = [self.compute_costs(amounts[b], bound).sum()
+                              + self.constant_cost[b]
+                              for b, bound in enumerate(BOUNDS)]
+        return BoundedQuantity(mean*ureg.work_day, (lower, upper))
@@ -0,0 +1,295 @@
+"""
+    kampach.mesh
+    ~~~~~~~~~~~~
+
+    Building shapes described by a triangulated surface, e.g. the scan of a
+    monument, loaded from OBJ or PLY (ASCII or binary) files.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg, xmlio
+from .arithmetic import BoundedQuantity
+from .geometry import BuildingShape, cached_result, null
+import numpy as np
+import math
+import os
+
+"""PLY scalar types and the corresponding NumPy types
+"""
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+class Mesh:
+    """A triangulated surface.
+
+    :param vertices: array of shape (n, 3) of the vertices coordinates
+    :param triangles: array of shape (m, 3) of the vertices indices of the
+        triangles
+    """
+    
+    def __init__(self, vertices, triangles):
+        vertices = np.asarray(vertices, dtype=float)
+        triangles = np.asarray(triangles, dtype=np.intp)
+        # Contiguous columns make the gathers and products faster
+        self.coordinates = [np.ascontiguousarray(vertices[:, i]) for i in range(3)]
+        self.indices = [np.ascontiguousarray(triangles[:, i]) for i in range(3)]
+    
+    @property
+    def vertices(self):
+        return np.column_stack(self.coordinates)
+    
+    @property
+    def triangles(self):
+        return np.column_stack(self.indices)
+    
+    def corners(self):
+        """Returns the coordinates (x, y, z) of the three corners of the
+        triangles.
+        """
+        return [[c[i] for c in self.coordinates] for i in self.indices]
+    
+    def compute_volume(self):
+        """Computes the enclosed volume, as the sum of the signed volumes of
+        the tetrahedra formed by the centroid and each triangle.
+        """
+        # Coordinates relative to the centroid limit the rounding errors
+        center = [c.mean() for c in self.coordinates]
+        a, b, c = [[x - x0 for x, x0 in zip(corner, center)]
+                   for corner in self.corners()]
+        n = _cross(b, c)
+        # np.sum uses a pairwise summation, more accurate than np.dot
+        return abs(np.sum(a[0]*n[0] + a[1]*n[1] + a[2]*n[2]))/6
+    
+    def compute_normals(self):
+        """Computes the normals (x, y, z) of the triangles, with a length
+        equal to twice their area.
+        """
+        a, b, c = self.corners()
+        return _cross([b[i] - a[i] for i in range(3)],
+                      [c[i] - a[i] for i in range(3)])
+    
+    def compute_areas(self):
+        """Computes the area of each triangle.
+        """
+        n = self.compute_normals()
+        return 0.5*np.sqrt(n[0]*n[0] + n[1]*n[1] + n[2]*n[2])
+
+
+def _cross(u, v):
+    """Cross product of vectors given as lists of coordinate arrays.
+    """
+    return [u[1]*v[2] - u[2]*v[1],
+            u[2]*v[0] - u[0]*v[2],
+            u[0]*v[1] - u[1]*v[0]]
+
+
+def load_obj(filename):
+    """Loads a mesh from a Wavefront OBJ file. Polygonal faces are split into
+    triangles.
+    """
+    vertices = []
+    triangles = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('v '):
+                vertices.append([float(x) for x in line.split()[1:4]])
+            elif line.startswith('f '):
+                face = [int(v.split('/')[0]) for v in line.split()[1:]]
+                # Negative indices are relative to the last vertex
+                face = [i-1 if i > 0 else len(vertices)+i for i in face]
+                for i in range(1, len(face)-1):
+                    triangles.append([face[0], face[i], face[i+1]])
+    return Mesh(vertices, triangles)
+
+
+def _read_ply_header(f):
+    """Reads the header of a PLY file.
+
+    :return: the format, the list of elements (name, count, properties) and
+        the size of the header in bytes. Properties are (name, type) or
+        (name, count type, item type) for lists.
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file: ' + f.name)
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('Missing end_header in PLY file: ' + f.name)
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        elif words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                prop = (words[4], PLY_TYPES[words[2]], PLY_TYPES[words[3]])
+            else:
+                prop = (words[2], PLY_TYPES[words[1]])
+            elements[-1][2].append(prop)
+    return fmt, elements, f.tell()
+
+
+def _vertices_from_records(records):
+    return np.column_stack([records['x'], records['y'], records['z']])
+
+
+def _load_binary_ply(filename, elements, offset, byte_order):
+    """Loads the vertices and triangles of a binary PLY file through
+    memory-mapped buffers.
+    """
+    vertices = triangles = None
+    for name, count, props in elements:
+        if all(len(p) == 2 for p in props):
+            dtype = np.dtype([(p[0], byte_order + p[1]) for p in props])
+            records = np.memmap(filename, dtype=dtype, mode='r',
+                                offset=offset, shape=(count,))
+            if name == 'vertex':
+                vertices = _vertices_from_records(records)
+        elif name == 'face' and len(props) == 1:
+            _, count_type, item_type = props[0]
+            # Triangle faces have a fixed size: map them directly
+            dtype = np.dtype([('n', byte_order + count_type),
+                              ('i', byte_order + item_type, 3)])
+            records = np.memmap(filename, dtype=dtype, mode='r',
+                                offset=offset, shape=(count,))
+            if not np.all(records['n'] == 3):
+                raise ValueError('Only triangular faces are supported in '
+                                 'binary PLY files: ' + filename)
+            triangles = np.array(records['i'])
+        else:
+            raise ValueError('Unsupported element in binary PLY file: ' + name)
+        offset += count*dtype.itemsize
+    return Mesh(vertices, triangles)
+
+
+def _load_ascii_ply(f, elements):
+    vertices = None
+    triangles = []
+    for name, count, props in elements:
+        lines = [f.readline().decode('ascii') for _ in range(count)]
+        if name == 'vertex':
+            names = [p[0] for p in props]
+            data = np.loadtxt(lines, ndmin=2)
+            vertices = data[:, [names.index(c) for c in 'xyz']]
+        elif name == 'face':
+            for line in lines:
+                face = [int(i) for i in line.split()[1:int(line.split()[0])+1]]
+                for i in range(1, len(face)-1):
+                    triangles.append([face[0], face[i], face[i+1]])
+    return Mesh(vertices, triangles)
+
+
+def load_ply(filename):
+    """Loads a mesh from an ASCII or binary PLY file.
+    """
+    with open(filename, 'rb') as f:
+        fmt, elements, offset = _read_ply_header(f)
+        if fmt == 'ascii':
+            return _load_ascii_ply(f, elements)
+    if fmt == 'binary_little_endian':
+        return _load_binary_ply(filename, elements, offset, '<')
+    elif fmt == 'binary_big_endian':
+        return _load_binary_ply(filename, elements, offset, '>')
+    raise ValueError('Unknown PLY format: {}'.format(fmt))
+
+
+def load_mesh(filename):
+    """Loads a mesh from an OBJ or PLY file, depending on its extension.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.obj':
+        return load_obj(filename)
+    elif ext == '.ply':
+        return load_ply(filename)
+    raise ValueError('Unsupported mesh file: ' + filename)
+
+
+class MeshShape(BuildingShape):
+    """A shape described by a closed triangulated surface. The faces whose
+    slope is lower than top_angle are the top, the faces facing downwards
+    are the bottom (not finished), and the others are the walls.
+    """
+    
+    # Affine in the finish thickness, the only bounded parameter
+    vertex_methods = ('compute_total_volume', 'compute_walls_finish_area',
+                      'compute_top_finish_area', 'compute_total_finish_area',
+                      'compute_finish_volume', 'compute_fill_volume')
+    
+    def __init__(self, finish_thickness=null, filename='', units='meter',
+                 top_angle=30*ureg.degree, up_axis='z', mesh=None):
+        super().__init__(finish_thickness)
+        self.filename = filename
+        self.units = units
+        self.top_angle = top_angle
+        self.up_axis = up_axis
+        self.mesh = mesh
+    
+    def get_mesh(self):
+        """Returns the mesh, loading it from the file the first time.
+        """
+        if self.mesh is None:
+            # Loading the mesh does not change the shape: keep cached results
+            vars(self)['mesh'] = load_mesh(self.filename)
+        return self.mesh
+    
+    @cached_result
+    def compute_face_classes(self):
+        """Returns the areas of the faces and two boolean arrays telling
+        whether each face is part of the top or of the walls.
+        """
+        normals = self.get_mesh().compute_normals()
+        lengths = np.sqrt(normals[0]*normals[0] + normals[1]*normals[1]
+                          + normals[2]*normals[2])
+        up = normals['xyz'.index(self.up_axis)]/np.where(lengths > 0, lengths, 1)
+        angle = self.top_angle.to(ureg.radian).magnitude
+        # The classification is piecewise constant in the angle: the value of
+        # a variable of kampach.gradient is used, with a zero derivative
+        cos_top = math.cos(getattr(angle, 'value', angle))
+        top = up >= cos_top
+        walls = ~top & (up > -cos_top)
+        return 0.5*lengths, top, walls
+    
+    @cached_result
+    def compute_total_volume(self):
+        volume = self.get_mesh().compute_volume()
+        return BoundedQuantity(volume*ureg.Unit(self.units)**3)
+    
+    @cached_result
+    def compute_walls_finish_area(self):
+        areas, top, walls = self.compute_face_classes()
+        return BoundedQuantity(areas[walls].sum()*ureg.Unit(self.units)**2)
+    
+    @cached_result
+    def compute_top_finish_area(self):
+        areas, top, walls = self.compute_face_classes()
+        return BoundedQuantity(areas[top].sum()*ureg.Unit(self.units)**2)
+    
+    def export_to_xml(self, parent):
+        elem = super().export_to_xml(parent)
+        elem.set('file', self.filename)
+        elem.set('units', self.units)
+        elem.set('top_angle', str(self.top_angle))
+        elem.set('up_axis', self.up_axis)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        super().add_data_from_xml_element(elem)
+        if 'file' in elem.attrib:
+            self.filename = xmlio.resolve_path(elem.get('file'))
+        if 'units' in elem.attrib:
+            self.units = elem.get('units')
+        if 'top_angle' in elem.attrib:
+            self.top_angle = ureg(elem.get('top_angle'))
+        if 'up_axis' in elem.attrib:
+            self.up_axis = elem.get('up_axis')
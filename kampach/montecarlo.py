@@ -0,0 +1,363 @@
+"""
+    kampach.montecarlo
+    ~~~~~~~~~~~~~~~~~~
+
+    Out-of-core Monte Carlo propagation of the uncertainty of the parameters
+    of a model.
+
+    Every BoundedQuantity parameter (see kampach.parameters) with distinct
+    bounds is drawn from the triangular distribution between its bounds,
+    with its mean as mode. The draws are processed in chunks: the parameters
+    are replaced by Quantity objects holding the samples of a chunk, and the
+    tree is evaluated once per chunk, so that the cost of every valuable is
+    an array of samples.
+
+    The samples of the total cost of every valuable (with the instances
+    counts of the buildings, like compute_total_cost()) are written to a
+    memory-mapped file, with one row per valuable, and streaming quantile
+    sketches give the percentiles without reading the samples again. A
+    checkpoint is saved after each chunk, so that an interrupted run resumes
+    from its last chunk. The samples of each chunk only depend on the seed
+    and the chunk number, so a resumed run gives the same results.
+
+    The bounds of the points of the piecewise-linear functions (see
+    kampach.arithmetic.PiecewiseLinear) are not parameters, so a model having
+    bounded points is refused: their uncertainty would be lost.
+
+    The run directory holds:
+
+    - nodes.json: the paths of the valuables and the settings of the run
+    - samples.npy: the samples in work days, one row per valuable
+    - checkpoint.npz: the number of done chunks and the sketches
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .parameters import iter_parameters
+from .valuable import iter_evaluation
+from collections import OrderedDict
+import contextlib
+import csv
+import json
+import os
+import numpy as np
+
+
+def is_sampled(val):
+    """Whether a parameter value is drawn: a BoundedQuantity with distinct
+    bounds.
+    """
+    return isinstance(val, BoundedQuantity) and val.lower != val.upper
+
+
+@contextlib.contextmanager
+def sampled_parameters(parameters, samples):
+    """Context replacing BoundedQuantity parameters by Quantity objects
+    holding their samples: the rows of samples for the sampled parameters,
+    in order, and the mean for the others.
+    """
+    originals = [param.value for param in parameters]
+    rows = iter(samples)
+    try:
+        for param, val in zip(parameters, originals):
+            if is_sampled(val):
+                param.value = ureg.Quantity(next(rows), val.units)
+            else:
+                param.value = val.mean
+        yield
+    finally:
+        for param, val in zip(parameters, originals):
+            param.value = val
+
+
+def check_functions(item):
+    """Raises ValueError if a piecewise-linear function of item or of its
+    inputs has bounded points, which are not sampled.
+    """
+    functions = [getattr(item, 'cost_function', None)]
+    functions += [getattr(i, 'amount_function', None) for i in item.inputs]
+    for function in functions:
+        if function is not None and function.bounded:
+            raise ValueError('The points of a table of {} have bounds, which '
+                             'cannot be sampled'.format(item.name))
+
+
+def _work_days(cost, size):
+    if isinstance(cost, BoundedQuantity):
+        cost = cost.mean
+    if isinstance(cost, ureg.Quantity):
+        cost = cost.to(ureg.work_day).magnitude
+    return np.broadcast_to(np.asarray(cost, dtype=float), (size,))
+
+
+def evaluate_own_costs(root, size):
+    """Evaluates root with parameters holding size samples.
+
+    :return: array of the own costs in work days, with one row per valuable
+        (in evaluation order) and one column per draw
+    """
+    return np.array([_work_days(cost, size)
+                     for _, cost, _, _ in iter_evaluation(root)]).reshape(-1, size)
+
+
+class QuantileSketch:
+    """Streaming quantile sketch: the values are kept in levels of weight
+    2**level, and a level exceeding k values is compacted by sorting it and
+    promoting every other value to the next level. The memory is about
+    k*log2(n/k) values for n values, and the rank error about 1/k.
+    """
+    
+    def __init__(self, k=200):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]
+        # Alternates the values promoted by the compactions, to avoid a bias
+        self.parity = 0
+    
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        self.count += values.size
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        for level in range(len(self.levels)):
+            items = self.levels[level]
+            if items.size <= self.k:
+                continue
+            items = np.sort(items)
+            # An odd value stays at its level
+            n = items.size - items.size % 2
+            promoted = items[self.parity:n:2]
+            self.parity ^= 1
+            self.levels[level] = items[n:]
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level + 1] = np.concatenate((self.levels[level + 1],
+                                                     promoted))
+    
+    def quantile(self, q):
+        """Estimates the quantiles q (scalar or array, in [0, 1]).
+        """
+        if not self.count:
+            raise ValueError('The sketch is empty')
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(items.size, 2.**level)
+                                  for level, items in enumerate(self.levels)])
+        order = np.argsort(values)
+        values = values[order]
+        ranks = np.cumsum(weights[order])
+        index = np.searchsorted(ranks, np.asarray(q)*ranks[-1])
+        return values[np.minimum(index, values.size - 1)]
+    
+    def get_state(self):
+        """Returns the values and their levels, and the count and parity.
+        """
+        values = np.concatenate(self.levels)
+        levels = np.concatenate([np.full(items.size, level, dtype=np.int8)
+                                 for level, items in enumerate(self.levels)])
+        return values, levels, self.count, self.parity
+    
+    def set_state(self, values, levels, count, parity):
+        self.levels = [values[levels == level]
+                       for level in range(max(levels.max(initial=0) + 1, 1))]
+        self.count = int(count)
+        self.parity = int(parity)
+
+
+class MonteCarlo:
+    """Monte Carlo run of a model, stored in a directory. Opening a directory
+    holding an unfinished run of the same model and settings resumes it.
+
+    :param root: the model
+    :param directory: directory of the run files, created if needed
+    :param draws: number of draws
+    :param chunk_size: number of draws evaluated at once. A chunk takes about
+        8*chunk_size bytes per valuable of the model in memory.
+    :param seed: seed of the random generator
+    :param sketch_size: parameter k of the QuantileSketch of each valuable
+    """
+    
+    def __init__(self, root, directory, draws, chunk_size=1024, seed=0,
+                 sketch_size=200):
+        self.root = root
+        self.directory = directory
+        self.draws = draws
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.parameters = [p for p in iter_parameters(root)
+                           if isinstance(p.value, BoundedQuantity)]
+        self.paths, self.parents, self.counts = self._structure()
+        os.makedirs(directory, exist_ok=True)
+        settings = {'draws': draws, 'chunk_size': chunk_size, 'seed': seed,
+                    'sketch_size': sketch_size, 'paths': self.paths}
+        manifest = self._file('nodes.json')
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                if json.load(f) != settings:
+                    raise ValueError('The directory holds another run: '
+                                     + directory)
+            mode = 'r+'
+        else:
+            with open(manifest, 'w') as f:
+                json.dump(settings, f)
+            mode = 'w+'
+        self.samples = np.lib.format.open_memmap(
+            self._file('samples.npy'), mode, float, (len(self.paths), draws))
+        self.sketches = [QuantileSketch(sketch_size) for _ in self.paths]
+        self.sums = np.zeros(len(self.paths))
+        self.done_chunks = 0
+        if os.path.exists(self._file('checkpoint.npz')):
+            self._load_checkpoint()
+    
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+    
+    def _structure(self):
+        """Paths, parents (indices) and instances counts of the valuables, in
+        evaluation order.
+        """
+        paths, parents, counts = [], [], []
+        seen = {}
+        for item, _, _, parent in iter_evaluation(self.root):
+            check_functions(item)
+            path = item.name or type(item).__name__
+            if parent >= 0:
+                path = paths[parent] + '/' + path
+            number = seen.get(path, 0)
+            seen[path] = number + 1
+            if number:
+                path = '{0}[{1}]'.format(path, number)
+            paths.append(path)
+            parents.append(parent)
+            counts.append(getattr(item, 'count', 1))
+        return paths, parents, counts
+    
+    @property
+    def chunks(self):
+        return -(-self.draws // self.chunk_size)
+    
+    @property
+    def finished(self):
+        return self.done_chunks == self.chunks
+    
+    def chunk_draws(self, chunk):
+        """Number of draws of a chunk (the last one may be smaller).
+        """
+        return min(self.chunk_size, self.draws - chunk*self.chunk_size)
+    
+    def sample_chunk(self, chunk, out=None):
+        """Draws the samples of the sampled parameters (see is_sampled())
+        for a chunk, from a generator seeded by the seed and the chunk number.
+
+        :param out: array receiving the samples, or None
+        :return: array with one row per sampled parameter and one column per
+            draw
+        """
+        size = self.chunk_draws(chunk)
+        sampled = [param.value for param in self.parameters
+                   if is_sampled(param.value)]
+        if out is None:
+            out = np.empty((len(sampled), size))
+        rng = np.random.default_rng([self.seed, chunk])
+        for row, val in zip(out, sampled):
+            row[:] = rng.triangular(val.lower, val.mean.magnitude, val.upper, size)
+        return out
+    
+    def reduce_costs(self, costs):
+        """Turns the own costs of the valuables into their total costs, in
+        place.
+        """
+        if len(costs) != len(self.paths):
+            raise ValueError('The structure of the model changed')
+        # Children come after their parent in evaluation order
+        for i in reversed(range(len(costs))):
+            if self.counts[i] != 1:
+                costs[i] *= self.counts[i]
+            if self.parents[i] >= 0:
+                costs[self.parents[i]] += costs[i]
+        return costs
+    
+    def evaluate_chunk(self, chunk):
+        """Evaluates the draws of a chunk.
+
+        :return: array of the total costs in work days, with one row per
+            valuable and one column per draw
+        """
+        samples = self.sample_chunk(chunk)
+        with sampled_parameters(self.parameters, samples):
+            costs = evaluate_own_costs(self.root, self.chunk_draws(chunk))
+        return self.reduce_costs(costs)
+    
+    def run(self, max_chunks=None):
+        """Evaluates the remaining chunks, or at most max_chunks of them,
+        saving a checkpoint after each one.
+
+        :return: whether the run is finished
+        """
+        stop = self.chunks if max_chunks is None else \
+            min(self.chunks, self.done_chunks + max_chunks)
+        for chunk in range(self.done_chunks, stop):
+            costs = self.evaluate_chunk(chunk)
+            start = chunk*self.chunk_size
+            self.samples[:, start:start + costs.shape[1]] = costs
+            for sketch, row in zip(self.sketches, costs):
+                sketch.update(row)
+            self.sums += costs.sum(axis=1)
+            self.samples.flush()
+            self.done_chunks = chunk + 1
+            self._save_checkpoint()
+        return self.finished
+    
+    def _save_checkpoint(self):
+        states = [sketch.get_state() for sketch in self.sketches]
+        filename = self._file('checkpoint.npz')
+        # Written aside and renamed, so that an interruption leaves the
+        # previous checkpoint
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, done_chunks=self.done_chunks, sums=self.sums,
+                     values=np.concatenate([s[0] for s in states]),
+                     levels=np.concatenate([s[1] for s in states]),
+                     sizes=[len(s[0]) for s in states],
+                     counts=[s[2] for s in states],
+                     parities=[s[3] for s in states])
+        os.replace(filename + '.tmp', filename)
+    
+    def _load_checkpoint(self):
+        with np.load(self._file('checkpoint.npz')) as data:
+            self.done_chunks = int(data['done_chunks'])
+            self.sums = data['sums']
+            bounds = np.cumsum(np.concatenate(([0], data['sizes'])))
+            values, levels = data['values'], data['levels']
+            for i, sketch in enumerate(self.sketches):
+                part = slice(bounds[i], bounds[i+1])
+                sketch.set_state(values[part], levels[part], data['counts'][i],
+                                 data['parities'][i])
+    
+    def node_samples(self, path):
+        """Samples of the total cost of the valuable with the given path, in
+        work days (a view of the memory-mapped file).
+        """
+        try:
+            index = self.paths.index(path)
+        except ValueError:
+            raise KeyError('Unknown valuable: ' + path)
+        return self.samples[index, :self.done_chunks*self.chunk_size]
+    
+    def quantiles(self, q=(0.05, 0.5, 0.95)):
+        """Estimates quantiles of the total costs of the valuables from the
+        sketches.
+
+        :return: ordered dict mapping paths to quantiles in work days
+        """
+        return OrderedDict((path, sketch.quantile(q)*ureg.work_day)
+                           for path, sketch in zip(self.paths, self.sketches))
+    
+    def write_csv(self, f, q=(0.05, 0.5, 0.95)):
+        """Writes the mean and quantiles of the total cost of each valuable.
+        """
+        writer = csv.writer(f)
+        writer.writerow(['Path', 'Mean'] + ['P{:g}'.format(100*p) for p in q])
+        count = self.sketches[0].count if self.sketches else 0
+        for path, sketch, total in zip(self.paths, self.sketches, self.sums):
+            writer.writerow([path, total/count] + list(sketch.quantile(q)))
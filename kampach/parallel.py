@@ -0,0 +1,170 @@
+"""
+    kampach.parallel
+    ~~~~~~~~~~~~~~~~
+
+    Multi-process Monte Carlo runs (see kampach.montecarlo).
+
+    The draws of each chunk are split into column blocks evaluated by a pool
+    of worker processes. The arrays are not pickled: the parent process
+    draws the samples of the parameters into a shared memory block, the
+    workers read their columns from it and write the own costs of the
+    valuables into a second shared block, where the parent sums them into
+    total costs in place.
+
+    Each worker receives the model once, pickled with its quantities in the
+    unit registry of kampach, so that it evaluates exactly the same values
+    (an XML export rounds them). The samples only depend on the seed and the
+    chunk number, and the evaluation is element-wise on the draws, so the
+    results don't depend on the number of workers.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .montecarlo import MonteCarlo, evaluate_own_costs, is_sampled,\
+    sampled_parameters
+from .parameters import iter_parameters
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import contextlib
+import io
+import os
+import pickle
+import numpy as np
+
+
+class SharedArray:
+    """A float array in a shared memory block, created or attached by name.
+    """
+    
+    def __init__(self, shape, name=None):
+        size = max(int(np.prod(shape))*8, 1)
+        self.shape = tuple(shape)
+        self.block = shared_memory.SharedMemory(name, create=name is None,
+                                                size=size)
+        self.array = np.ndarray(self.shape, float, buffer=self.block.buf)
+    
+    @property
+    def spec(self):
+        """Arguments attaching the array in another process.
+        """
+        return self.shape, self.block.name
+    
+    def close(self, unlink=False):
+        # The views of the buffer must be released first
+        self.array = None
+        self.block.close()
+        if unlink:
+            self.block.unlink()
+
+
+def _load_quantity(magnitude, units):
+    return ureg.Quantity(magnitude, units)
+
+
+def _load_units(units):
+    return ureg.Unit(units)
+
+
+class _ModelPickler(pickle.Pickler):
+    """Pickler of a model. Pint unpickles the quantities in its application
+    registry, so they are rebuilt in the registry of kampach instead.
+    """
+    
+    def reducer_override(self, obj):
+        if isinstance(obj, ureg.Quantity):
+            return _load_quantity, (obj.magnitude, str(obj.units))
+        if isinstance(obj, ureg.Unit):
+            return _load_units, (str(obj),)
+        return NotImplemented
+
+
+def dump_model(root):
+    """Pickles a model, with its exact values, to be loaded by pickle.loads()
+    in another process.
+    """
+    f = io.BytesIO()
+    _ModelPickler(f, pickle.HIGHEST_PROTOCOL).dump(root)
+    return f.getvalue()
+
+
+"""State of a worker process, set by _init_worker().
+"""
+_worker = {}
+
+
+def _init_worker(model, paths, samples_spec, costs_spec):
+    root = pickle.loads(model)
+    params = {param.path: param for param in iter_parameters(root)}
+    _worker['parameters'] = [params[path] for path in paths]
+    _worker['root'] = root
+    _worker['samples'] = SharedArray(*samples_spec)
+    _worker['costs'] = SharedArray(*costs_spec)
+
+
+def _evaluate_columns(start, stop):
+    """Evaluates the draws of the columns start:stop of the shared samples.
+    """
+    samples = _worker['samples'].array[:, start:stop]
+    with sampled_parameters(_worker['parameters'], samples):
+        costs = evaluate_own_costs(_worker['root'], stop - start)
+    shared = _worker['costs'].array
+    if len(costs) != len(shared):
+        raise ValueError('The structure of the model changed')
+    shared[:, start:stop] = costs
+
+
+class ParallelMonteCarlo(MonteCarlo):
+    """Monte Carlo run evaluating each chunk in worker processes. The run
+    directory is the same as a MonteCarlo one, and a run can be resumed with
+    either class and any number of workers.
+
+    :param max_workers: number of processes, by default the number of
+        processors
+    """
+    
+    def __init__(self, root, directory, draws, chunk_size=1024, seed=0,
+                 sketch_size=200, max_workers=None):
+        super().__init__(root, directory, draws, chunk_size, seed, sketch_size)
+        self.max_workers = max_workers or os.cpu_count()
+        self._pool = None
+    
+    @contextlib.contextmanager
+    def pool(self):
+        """Context of the shared arrays and worker processes of a run.
+        """
+        sampled = sum(is_sampled(param.value) for param in self.parameters)
+        samples = SharedArray((sampled, self.chunk_size))
+        costs = SharedArray((len(self.paths), self.chunk_size))
+        try:
+            with ProcessPoolExecutor(
+                    self.max_workers, initializer=_init_worker,
+                    initargs=(dump_model(self.root),
+                              [param.path for param in self.parameters],
+                              samples.spec, costs.spec)) as executor:
+                self._pool = executor, samples, costs
+                yield
+        finally:
+            self._pool = None
+            samples.close(unlink=True)
+            costs.close(unlink=True)
+    
+    def run(self, max_chunks=None):
+        with self.pool():
+            return super().run(max_chunks)
+    
+    def evaluate_chunk(self, chunk):
+        """Overriden from MonteCarlo. The returned array is a view of the
+        shared memory, valid until the next chunk.
+        """
+        if self._pool is None:
+            with self.pool():
+                return self.evaluate_chunk(chunk).copy()
+        executor, samples, costs = self._pool
+        size = self.chunk_draws(chunk)
+        self.sample_chunk(chunk, samples.array[:, :size])
+        bounds = np.linspace(0, size, min(self.max_workers, size) + 1).astype(int)
+        # Raises the errors of the workers
+        list(executor.map(_evaluate_columns, bounds[:-1], bounds[1:]))
+        return self.reduce_costs(costs.array[:, :size])
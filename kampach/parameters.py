@@ -0,0 +1,122 @@
+"""
+    kampach.parameters
+    ~~~~~~~~~~~~~~~~~~
+
+    Enumeration of the numeric parameters of a model: shape dimensions,
+    marginal amounts and costs, transport parameters...
+
+    A parameter is identified by a path made of the names of the valuables
+    from the root, and the name of the attribute, e.g.
+    'My site/My building/Shape.height' or 'My site/My building/Earth
+    packing.marginal_cost'. The attributes of an input are attached to its
+    input valuable. The parts of a valuable (shape, substructures, carriers
+    and legs of a fleet transport) have their own segment, e.g.
+    'My site/Stones/Legs[0].distance'.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from numbers import Number
+
+"""Attributes holding the state of an evaluation rather than a parameter.
+"""
+EXCLUDED_ATTRIBUTES = ('_amount', '_count', 'tight_bounds')
+
+"""Attributes of the valuables holding lists of parts with parameters.
+"""
+PART_LISTS = (('substructures', 'Substructures'), ('carriers', 'Carriers'),
+              ('legs', 'Legs'))
+
+
+class Parameter:
+    """A numeric attribute of an object of the model.
+    """
+    
+    def __init__(self, path, owner, attribute):
+        self.path = path
+        self.owner = owner
+        self.attribute = attribute
+    
+    def __repr__(self):
+        return "<Parameter: {}>".format(self.path)
+    
+    @property
+    def value(self):
+        """Current value of the parameter.
+        """
+        return vars(self.owner)[self.attribute]
+    
+    @value.setter
+    def value(self, val):
+        # setattr keeps the cached results of shapes consistent
+        setattr(self.owner, self.attribute, val)
+
+
+def is_parameter_value(val):
+    return (isinstance(val, (BoundedQuantity, ureg.Quantity, Number))
+            and not isinstance(val, bool))
+
+
+def _own_parameters(path, obj):
+    for attribute, val in list(vars(obj).items()):
+        if attribute not in EXCLUDED_ATTRIBUTES and is_parameter_value(val):
+            yield Parameter('{0}.{1}'.format(path, attribute.lstrip('_')),
+                            obj, attribute)
+
+
+def _segments(objects):
+    """Path segments of sibling valuables: their name, or their class name,
+    with an index when several siblings have the same one.
+    """
+    names = [obj.name or type(obj).__name__ for obj in objects]
+    segments = []
+    for i, name in enumerate(names):
+        if names.count(name) > 1:
+            name = '{0}[{1}]'.format(name, names[:i].count(name))
+        segments.append(name)
+    return segments
+
+
+def iter_parameters(root):
+    """Yields the Parameter objects of root and of all the objects below it,
+    in a deterministic order. Shared objects are visited once.
+    """
+    visited = set()
+    stack = [(root.name or type(root).__name__, root, None)]
+    while stack:
+        path, valuable, linear_input = stack.pop()
+        if linear_input is not None:
+            yield from _own_parameters(path, linear_input)
+        if id(valuable) in visited:
+            continue
+        visited.add(id(valuable))
+        yield from _own_parameters(path, valuable)
+        parts = [('/Shape', getattr(valuable, 'shape', None))]
+        for attribute, segment in PART_LISTS:
+            for i, part in enumerate(getattr(valuable, attribute, [])):
+                parts.append(('/{0}[{1}]'.format(segment, i), part))
+        for suffix, part in parts:
+            if part is not None and id(part) not in visited:
+                visited.add(id(part))
+                yield from _own_parameters(path + suffix, part)
+        children = []
+        for i in valuable.inputs:
+            if hasattr(i, 'input_valuable'):
+                children.append((i.input_valuable, i))
+            else:
+                children.append((i, None))
+        segments = _segments([child for child, _ in children])
+        for segment, (child, i) in reversed(list(zip(segments, children))):
+            stack.append((path + '/' + segment, child, i))
+
+
+def find_parameter(root, path):
+    """Returns the Parameter of root with the given path.
+    """
+    for param in iter_parameters(root):
+        if param.path == path:
+            return param
+    raise KeyError('Unknown parameter: ' + path)
@@ -0,0 +1,186 @@
+"""
+    kampach.query
+    ~~~~~~~~~~~~~
+
+    Queries of some valuables of a model, without evaluating the whole tree.
+
+    The valuables are selected by a pattern on their path, made of the names
+    of the valuables from the root like the paths of the parameters (see
+    kampach.parameters), e.g. 'My site/My building/Plaster laying'. The
+    segments of a pattern are shell-style wildcards ('*', '?', '[...]'), and
+    the segment '**' matches any number of segments. A pattern without '/'
+    is a name pattern, matching the valuables with that name at any depth:
+
+        >>> total(site, 'Plaster laying')
+        >>> next(select(site, 'My site/House')).get('fill_volume')
+
+    The walk of the tree only reads the names, and skips the subtrees that
+    cannot match. The results are lazy: the amount of a selected valuable is
+    computed when it is first needed, by evaluating the inputs from the root
+    down to it only (the ancestors supplying its amount), without printing.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from .parameters import _segments
+from .valuable import QuantitativeValuableInput, iter_evaluation
+import fnmatch
+
+
+def parse_pattern(pattern):
+    """Splits a pattern into segments, a name pattern matching at any depth.
+    """
+    if '/' not in pattern:
+        return ('**', pattern)
+    return tuple(pattern.strip('/').split('/'))
+
+
+def _advance(pattern, states, segment):
+    """States (positions in the pattern) reached by matching a segment from
+    states.
+    """
+    reached = set()
+    for i in _closure(pattern, states):
+        if i == len(pattern):
+            continue
+        if pattern[i] == '**':
+            reached.add(i)
+        elif fnmatch.fnmatchcase(segment, pattern[i]):
+            reached.add(i + 1)
+    return reached
+
+
+def _closure(pattern, states):
+    """Adds the states reached by matching '**' with no segment.
+    """
+    closure = set(states)
+    stack = list(states)
+    while stack:
+        i = stack.pop()
+        if i < len(pattern) and pattern[i] == '**' and i + 1 not in closure:
+            closure.add(i + 1)
+            stack.append(i + 1)
+    return closure
+
+
+class QueryResult:
+    """A selected valuable, evaluated lazily.
+
+    :param path: path of the valuable
+    :param chain: (input, valuable) pairs from the root down to the valuable,
+        with input None for the valuables that are direct inputs
+    :param count: number of instances of the valuable (product of the counts
+        of the buildings containing it)
+    """
+    
+    def __init__(self, path, chain, count):
+        self.path = path
+        self.chain = chain
+        self.count = count
+        self._results = {}
+    
+    def __repr__(self):
+        return "<QueryResult: {}>".format(self.path)
+    
+    @property
+    def valuable(self):
+        return self.chain[-1][1]
+    
+    def _evaluate_chain(self):
+        """Sets the amounts of the valuables from the root down to the
+        selected one (the valuables may be shared by other paths).
+        """
+        for item, val in self.chain:
+            if isinstance(item, QuantitativeValuableInput):
+                val.amount = item.compute_input_amount()
+    
+    def _cached(self, key, compute):
+        if key not in self._results:
+            self._evaluate_chain()
+            self._results[key] = compute()
+        return self._results[key]
+    
+    @property
+    def amount(self):
+        """Amount of one instance of the valuable, or None.
+        """
+        return self._cached('amount', lambda: getattr(self.valuable, 'amount', None))
+    
+    @property
+    def cost(self):
+        """Own cost of the valuable, for all its instances.
+        """
+        return self._cached('cost', lambda: self.valuable.compute_own_cost(quiet=True)
+                            *self.count)
+    
+    @property
+    def total_cost(self):
+        """Cost of the valuable and its inputs, for all its instances.
+        """
+        def compute():
+            cost = 0
+            for _, own_cost, count, _ in iter_evaluation(self.valuable, self.count):
+                cost = cost + own_cost*count
+            return cost
+        return self._cached('total_cost', compute)
+    
+    def get(self, attribute):
+        """Value of an attribute of one instance of the valuable, e.g.
+        'fill_volume' for a building.
+        """
+        return self._cached('.' + attribute,
+                            lambda: getattr(self.valuable, attribute))
+
+
+def select(root, pattern):
+    """Yields a QueryResult for each valuable of root whose path matches
+    pattern, in evaluation order. Nothing is evaluated. The inputs referring
+    to a valuable defined elsewhere (see
+    LinearQuantitativeValuableInput.reference) are not followed.
+    """
+    pattern = parse_pattern(pattern)
+    root_path = root.name or type(root).__name__
+    # (path, link, count, states), with the chains stored as linked tuples
+    # (parent link, input, valuable) until a valuable is selected
+    stack = [(root_path, (None, None, root), getattr(root, 'count', 1),
+              _advance(pattern, {0}, root_path))]
+    while stack:
+        path, link, count, states = stack.pop()
+        if not states:
+            continue
+        if len(pattern) in _closure(pattern, states):
+            chain = []
+            node = link
+            while node is not None:
+                chain.append(node[1:])
+                node = node[0]
+            yield QueryResult(path, chain[::-1], count)
+        children = [(i, getattr(i, 'input_valuable', i)) for i in link[2].inputs]
+        segments = _segments([child for _, child in children])
+        for segment, (item, child) in reversed(list(zip(segments, children))):
+            if getattr(item, 'reference', False):
+                # Selected where it is defined: references may form cycles
+                continue
+            stack.append((path + '/' + segment, (link, item, child),
+                          count*getattr(child, 'count', 1),
+                          _advance(pattern, states, segment)))
+
+
+def total(root, pattern, value='cost'):
+    """Sums a value of the valuables of root matching pattern.
+
+    :param value: 'cost', 'total_cost' or 'amount' (of all the instances), or
+        the name of an attribute (of all the instances), e.g. 'fill_volume'
+    :return: the sum, or 0 if no valuable matches
+    """
+    result = 0
+    for selected in select(root, pattern):
+        if value in ('cost', 'total_cost'):
+            val = getattr(selected, value)
+        elif value == 'amount':
+            val = selected.amount*selected.count
+        else:
+            val = selected.get(value)*selected.count
+        result = result + val
+    return result
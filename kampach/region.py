@@ -0,0 +1,212 @@
+"""
+    kampach.region
+    ~~~~~~~~~~~~~~
+
+    Evaluation of many sites drawing on the same resources (quarries, labour
+    pools...).
+
+    A region file lists site files and the shared resources:
+
+        <Region name="Valley">
+            <Resource name="North quarry" capacity="5000 meter ** 3"/>
+            <Site file="site_a.xml"/>
+            <Site file="site_b.xml"/>
+        </Region>
+
+    The valuables of the sites refer to a resource by their resource
+    attribute. The sites are evaluated in worker processes (map), and the
+    costs and the amounts drawn on each resource are summed into a regional
+    report (reduce).
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import xmlio
+from .arithmetic import BoundedQuantity, parse_quantity, dump_quantity,\
+    load_quantity
+from .valuable import iter_evaluation
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import xml.etree.ElementTree as ET
+import os
+
+
+class Resource:
+    """A resource shared by the sites of a region.
+
+    :param capacity: maximum amount that can be drawn on the resource, or
+        None
+    """
+    
+    def __init__(self, name='', capacity=None):
+        self.name = name
+        self.capacity = capacity
+    
+    def __repr__(self):
+        return "<Resource: {}>".format(self.name)
+
+
+class ResourceUsage:
+    """Amount and cost drawn on a resource by the sites of a region.
+    """
+    
+    def __init__(self, resource):
+        self.resource = resource
+        self.amount = 0
+        self.cost = 0
+        self.sites = []
+    
+    def is_over_capacity(self):
+        """Tells if the amount may exceed the capacity of the resource.
+        """
+        capacity = self.resource.capacity
+        if capacity is None:
+            return False
+        amount = self.amount
+        if isinstance(amount, BoundedQuantity):
+            amount = amount.upper*amount.units
+        if isinstance(capacity, BoundedQuantity):
+            capacity = capacity.mean
+        return amount > capacity
+
+
+def evaluate_site(site):
+    """Evaluates a site without printing.
+
+    :return: the total cost and an ordered dict mapping resource names to
+        (amount, cost)
+    """
+    total = 0
+    resources = OrderedDict()
+    for item, cost, count, _ in iter_evaluation(site):
+        if count != 1:
+            cost = cost*count
+        total = total + cost
+        resource = getattr(item, 'resource', '')
+        if resource:
+            amount, resource_cost = resources.get(resource, (0, 0))
+            item_amount = item.amount if count == 1 else item.amount*count
+            resources[resource] = (amount + item_amount, resource_cost + cost)
+    return total, resources
+
+
+def _evaluate_site_file(filename):
+    """Worker of Region.evaluate().
+    """
+    total, resources = evaluate_site(xmlio.load_xml_file(filename))
+    return filename, dump_quantity(total), [
+        (name, dump_quantity(amount), dump_quantity(cost))
+        for name, (amount, cost) in resources.items()]
+
+
+class RegionReport:
+    """Result of the evaluation of a region.
+    """
+    
+    def __init__(self, region):
+        self.region = region
+        self.total_cost = 0
+        self.site_costs = OrderedDict()
+        self.resources = OrderedDict((name, ResourceUsage(resource))
+                                     for name, resource in region.resources.items())
+    
+    def add_site(self, filename, cost, resources):
+        self.site_costs[filename] = cost
+        self.total_cost = self.total_cost + cost
+        for name, (amount, resource_cost) in resources.items():
+            if name not in self.resources:
+                self.resources[name] = ResourceUsage(Resource(name))
+            usage = self.resources[name]
+            usage.amount = usage.amount + amount
+            usage.cost = usage.cost + resource_cost
+            usage.sites.append(filename)
+    
+    def print_report(self):
+        title = self.region.name or 'Region'
+        print(title)
+        print('='*len(title))
+        for filename, cost in self.site_costs.items():
+            print('{0}: {1}'.format(os.path.basename(filename), cost))
+        print('Total cost: {}'.format(self.total_cost))
+        for name, usage in self.resources.items():
+            print()
+            print(name)
+            print('-'*len(name))
+            print('Amount: {}'.format(usage.amount))
+            if usage.resource.capacity is not None:
+                print('Capacity: {}'.format(usage.resource.capacity))
+                if usage.is_over_capacity():
+                    print('Over capacity!')
+            print('Cost: {}'.format(usage.cost))
+            print('Sites: {}'.format(len(usage.sites)))
+
+
+class Region:
+    """A set of site files sharing resources.
+    """
+    
+    def __init__(self, name='', sites=None, resources=None):
+        self.name = name
+        self.sites = sites if sites is not None else []
+        self.resources = resources if resources is not None else OrderedDict()
+    
+    def __repr__(self):
+        return "<Region: {}>".format(self.name)
+    
+    def evaluate(self, max_workers=None, chunksize=1):
+        """Evaluates the sites in worker processes and sums their results.
+
+        :param max_workers: number of processes (by default the number of
+            processors), 1 to evaluate the sites in this process
+        :return: a RegionReport
+        """
+        if max_workers == 1:
+            results = map(_evaluate_site_file, self.sites)
+            return self._reduce(results)
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = executor.map(_evaluate_site_file, self.sites,
+                                   chunksize=chunksize)
+            return self._reduce(results)
+    
+    def _reduce(self, results):
+        report = RegionReport(self)
+        for filename, total, resources in results:
+            resources = OrderedDict(
+                (name, (load_quantity(amount), load_quantity(cost)))
+                for name, amount, cost in resources)
+            report.add_site(filename, load_quantity(total), resources)
+        return report
+    
+    def export_to_xml(self, parent=None):
+        if parent is None:
+            elem = ET.Element('Region', {'name': self.name})
+        else:
+            elem = ET.SubElement(parent, 'Region', {'name': self.name})
+        for name, resource in self.resources.items():
+            sub = ET.SubElement(elem, 'Resource', {'name': name})
+            if resource.capacity is not None:
+                sub.set('capacity', str(resource.capacity))
+        for filename in self.sites:
+            ET.SubElement(elem, 'Site', {'file': filename})
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        if 'name' in elem.attrib:
+            self.name = elem.get('name')
+        for sub in elem.findall('Resource'):
+            resource = Resource(sub.get('name'))
+            if 'capacity' in sub.attrib:
+                resource.capacity = parse_quantity(sub.get('capacity'))
+            self.resources[resource.name] = resource
+        for sub in elem.findall('Site'):
+            self.sites.append(xmlio.resolve_path(sub.get('file')))
+
+
+def load_region(filename):
+    """Loads a Region from an XML file. The site files are relative to it.
+    """
+    region = Region()
+    with xmlio.directory(os.path.dirname(os.path.abspath(filename))):
+        region.add_data_from_xml_element(ET.parse(filename).getroot())
+    return region
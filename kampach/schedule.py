@@ -0,0 +1,225 @@
+"""
+    kampach.schedule
+    ~~~~~~~~~~~~~~~~
+
+    Workforce scheduling of the construction of a site.
+
+    Every valuable of the evaluated tree gives a task, whose work is its own
+    cost. A valuable can only be done once all its inputs are done, e.g. the
+    earth must be transported before being packed, and a building is
+    finished when all its activities are. Instances of a building (see
+    Building.count) give separate tasks that can be done in parallel.
+
+    The work is done by teams of workers. A task is done by a single team, in
+    a time equal to its work divided by the team size. Durations are in
+    working days (work_day).
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .valuable import iter_evaluation
+import heapq
+
+
+class Task:
+    """A unit of work of the schedule.
+
+    :param name: path of the valuable in the tree, e.g. 'Site/House/Filling'
+    :param work: work of the task, in work days (float)
+    :param predecessors: tasks that must be finished before this one
+    """
+    
+    def __init__(self, name, work=0., predecessors=None):
+        self.name = name
+        self.work = work
+        self.predecessors = predecessors if predecessors is not None else []
+        self.start = None
+        self.finish = None
+    
+    def __repr__(self):
+        return "<Task: {}>".format(self.name)
+
+
+def _work(cost, bound):
+    """Work of a cost, as a float number of work days.
+    """
+    if isinstance(cost, BoundedQuantity):
+        units = cost.units
+        if bound == 'mean':
+            cost = cost.mean
+        else:
+            cost = getattr(cost, bound)*units
+    if isinstance(cost, ureg.Quantity):
+        return float(cost.to(ureg.work_day).magnitude)
+    return float(cost)
+
+
+def _copy_tasks(block, prefix, new_prefix):
+    """Copies a block of tasks, with the links inside the block, replacing
+    the prefix of their names.
+    """
+    copies = {}
+    for task in block:
+        copies[id(task)] = Task(new_prefix + task.name[len(prefix):], task.work)
+    for task in block:
+        copies[id(task)].predecessors = [copies.get(id(p), p)
+                                         for p in task.predecessors]
+    return [copies[id(task)] for task in block]
+
+
+def _add_instances(tasks, task, start, count, parent):
+    """Adds the tasks of the instances 2 to count of a building, copied from
+    the block tasks[start:] of the first one.
+    """
+    block = tasks[start:]
+    prefix = task.name
+    for i in range(2, count+1):
+        copies = _copy_tasks(block, prefix, prefix + ' #{}'.format(i))
+        if parent is not None:
+            parent.predecessors.append(copies[0])
+        tasks.extend(copies)
+    for t in block:
+        t.name = prefix + ' #1' + t.name[len(prefix):]
+
+
+def build_tasks(root, bound='mean'):
+    """Evaluates root and returns its tasks, in a topological order
+    (predecessors first).
+
+    :param bound: which value of the bounded costs gives the work: 'mean',
+        'lower' or 'upper'
+    """
+    # Tasks are created in pre-order (a task before its inputs), so the
+    # reversed list is a topological order
+    tasks = []
+    # Task of each valuable, in evaluation order
+    created = []
+    # Valuables having several instances whose block of tasks is not
+    # complete: (index, task, start of the block, count, parent task). The
+    # block is complete at the first valuable that is not a descendant,
+    # whose parent comes before it.
+    blocks = []
+    for item, cost, _, parent_index in iter_evaluation(root):
+        while blocks and blocks[-1][0] > parent_index:
+            _add_instances(tasks, *blocks.pop()[1:])
+        parent = created[parent_index] if parent_index >= 0 else None
+        name = item.name or type(item).__name__
+        if parent is not None:
+            name = parent.name + '/' + name
+        task = Task(name, _work(cost, bound))
+        if parent is not None:
+            parent.predecessors.append(task)
+        count = getattr(item, 'count', 1)
+        if count != 1:
+            blocks.append((len(created), task, len(tasks), count, parent))
+        created.append(task)
+        tasks.append(task)
+    while blocks:
+        _add_instances(tasks, *blocks.pop()[1:])
+    tasks.reverse()
+    return tasks
+
+
+def _successors(tasks):
+    index = {id(task): i for i, task in enumerate(tasks)}
+    successors = [[] for _ in tasks]
+    for i, task in enumerate(tasks):
+        for p in task.predecessors:
+            successors[index[id(p)]].append(i)
+    return successors
+
+
+def _bottom_levels(tasks, durations, successors):
+    """Length of the longest path from the start of each task to the end of
+    the project.
+    """
+    levels = [0.]*len(tasks)
+    for i in reversed(range(len(tasks))):
+        levels[i] = durations[i] + max((levels[s] for s in successors[i]),
+                                       default=0.)
+    return levels
+
+
+def critical_path(tasks, team_size=1):
+    """Computes the critical path of the tasks, i.e. the duration of the
+    project with an unlimited workforce.
+
+    :return: the duration and the list of tasks of the critical path
+    """
+    durations = [task.work/team_size for task in tasks]
+    successors = _successors(tasks)
+    levels = _bottom_levels(tasks, durations, successors)
+    if not tasks:
+        return 0*ureg.work_day, []
+    has_predecessors = {s for succ in successors for s in succ}
+    current = max((i for i in range(len(tasks)) if i not in has_predecessors),
+                  key=lambda i: levels[i])
+    length = levels[current]
+    path = [tasks[current]]
+    while successors[current]:
+        current = max(successors[current], key=lambda i: levels[i])
+        path.append(tasks[current])
+    return length*ureg.work_day, path
+
+
+def _list_schedule(tasks, durations, successors, levels, teams):
+    remaining = [len(task.predecessors) for task in tasks]
+    ready = [(-levels[i], i) for i in range(len(tasks)) if not remaining[i]]
+    heapq.heapify(ready)
+    running = []
+    time = 0.
+    done = 0
+    while done < len(tasks):
+        while ready and teams:
+            _, i = heapq.heappop(ready)
+            tasks[i].start = time
+            tasks[i].finish = time + durations[i]
+            # Tasks without work (e.g. buildings) don't need a team
+            uses_team = durations[i] > 0
+            teams -= uses_team
+            heapq.heappush(running, (tasks[i].finish, i, uses_team))
+        time, i, uses_team = heapq.heappop(running)
+        teams += uses_team
+        done += 1
+        for s in successors[i]:
+            remaining[s] -= 1
+            if not remaining[s]:
+                heapq.heappush(ready, (-levels[s], s))
+    return max((task.finish for task in tasks), default=0.)*ureg.work_day
+
+
+def _teams(workforce, team_size):
+    teams = workforce // team_size
+    if teams < 1:
+        raise ValueError('The workforce is smaller than a team: {0} < {1}'
+                         .format(workforce, team_size))
+    return teams
+
+
+def schedule(tasks, workforce, team_size=1):
+    """Schedules the tasks with a limited workforce, by list scheduling: when
+    a team is free, it starts the ready task with the longest remaining
+    critical path. Sets the start and finish of the tasks.
+
+    :param workforce: number of workers
+    :param team_size: number of workers of a team
+    :return: the duration of the project
+    """
+    return sweep_workforce(tasks, [workforce], team_size)[0][1]
+
+
+def sweep_workforce(tasks, workforces, team_size=1):
+    """Schedules the tasks for several workforces. The start and finish of
+    the tasks are those of the last schedule.
+
+    :return: list of (workforce, duration)
+    """
+    durations = [task.work/team_size for task in tasks]
+    successors = _successors(tasks)
+    levels = _bottom_levels(tasks, durations, successors)
+    return [(workforce, _list_schedule(tasks, durations, successors, levels,
+                                       _teams(workforce, team_size)))
+            for workforce in workforces]
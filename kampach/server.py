@@ -0,0 +1,298 @@
+"""
+    kampach.server
+    ~~~~~~~~~~~~~~
+
+    Local evaluation service, keeping the unit registry and the parsed models
+    in memory between requests. It is started with:
+
+        python -m kampach.server --port 8765
+
+    and answers JSON requests on localhost:
+
+    - POST /models with an XML model as body: parses and caches the model,
+      returns its id and its cost.
+    - POST /evaluate with {"model": id, "overrides": {path: value}}: returns
+      the cost of a cached model with some parameters changed (see
+      kampach.parameters for the paths; the values are parsed like XML
+      attributes, e.g. "5 meter, [4 ; 6]", or are numbers in the units of
+      the parameter). The model is left unchanged.
+    - GET /models/<id>/parameters: returns the parameters of a model.
+    - GET /metrics: returns the requests and cache statistics.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg, xmlio
+from .arithmetic import BoundedQuantity, parse_quantity
+from .parameters import iter_parameters
+from .region import evaluate_site
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numbers import Number
+from pint.errors import PintError
+import xml.etree.ElementTree as ET
+import argparse
+import hashlib
+import json
+import threading
+import time
+
+
+class CachedModel:
+    """A parsed model and its cost, with a lock serializing its evaluations
+    (they set the amounts of the valuables).
+    """
+    
+    def __init__(self, model_id, root, size):
+        self.id = model_id
+        self.root = root
+        self.size = size
+        self.lock = threading.Lock()
+        self.parameters = OrderedDict((p.path, p) for p in iter_parameters(root))
+        self.cost = None
+
+
+class ModelCache:
+    """LRU cache of the parsed models, bounded by the number of models and by
+    the total size of their XML sources (a proxy of their memory usage).
+    """
+    
+    def __init__(self, max_models=64, max_bytes=256*2**20):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def add(self, xml_bytes):
+        """Parses, evaluates and caches a model, unless it is already cached.
+        A model that can't be evaluated is not cached.
+
+        :return: the CachedModel
+        """
+        model_id = hashlib.sha256(xml_bytes).hexdigest()[:16]
+        with self.lock:
+            if model_id in self.models:
+                self.hits += 1
+                self.models.move_to_end(model_id)
+                return self.models[model_id]
+        # Not shared, so that an override changes a single parameter
+        root = xmlio.create_object_from_xml_element(ET.fromstring(xml_bytes))
+        model = CachedModel(model_id, root, len(xml_bytes))
+        model.cost = evaluate(model)
+        with self.lock:
+            self.misses += 1
+            if model_id not in self.models:
+                self.models[model_id] = model
+                self.size += model.size
+            while self.models and (len(self.models) > self.max_models or
+                                   self.size > self.max_bytes):
+                _, evicted = self.models.popitem(last=False)
+                self.size -= evicted.size
+            return model
+    
+    def get(self, model_id):
+        with self.lock:
+            if model_id not in self.models:
+                self.misses += 1
+                raise KeyError('Unknown model: ' + model_id)
+            self.hits += 1
+            self.models.move_to_end(model_id)
+            return self.models[model_id]
+
+
+class Metrics:
+    """Requests statistics, per endpoint.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = OrderedDict()
+    
+    def record(self, endpoint, elapsed, error):
+        with self.lock:
+            stats = self.endpoints.setdefault(
+                endpoint, {'requests': 0, 'errors': 0, 'total_ms': 0.,
+                           'max_ms': 0.})
+            stats['requests'] += 1
+            stats['errors'] += error
+            stats['total_ms'] += elapsed
+            stats['max_ms'] = max(stats['max_ms'], elapsed)
+    
+    def as_dict(self):
+        with self.lock:
+            endpoints = OrderedDict()
+            for endpoint, stats in self.endpoints.items():
+                endpoints[endpoint] = dict(stats)
+                endpoints[endpoint]['mean_ms'] = stats['total_ms']/stats['requests']
+            return {'uptime_s': time.time() - self.started,
+                    'endpoints': endpoints}
+
+
+def format_value(val):
+    """JSON form of a cost or parameter value.
+    """
+    if isinstance(val, BoundedQuantity):
+        return {'mean': float(val.mean.magnitude), 'lower': float(val.lower),
+                'upper': float(val.upper), 'units': str(val.units)}
+    if hasattr(val, 'units'):
+        return {'mean': float(val.magnitude), 'units': str(val.units)}
+    return {'mean': val}
+
+
+def parse_value(value, current):
+    """Parses the JSON value of a parameter: a string parsed like an XML
+    attribute, or a number in the units of the current value.
+    """
+    if isinstance(value, str):
+        return parse_quantity(value)
+    if isinstance(value, bool) or not isinstance(value, Number):
+        raise ValueError('Invalid parameter value: {!r}'.format(value))
+    if isinstance(current, BoundedQuantity):
+        return BoundedQuantity(ureg.Quantity(value, current.units))
+    if isinstance(current, ureg.Quantity):
+        return ureg.Quantity(value, current.units)
+    return value
+
+
+def evaluate(model, overrides=None):
+    """Evaluates a cached model with some parameters overridden, and restores
+    them.
+    """
+    overrides = overrides or {}
+    with model.lock:
+        params = []
+        try:
+            for path, value in overrides.items():
+                try:
+                    param = model.parameters[path]
+                except KeyError:
+                    raise KeyError('Unknown parameter: ' + path)
+                params.append((param, param.value))
+                param.value = parse_value(value, param.value)
+            cost, _ = evaluate_site(model.root)
+        finally:
+            for param, value in reversed(params):
+                param.value = value
+    return cost
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handler of the requests, using the cache and metrics of its server.
+    """
+    
+    def log_message(self, format, *args):
+        # The metrics replace the access log
+        pass
+    
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    
+    def _handle(self, endpoint, action):
+        start = time.perf_counter()
+        error = True
+        try:
+            status, data = action()
+            error = status >= 400
+        except KeyError as e:
+            status, data = 404, {'error': e.args[0]}
+        except (ValueError, TypeError, ET.ParseError, PintError) as e:
+            status, data = 400, {'error': str(e)}
+        except Exception as e:
+            # Any other error of the model
+            status, data = 500, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+        elapsed = 1000*(time.perf_counter() - start)
+        if isinstance(data, dict) and status < 400 and endpoint != '/metrics':
+            data['elapsed_ms'] = elapsed
+        self.server.metrics.record(endpoint, elapsed, error)
+        self._send(status, data)
+    
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['metrics']:
+            self._handle('/metrics', self._metrics)
+        elif len(parts) == 3 and parts[0] == 'models' and parts[2] == 'parameters':
+            self._handle('/models/parameters', lambda: self._parameters(parts[1]))
+        else:
+            self._send(404, {'error': 'Unknown endpoint: ' + self.path})
+    
+    def do_POST(self):
+        if self.path == '/models':
+            self._handle('/models', self._upload)
+        elif self.path == '/evaluate':
+            self._handle('/evaluate', self._evaluate)
+        else:
+            self._send(404, {'error': 'Unknown endpoint: ' + self.path})
+    
+    def _metrics(self):
+        cache = self.server.cache
+        data = self.server.metrics.as_dict()
+        data['cache'] = {'models': len(cache.models), 'bytes': cache.size,
+                         'hits': cache.hits, 'misses': cache.misses}
+        return 200, data
+    
+    def _parameters(self, model_id):
+        model = self.server.cache.get(model_id)
+        with model.lock:
+            return 200, OrderedDict((path, format_value(p.value))
+                                    for path, p in model.parameters.items())
+    
+    def _upload(self):
+        model = self.server.cache.add(self._body())
+        return 200, {'model': model.id, 'cost': format_value(model.cost)}
+    
+    def _evaluate(self):
+        request = json.loads(self._body().decode())
+        if not isinstance(request, dict):
+            raise ValueError('The request must be a JSON object')
+        model = self.server.cache.get(request.get('model', ''))
+        cost = evaluate(model, request.get('overrides'))
+        return 200, {'model': model.id, 'cost': format_value(cost)}
+
+
+class EvaluationServer(ThreadingHTTPServer):
+    """HTTP server handling each request in a thread, with a shared model
+    cache.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, address=('127.0.0.1', 8765), max_models=64,
+                 max_bytes=256*2**20):
+        super().__init__(address, RequestHandler)
+        self.cache = ModelCache(max_models, max_bytes)
+        self.metrics = Metrics()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Kampach evaluation server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-models', type=int, default=64)
+    parser.add_argument('--max-megabytes', type=float, default=256)
+    args = parser.parse_args(args)
+    server = EvaluationServer((args.host, args.port), args.max_models,
+                              int(args.max_megabytes*2**20))
+    print('Serving on http://{0}:{1}'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
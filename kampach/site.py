@@ -8,20 +8,115 @@
     :license: CeCILL, see LICENSE for more details.
 """
 
-from . import ureg, xmlio, valuable
-from .arithmetic import parse_quantity
+from . import ureg, xmlio, valuable, csg
+from .arithmetic import BoundedQuantity, bounded_magnitudes, parse_quantity
+from .terrain import ElevationGrid, parse_point, format_point
 import xml.etree.ElementTree as ET
+import numpy as np
+import copy
 
 
 class Site(valuable.Valuable):
     """An archeological site. Contains buildings and geographical information.
     """
     
-    def __init__(self, name=''):
+    def __init__(self, name='', terrain=None, sources=None):
         super().__init__(name)
+        self.terrain = terrain
+        self.sources = sources if sources is not None else []
+    
+    @property
+    def sources(self):
+        """List of the Source objects (quarries, clay pits...) of the site.
+        """
+        return self._sources
+    
+    @sources.setter
+    def sources(self, val):
+        self._sources = val
+    
+    @property
+    def terrain(self):
+        """An ElevationGrid used by the transport activities, or None.
+        """
+        return self._terrain
     
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    @terrain.setter
+    def terrain(self, val):
+        self._terrain = val
+        self.attach_terrain()
+    
+    def attach_terrain(self):
+        """Gives the terrain of the site to all its transport activities. Must
+        be called again when activities are added after the terrain.
+        """
+        stack = list(self.inputs)
+        # Shared valuables, and cycles of references, are walked once
+        visited = set()
+        while stack:
+            node = stack.pop()
+            node = getattr(node, 'input_valuable', node)
+            # Inputs still being loaded have no valuable
+            if node is None or id(node) in visited:
+                continue
+            visited.add(id(node))
+            if isinstance(node, TransportActivity):
+                node.terrain = self.terrain
+            stack.extend(node.inputs)
+    
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
         return 0
+    
+    def export_to_xml(self, parent=None):
+        elem = super().export_to_xml(parent)
+        if self.terrain is not None:
+            self.terrain.export_to_xml(elem)
+        for source in self.sources:
+            source.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        # Templates are available to all the elements of the site
+        with xmlio.templates(elem.find('Templates')):
+            super().add_data_from_xml_element(elem)
+        terrain = elem.find('Terrain')
+        if terrain is not None:
+            self.terrain = ElevationGrid.create_from_xml_element(terrain)
+            # The activities are complete once the whole site is loaded
+            xmlio.when_loaded(self.attach_terrain)
+        self.sources = [Source.create_from_xml_element(e)
+                        for e in elem.findall('Source')]
+
+
+class Source:
+    """A place where material is taken, e.g. a quarry.
+
+    :param location: point (x, y)
+    :param resource: name of the resource supplied (see
+        QuantitativeValuable.resource), by default the name of the source
+    """
+    
+    def __init__(self, name='', location=None, resource=None):
+        self.name = name
+        self.location = location
+        self.resource = name if resource is None else resource
+    
+    def __repr__(self):
+        return "<Source: {}>".format(self.name)
+    
+    def export_to_xml(self, parent):
+        elem = ET.SubElement(parent, 'Source')
+        elem.set('name', self.name)
+        elem.set('location', format_point(self.location))
+        if self.resource != self.name:
+            elem.set('resource', self.resource)
+        return elem
+    
+    @classmethod
+    def create_from_xml_element(cls, elem):
+        return cls(elem.get('name', ''), parse_point(elem.get('location')),
+                   elem.get('resource'))
 
 
 class SuperBuilding(valuable.Valuable):
@@ -31,7 +126,8 @@ class SuperBuilding(valuable.Valuable):
     def __init__(self, name=''):
         super().__init__(name)
     
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
         return 0
 
 
@@ -39,10 +135,12 @@ class Building(valuable.Valuable):
     """An archeological building. Has a shape and possibly substructures.
     """
     
-    def __init__(self, name='', shape=None):
+    def __init__(self, name='', shape=None, count=1, location=None):
         super().__init__(name)
         self.shape = shape
         self.substructures = []
+        self.count = count
+        self.location = location
     
     @property
     def shape(self):
@@ -56,6 +154,19 @@ class Building(valuable.Valuable):
         """
         return self._substructures
     
+    @property
+    def count(self):
+        """Number of identical instances of this building. The total cost
+        is the cost of one instance scaled by this number.
+        """
+        return self._count
+    
+    @property
+    def location(self):
+        """Point (x, y) of the building, or None.
+        """
+        return self._location
+    
     @property
     def total_volume(self):
         """The total volume of the building, including any substructure.
@@ -64,11 +175,22 @@ class Building(valuable.Valuable):
     
     @property
     def fill_volume(self):
-        """The (inner) fill volume of the building.
+        """The (inner) fill volume of the building, without the substructures.
+        The composite substructures (see kampach.csg), positioned relative to
+        the center of the base of the shape, only count for their parts
+        inside the shape.
         """
         vol = self.shape.compute_fill_volume()
+        solids = []
         for b in self.substructures:
-            vol -= b.compute_total_volume()
+            if isinstance(b, csg.Solid) and csg.is_supported(self.shape):
+                solids.append(b)
+            else:
+                vol -= b.compute_total_volume()
+        if solids:
+            # Only the parts of the positioned substructures inside the shape
+            shell = csg.Difference(csg.Placed(self.shape), solids)
+            vol -= shell.compute_removed_volume()
         return vol
     
     @property
@@ -103,12 +225,37 @@ class Building(valuable.Valuable):
     def substructures(self, val):
         self._substructures = val
     
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
-        if self.name:
+    @count.setter
+    def count(self, val):
+        self._count = val
+    
+    @location.setter
+    def location(self, val):
+        self._location = val
+    
+    def expand_instances(self):
+        """Returns one building per instance, sharing the shape and inputs of
+        this building, e.g. to write one CSV row per instance.
+        """
+        if self.count == 1:
+            return [self]
+        instances = []
+        for i in range(self.count):
+            instance = copy.copy(self)
+            instance.name = '{0} #{1}'.format(self.name, i+1)
+            instance.count = 1
+            instances.append(instance)
+        return instances
+    
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
+        if self.name and not quiet:
             blank = " "*2*print_depth
             print()
             print(blank + self.name)
             print(blank + '='*len(self.name))
+            if self.count != 1:
+                print(blank + 'Instances: {}'.format(self.count))
             print(blank + 'Fill volume: {}'.format(self.fill_volume))
             print(blank + 'Finish volume: {}'.format(self.finish_volume))
             print(blank + 'Total finish area: {}'.format(self.total_finish_area))
@@ -136,6 +283,10 @@ class Building(valuable.Valuable):
     
     def export_to_xml(self, parent=None):
         elem = super().export_to_xml(parent)
+        if self.count != 1:
+            elem.set('count', str(self.count))
+        if self.location is not None:
+            elem.set('location', format_point(self.location))
         shape = ET.SubElement(elem, 'Shape')
         self.shape.export_to_xml(shape)
         if self.substructures:
@@ -146,6 +297,10 @@ class Building(valuable.Valuable):
     
     def add_data_from_xml_element(self, elem):
         super().add_data_from_xml_element(elem)
+        if 'count' in elem.attrib:
+            self.count = int(elem.get('count'))
+        if 'location' in elem.attrib:
+            self.location = parse_point(elem.get('location'))
         shape = elem.find('Shape')
         if shape:
             self.shape = xmlio.create_object_from_xml_element(shape[0])
@@ -158,24 +313,48 @@ class Building(valuable.Valuable):
 
 class TransportActivity(valuable.LinearQuantitativeValuable):
     """Transport of material.
+    
+    When the activity has a source and a destination and its site has a
+    terrain, the distances are those of the least-cost paths on the terrain
+    (loaded from the source, empty back), as equivalent distances on flat
+    ground. Otherwise the same distance is used both ways.
     """
     
     def __init__(self, name='', amount=None, amount_per_travel=None,
-                 speed_loaded=None, speed_empty=None, distance=None):
+                 speed_loaded=None, speed_empty=None, distance=None,
+                 source=None, destination=None):
         super(valuable.LinearQuantitativeValuable, self).__init__(name, amount)
         self.amount_per_travel = amount_per_travel
         self.speed_loaded = speed_loaded
         self.speed_empty = speed_empty
         self.distance = distance
+        self.source = source
+        self.destination = destination
+        self.terrain = None
     
     @property
     def marginal_cost(self):
         """The cost of transportation is a standard United Nations formula.
+        It is per unit of the amount, or of the amount per travel when no
+        amount is set yet.
+        """
+        units = getattr(self.amount, 'units', self.amount_per_travel.units)
+        return (self.compute_travel_time() / self.amount_per_travel).to(
+            ureg.work_day / units)
+    
+    def compute_distances(self):
+        """Computes the distances of the loaded and of the empty travels.
+        """
+        if (self.terrain is None or self.source is None
+                or self.destination is None):
+            return self.distance, self.distance
+        return self.terrain.compute_distances(self.source, self.destination)
+    
+    def compute_travel_time(self):
+        """Computes the time of a round trip.
         """
-        travel_time = self.distance * (1/self.speed_empty +
-                                       1/self.speed_loaded)
-        return (travel_time / self.amount_per_travel).to(ureg.work_day /
-                                                         self.amount.units)
+        loaded, empty = self.compute_distances()
+        return loaded/self.speed_loaded + empty/self.speed_empty
     
     @property
     def fixed_cost(self):
@@ -207,6 +386,24 @@ class TransportActivity(valuable.LinearQuantitativeValuable):
         """
         return self._distance
     
+    @property
+    def source(self):
+        """Point (x, y) where the material is taken, or None.
+        """
+        return self._source
+    
+    @property
+    def destination(self):
+        """Point (x, y) where the material is brought, or None.
+        """
+        return self._destination
+    
+    @property
+    def terrain(self):
+        """ElevationGrid of the site, set by Site.attach_terrain(), or None.
+        """
+        return self._terrain
+    
     @marginal_cost.setter
     def marginal_cost(self, val):
         # Don't allow to set the marginal cost directly
@@ -232,13 +429,30 @@ class TransportActivity(valuable.LinearQuantitativeValuable):
     def distance(self, val):
         self._distance = val
     
+    @source.setter
+    def source(self, val):
+        self._source = val
+    
+    @destination.setter
+    def destination(self, val):
+        self._destination = val
+    
+    @terrain.setter
+    def terrain(self, val):
+        self._terrain = val
+    
     def export_to_xml(self, parent=None):
         elem = super(valuable.LinearQuantitativeValuable,
                      self).export_to_xml(parent)
         elem.set('amount_per_travel', str(self.amount_per_travel))
         elem.set('speed_loaded', str(self.speed_loaded))
         elem.set('speed_empty', str(self.speed_empty))
-        elem.set('distance', str(self.distance))
+        if self.distance is not None:
+            elem.set('distance', str(self.distance))
+        if self.source is not None:
+            elem.set('source', format_point(self.source))
+        if self.destination is not None:
+            elem.set('destination', format_point(self.destination))
         return elem
     
     def add_data_from_xml_element(self, elem):
@@ -247,8 +461,257 @@ class TransportActivity(valuable.LinearQuantitativeValuable):
         self.amount_per_travel = parse_quantity(elem.get('amount_per_travel'))
         self.speed_loaded = parse_quantity(elem.get('speed_loaded'))
         self.speed_empty = parse_quantity(elem.get('speed_empty'))
-        self.distance = parse_quantity(elem.get('distance'))
+        if 'distance' in elem.attrib:
+            self.distance = parse_quantity(elem.get('distance'))
+        if 'source' in elem.attrib:
+            self.source = parse_point(elem.get('source'))
+        if 'destination' in elem.attrib:
+            self.destination = parse_point(elem.get('destination'))
+
+
+class Carrier:
+    """A type of carrier (porter, cart, boat...) of a FleetTransportActivity.
+
+    :param capacity: amount of material carried at each travel
+    :param loading_time: time to load the carrier, at each travel
+    :param unloading_time: time to unload the carrier, at each travel
+    :param crew: number of workers operating one carrier
+    """
+    
+    def __init__(self, name='', capacity=None, speed_loaded=None,
+                 speed_empty=None, loading_time=0*ureg.hour,
+                 unloading_time=0*ureg.hour, crew=1):
+        self.name = name
+        self.capacity = capacity
+        self.speed_loaded = speed_loaded
+        self.speed_empty = speed_empty
+        self.loading_time = loading_time
+        self.unloading_time = unloading_time
+        self.crew = crew
+    
+    def __repr__(self):
+        return "<Carrier: {}>".format(self.name)
+    
+    def export_to_xml(self, parent):
+        elem = ET.SubElement(parent, 'Carrier')
+        elem.set('name', self.name)
+        for name in ('capacity', 'speed_loaded', 'speed_empty', 'loading_time',
+                     'unloading_time', 'crew'):
+            if getattr(self, name) is not None:
+                elem.set(name, str(getattr(self, name)))
+        return elem
+    
+    @classmethod
+    def create_from_xml_element(cls, elem):
+        carrier = cls(elem.get('name', ''))
+        for name in ('capacity', 'speed_loaded', 'speed_empty', 'loading_time',
+                     'unloading_time'):
+            if name in elem.attrib:
+                setattr(carrier, name, parse_quantity(elem.get(name)))
+        carrier.crew = int(elem.get('crew', 1))
+        return carrier
+
+
+class Leg:
+    """A leg of a FleetTransportActivity, travelled by a fleet of carriers of
+    one type.
+
+    :param distance: distance to run at each travel (one way)
+    :param fleet_size: number of carriers working on the leg
+    """
+    
+    def __init__(self, carrier=None, distance=None, fleet_size=1):
+        self.carrier = carrier
+        self.distance = distance
+        self.fleet_size = fleet_size
+    
+    def __repr__(self):
+        return "<Leg: {0}, {1}>".format(self.carrier.name, self.distance)
+    
+    def export_to_xml(self, parent):
+        elem = ET.SubElement(parent, 'Leg')
+        elem.set('carrier', self.carrier.name)
+        if self.distance is not None:
+            elem.set('distance', str(self.distance))
+        elem.set('fleet_size', str(self.fleet_size))
+        return elem
+
+
+def _bounded_array(val, units):
+    """Array of the (lower, mean, upper) magnitudes of val in units, with the
+    dimensions of arrays of samples after the first one.
+    """
+    return np.array(np.broadcast_arrays(*bounded_magnitudes(val, units)),
+                    dtype=float)
+
+
+class FleetTransportActivity(valuable.LinearQuantitativeValuable):
+    """Transport of material along successive legs (e.g. by river, then
+    overland), each travelled by a fleet of carriers.
+    
+    The material goes through the legs like a pipeline, so the transport
+    lasts as long as its slowest leg: a leg carries its amount in
+    amount/capacity travels, each taking the loaded and empty travel times
+    plus the loading and unloading times, shared by the carriers of its
+    fleet. The crews of all the fleets are employed during the whole
+    transport, so the cost is the duration times the number of workers.
+    With a single leg, a single carrier and no loading time, this is the
+    cost of a TransportActivity.
+    
+    The legs and carriers are evaluated as arrays, so that many fleet
+    configurations are compared in one call (see compare_fleets()).
+    """
+    
+    def __init__(self, name='', amount=None, carriers=None, legs=None):
+        super(valuable.LinearQuantitativeValuable, self).__init__(name, amount)
+        self.carriers = carriers if carriers is not None else []
+        self.legs = legs if legs is not None else []
+    
+    @property
+    def carriers(self):
+        """List of the Carrier types used by the legs.
+        """
+        return self._carriers
+    
+    @property
+    def legs(self):
+        """List of the Leg objects, in the order travelled by the material.
+        """
+        return self._legs
+    
+    @property
+    def marginal_cost(self):
+        """Overriden from LinearQuantitativeValuable
+        """
+        fleet_sizes = [[leg.fleet_size for leg in self.legs]]
+        costs = self.compare_fleets(fleet_sizes)
+        lower, mean, upper = costs.magnitude[:, 0]
+        if np.ndim(mean) or lower == upper:
+            # Samples (see kampach.montecarlo) or exact values
+            return mean*costs.units
+        return BoundedQuantity(mean*costs.units, (lower, upper))
+    
+    @property
+    def fixed_cost(self):
+        """Overriden from LinearQuantitativeValuable
+        """
+        return 0
+    
+    @carriers.setter
+    def carriers(self, val):
+        self._carriers = val
+    
+    @legs.setter
+    def legs(self, val):
+        self._legs = val
+    
+    @marginal_cost.setter
+    def marginal_cost(self, val):
+        # Don't allow to set the marginal cost directly
+        pass
+    
+    @fixed_cost.setter
+    def fixed_cost(self, val):
+        self._fixed_cost = val
+    
+    def _leg_arrays(self):
+        """Time of a travel (hours) and capacity of each leg, as arrays with
+        one row for the lower, mean and upper values of the cost and one
+        column per leg, and the crew of each leg.
+        
+        Values holding arrays of samples (see kampach.montecarlo) add their
+        dimensions after the column of the leg.
+        """
+        if not self.legs:
+            raise ValueError('A fleet transport activity needs legs')
+        capacity_units = self.legs[0].carrier.capacity.units
+        values = [[_bounded_array(leg.distance, ureg.meter),
+                   _bounded_array(leg.carrier.speed_loaded, ureg.meter/ureg.hour),
+                   _bounded_array(leg.carrier.speed_empty, ureg.meter/ureg.hour),
+                   _bounded_array(leg.carrier.loading_time, ureg.hour),
+                   _bounded_array(leg.carrier.unloading_time, ureg.hour),
+                   _bounded_array(leg.carrier.capacity, capacity_units)]
+                  for leg in self.legs]
+        ndim = max(a.ndim for row in values for a in row)
+        travel_times = []
+        capacities = []
+        for row in values:
+            distance, loaded, empty, loading, unloading, capacity = [
+                a.reshape(a.shape + (1,)*(ndim - a.ndim)) for a in row]
+            # The cost is lower with the upper speeds and capacity
+            travel_times.append(distance/loaded[::-1] + distance/empty[::-1]
+                                + loading + unloading)
+            capacities.append(capacity[::-1])
+        travel_times = np.stack(np.broadcast_arrays(*travel_times), axis=1)
+        capacities = np.stack(np.broadcast_arrays(*capacities), axis=1)
+        crews = np.array([leg.carrier.crew for leg in self.legs], dtype=float)
+        return travel_times, capacities, crews, capacity_units
+    
+    def compare_fleets(self, fleet_sizes):
+        """Computes the marginal costs of the activity for several fleet
+        configurations at once.
+
+        :param fleet_sizes: array of the numbers of carriers, with one row
+            per configuration and one column per leg
+        :return: Quantity of an array of the marginal costs (work days per
+            unit of capacity of the first carrier), with rows for the lower,
+            mean and upper values and one column per configuration
+        """
+        travel_times, capacities, crews, capacity_units = self._leg_arrays()
+        samples = (1,)*(np.ndim(travel_times) - 2)
+        fleet_sizes = np.asarray(fleet_sizes, dtype=float).reshape(
+            -1, len(self.legs))
+        # Duration per unit of amount of each leg: (bound, configuration,
+        # leg, samples)
+        durations = ((travel_times/capacities)[:, None]
+                     /fleet_sizes.reshape((1,) + fleet_sizes.shape + samples))
+        workers = (fleet_sizes*crews).sum(axis=1)
+        hours = durations.max(axis=2)*workers.reshape(workers.shape + samples)
+        return (hours*ureg.hour/capacity_units).to(ureg.work_day/capacity_units)
+    
+    def compute_duration(self):
+        """Computes the duration of the transport of the current amount, with
+        the current fleet sizes.
+        """
+        travel_times, capacities, _, capacity_units = self._leg_arrays()
+        fleet_sizes = np.array([leg.fleet_size for leg in self.legs], dtype=float)
+        fleet_sizes = fleet_sizes.reshape(fleet_sizes.shape
+                                          + (1,)*(np.ndim(travel_times) - 2))
+        lower, mean, upper = (travel_times/capacities/fleet_sizes).max(axis=1)
+        if np.ndim(mean):
+            return (mean*ureg.hour/capacity_units*self.amount).to(ureg.work_day)
+        duration = BoundedQuantity(mean*ureg.hour/capacity_units,
+                                   (lower, upper))*self.amount
+        return duration.to(ureg.work_day)
+    
+    def export_to_xml(self, parent=None):
+        elem = super(valuable.LinearQuantitativeValuable,
+                     self).export_to_xml(parent)
+        for carrier in self.carriers:
+            carrier.export_to_xml(elem)
+        for leg in self.legs:
+            leg.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        super(valuable.LinearQuantitativeValuable,
+              self).add_data_from_xml_element(elem)
+        self.carriers = [Carrier.create_from_xml_element(e)
+                         for e in elem.findall('Carrier')]
+        carriers = {carrier.name: carrier for carrier in self.carriers}
+        self.legs = []
+        for e in elem.findall('Leg'):
+            try:
+                carrier = carriers[e.get('carrier')]
+            except KeyError:
+                raise ValueError('Unknown carrier: {}'.format(e.get('carrier')))
+            self.legs.append(Leg(carrier, parse_quantity(e.get('distance')),
+                                 int(e.get('fleet_size', 1))))
 
 
 class ProductionActivity(valuable.LinearQuantitativeValuable):
     pass
+
+
+class TabulatedActivity(valuable.TabulatedQuantitativeValuable):
+    pass
@@ -0,0 +1,256 @@
+"""
+    kampach.siting
+    ~~~~~~~~~~~~~~
+
+    Choice of the sources (quarries, clay pits...) of the transport
+    activities among candidate locations.
+
+    The cost of every transport activity of a site (with a destination) from
+    every candidate source is computed at once as a matrix, from the
+    straight distances or from the least-cost fields of the terrain of the
+    site. Each activity is supplied by the cheapest open source, and the set
+    of open sources is chosen with a greedy heuristic (opening the source
+    that lowers the total cost most, while it lowers it) improved by local
+    search (swapping, opening or closing a source while it lowers the total
+    cost). Opening a source may have a cost, and the number of open sources
+    may be limited.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .site import TransportActivity
+from .valuable import iter_evaluation
+import numpy as np
+
+
+def _mean(val):
+    if isinstance(val, BoundedQuantity):
+        return val.mean
+    return val
+
+
+def _meters(point):
+    return [float(_mean(c).to(ureg.meter).magnitude) for c in point]
+
+
+def check_distances(root):
+    """Raises a ValueError if a transport activity of root can't be
+    evaluated: it has no distance, and no source on a terrain.
+    """
+    stack = [root]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        node = getattr(node, 'input_valuable', node)
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if (isinstance(node, TransportActivity) and node.distance is None
+                and (node.source is None or node.terrain is None)):
+            raise ValueError('Transport activity {!r} has neither a distance '
+                             'nor a source on a terrain'.format(node.name))
+        stack.extend(node.inputs)
+
+
+def transport_activities(root):
+    """Evaluates root and returns its transport activities having a
+    destination, with their number of instances. The activities must have a
+    current source or distance to be evaluated (see check_distances()).
+
+    :return: list of (TransportActivity, count)
+    """
+    check_distances(root)
+    activities = []
+    for item, _, count, _ in iter_evaluation(root):
+        if isinstance(item, TransportActivity) and item.destination is not None:
+            activities.append((item, count))
+    return activities
+
+
+def _scaled_distance(current, distance):
+    """The distance, with the bounds of the current distance relative to its
+    mean.
+    """
+    if not isinstance(current, BoundedQuantity) or current.mean.magnitude == 0:
+        return BoundedQuantity(distance)
+    current = current.to(distance.units)
+    scale = distance.magnitude/current.mean.magnitude
+    return BoundedQuantity(distance, (current.lower*scale, current.upper*scale))
+
+
+def transport_costs(activities, candidates, terrain=None):
+    """Computes the costs of transport activities from candidate sources.
+
+    :param activities: TransportActivity objects, whose amounts are set
+    :param candidates: (x, y) points
+    :param terrain: an ElevationGrid, or None for straight distances
+    :return: array of the costs in work days, with one row per activity and
+        one column per candidate
+    """
+    # Cost of a meter of loaded and of empty travel, for each activity
+    rates = []
+    for a in activities:
+        travels = _mean(a.amount)/_mean(a.amount_per_travel)
+        rates.append([float((travels/_mean(speed)).to(ureg.work_day/ureg.meter)
+                            .magnitude)
+                      for speed in (a.speed_loaded, a.speed_empty)])
+    rates = np.array(rates, dtype=float).reshape(len(activities), 2)
+    if terrain is None:
+        destinations = np.array([_meters(a.destination) for a in activities],
+                                dtype=float).reshape(-1, 2)
+        sources = np.array([_meters(c) for c in candidates],
+                           dtype=float).reshape(-1, 2)
+        loaded = np.hypot(destinations[:, 0, None] - sources[None, :, 0],
+                          destinations[:, 1, None] - sources[None, :, 1])
+        empty = loaded
+    else:
+        cells = tuple(np.array([terrain.cell(a.destination) for a in activities],
+                               dtype=int).reshape(-1, 2).T)
+        size = float(terrain.cell_size.to(ureg.meter).magnitude)
+        loaded = np.empty((len(activities), len(candidates)))
+        empty = np.empty((len(activities), len(candidates)))
+        for j, candidate in enumerate(candidates):
+            forward, back = terrain.cost_fields(terrain.cell(candidate))
+            loaded[:, j] = forward[cells]*size
+            empty[:, j] = back[cells]*size
+    return loaded*rates[:, 0, None] + empty*rates[:, 1, None]
+
+
+class SourceSiting:
+    """Choice of open sources minimizing the total cost of the activities,
+    each supplied by its cheapest open source, plus the opening costs.
+
+    :param costs: array of the costs of the activities (rows) from the
+        candidate sources (columns)
+    :param opening_costs: cost of opening each candidate (scalar or array)
+    :param max_sources: maximum number of open sources, or None
+    """
+    
+    def __init__(self, costs, opening_costs=0., max_sources=None):
+        self.costs = np.asarray(costs, dtype=float)
+        candidates = self.costs.shape[1]
+        self.opening_costs = np.broadcast_to(
+            np.asarray(opening_costs, dtype=float), (candidates,))
+        self.max_sources = candidates if max_sources is None else max_sources
+    
+    def total_cost(self, sources):
+        """Total cost with the given open sources (candidate indices).
+        """
+        sources = list(sources)
+        return float(self.costs[:, sources].min(axis=1).sum()
+                     + self.opening_costs[sources].sum())
+    
+    def assign(self, sources):
+        """Returns the index of the source of each activity.
+        """
+        sources = np.asarray(sources, dtype=int)
+        return sources[np.argmin(self.costs[:, sources], axis=1)]
+    
+    def greedy(self):
+        """Opens the sources one by one, choosing each time the one that
+        lowers the total cost most.
+
+        :return: list of candidate indices
+        """
+        sources = []
+        best = np.full(self.costs.shape[0], np.inf)
+        total = np.inf
+        while len(sources) < self.max_sources:
+            totals = np.minimum(self.costs, best[:, None]).sum(axis=0) \
+                + self.opening_costs + self.opening_costs[sources].sum()
+            totals[sources] = np.inf
+            j = int(np.argmin(totals))
+            if not totals[j] < total:
+                break
+            sources.append(j)
+            best = np.minimum(best, self.costs[:, j])
+            total = totals[j]
+        return sources
+    
+    def local_search(self, sources, max_iterations=1000):
+        """Improves a set of open sources by the best move (swapping, opening
+        or closing a source) while it lowers the total cost.
+
+        :return: list of candidate indices
+        """
+        sources = list(sources)
+        costs = self.costs
+        rows = np.arange(costs.shape[0])
+        for _ in range(max_iterations):
+            total = self.total_cost(sources)
+            opening = self.opening_costs[sources].sum()
+            # Cheapest and second cheapest open source of each activity
+            open_costs = costs[:, sources]
+            order = np.argsort(open_costs, axis=1)[:, :2]
+            best = open_costs[rows, order[:, 0]]
+            if len(sources) > 1:
+                second = open_costs[rows, order[:, 1]]
+            else:
+                second = np.full(len(rows), np.inf)
+            closed = np.ones(costs.shape[1], dtype=bool)
+            closed[sources] = False
+            moves = []
+            if len(sources) < self.max_sources and closed.any():
+                totals = np.minimum(costs, best[:, None]).sum(axis=0) \
+                    + self.opening_costs + opening
+                totals[~closed] = np.inf
+                j = int(np.argmin(totals))
+                moves.append((totals[j], sources + [j]))
+            for k, out in enumerate(sources):
+                # Cost of each activity without the source out
+                without = np.where(order[:, 0] == k, second, best)
+                others = sources[:k] + sources[k+1:]
+                if others:
+                    moves.append((without.sum() + opening
+                                  - self.opening_costs[out], others))
+                if closed.any():
+                    totals = np.minimum(costs, without[:, None]).sum(axis=0) \
+                        + self.opening_costs + opening - self.opening_costs[out]
+                    totals[~closed] = np.inf
+                    j = int(np.argmin(totals))
+                    moves.append((totals[j], others + [j]))
+            if not moves:
+                break
+            move_total, move = min(moves, key=lambda move: move[0])
+            # Tolerance against rounding errors, so that the search ends
+            if not move_total < total - 1e-9*abs(total):
+                break
+            sources = move
+        return sorted(sources)
+    
+    def solve(self):
+        """Returns the sources found by the greedy heuristic and improved by
+        local search.
+        """
+        return self.local_search(self.greedy())
+
+
+def optimize_sources(root, candidates, max_sources=None, opening_costs=0.,
+                     apply=True):
+    """Chooses the sources of the transport activities of root among
+    candidates, using the terrain of root if any.
+
+    :param opening_costs: cost of opening each candidate, in work days
+    :param apply: set the source of each activity to the chosen one (and
+        without terrain, its distance to the straight distance, with the
+        relative bounds of the current distance)
+    :return: the indices of the open candidates and the total cost
+    """
+    activities = transport_activities(root)
+    terrain = getattr(root, 'terrain', None)
+    costs = transport_costs([a for a, _ in activities], candidates, terrain)
+    costs *= np.array([count for _, count in activities], dtype=float)[:, None]
+    siting = SourceSiting(costs, opening_costs, max_sources)
+    sources = siting.solve()
+    if apply:
+        for (activity, _), j in zip(activities, siting.assign(sources)):
+            activity.source = candidates[j]
+            if terrain is None:
+                (x0, y0), (x1, y1) = _meters(candidates[j]), \
+                    _meters(activity.destination)
+                activity.distance = _scaled_distance(
+                    activity.distance, float(np.hypot(x1 - x0, y1 - y0))*ureg.meter)
+    return sources, siting.total_cost(sources)*ureg.work_day
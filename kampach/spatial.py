@@ -0,0 +1,237 @@
+"""
+    kampach.spatial
+    ~~~~~~~~~~~~~~~
+
+    Spatial index of the buildings and material sources of a site.
+
+    The points are bucketed in a uniform grid (sorted by cell, with the
+    offsets of the cells), so that the nearest point of many query points is
+    found at once by searching rings of cells of growing radius around
+    them, until no unvisited cell can hold a closer point.
+
+    The buildings may have a location, and the sites a list of sources
+    (quarries, clay pits...). locate_transports() sets the source,
+    destination and distance of the transport activities of the located
+    buildings from their nearest source, for all the buildings of a site in
+    one pass.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg
+from .arithmetic import BoundedQuantity
+from .site import Building, TransportActivity
+from collections import OrderedDict
+import numpy as np
+
+
+def to_meters(points):
+    """Converts (x, y) points of quantities to an array of meters.
+    """
+    coordinates = []
+    for point in points:
+        for c in point:
+            if isinstance(c, BoundedQuantity):
+                c = c.mean
+            coordinates.append(float(c.to(ureg.meter).magnitude))
+    return np.array(coordinates, dtype=float).reshape(-1, 2)
+
+
+def _ring(radius):
+    """Offsets of the cells at a Chebyshev distance radius from a cell.
+    """
+    if radius == 0:
+        return np.zeros((1, 2), dtype=np.int64)
+    side = np.arange(-radius, radius + 1)
+    inner = side[1:-1]
+    return np.concatenate([
+        np.stack([side, np.full(side.size, -radius)], axis=1),
+        np.stack([side, np.full(side.size, radius)], axis=1),
+        np.stack([np.full(inner.size, -radius), inner], axis=1),
+        np.stack([np.full(inner.size, radius), inner], axis=1)])
+
+
+class GridIndex:
+    """Uniform grid index of points (x, y).
+
+    :param points: array of the points, one row per point
+    :param cell_size: size of the cells, by default such that there is about
+        one point per cell
+    """
+    
+    def __init__(self, points, cell_size=None):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(self.points)
+        if n:
+            self.origin = self.points.min(axis=0)
+            extent = self.points.max(axis=0) - self.origin
+        else:
+            self.origin = extent = np.zeros(2)
+        if cell_size is None:
+            area = extent[0]*extent[1]
+            cell_size = np.sqrt(area/n) if area > 0 else max(extent.max()/max(n, 1), 0)
+        self.cell_size = float(cell_size) or 1.
+        self.shape = (np.floor(extent/self.cell_size).astype(np.int64) + 1)
+        cells = self._cells(self.points)
+        keys = cells[:, 0]*self.shape[1] + cells[:, 1]
+        self.order = np.argsort(keys, kind='stable')
+        # Points of the cell k: order[starts[k]:starts[k+1]]
+        self.starts = np.searchsorted(keys[self.order],
+                                      np.arange(self.shape.prod() + 1))
+    
+    def __len__(self):
+        return len(self.points)
+    
+    def _cells(self, points):
+        cells = np.floor((points - self.origin)/self.cell_size).astype(np.int64)
+        return np.minimum(np.maximum(cells, 0), self.shape - 1)
+    
+    def _candidates(self, queries, cells):
+        """Points of some cells: arrays of (query, point) pairs for cells given
+        as (query, cell) pairs, ignoring the cells outside the grid.
+        """
+        inside = ((cells >= 0) & (cells < self.shape)).all(axis=1)
+        queries, cells = queries[inside], cells[inside]
+        keys = cells[:, 0]*self.shape[1] + cells[:, 1]
+        starts, counts = self.starts[keys], self.starts[keys + 1] - self.starts[keys]
+        total = counts.sum()
+        first = np.cumsum(counts) - counts
+        positions = np.repeat(starts - first, counts) + np.arange(total)
+        return np.repeat(queries, counts), self.order[positions]
+    
+    def _unvisited_distance(self, queries, centers, radius):
+        """Distance from the queries to the cells of the grid outside the
+        squares of cells of the given radius around their centers (inf when
+        the squares cover the grid).
+        """
+        low = np.maximum(centers - radius, 0)
+        high = np.minimum(centers + radius + 1, self.shape)
+        zeros, shape = np.zeros_like(low), np.broadcast_to(self.shape, low.shape)
+        # The parts of the grid left, right, below and above the squares
+        strips = [((zeros[:, 0], zeros[:, 1]), (low[:, 0], shape[:, 1])),
+                  ((high[:, 0], zeros[:, 1]), (shape[:, 0], shape[:, 1])),
+                  ((low[:, 0], zeros[:, 1]), (high[:, 0], low[:, 1])),
+                  ((low[:, 0], high[:, 1]), (high[:, 0], shape[:, 1]))]
+        distance = np.full(len(queries), np.inf)
+        for strip_low, strip_high in strips:
+            strip_low, strip_high = np.stack(strip_low, 1), np.stack(strip_high, 1)
+            empty = (strip_low >= strip_high).any(axis=1)
+            gap = np.maximum(self.origin + strip_low*self.cell_size - queries,
+                             queries - self.origin - strip_high*self.cell_size)
+            d = np.hypot(*np.maximum(gap, 0).T)
+            distance = np.where(empty, distance, np.minimum(distance, d))
+        return distance
+    
+    def nearest(self, queries):
+        """Finds the nearest point of each query point.
+
+        :param queries: array of points, one row per point
+        :return: arrays of the indices of the nearest points and of their
+            distances (-1 and inf without points)
+        """
+        queries = np.asarray(queries, dtype=float).reshape(-1, 2)
+        indices = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf)
+        if not len(self.points):
+            return indices, distances
+        centers = self._cells(queries)
+        active = np.arange(len(queries))
+        radius = 0
+        while active.size:
+            offsets = _ring(radius)
+            cells = (centers[active, None, :] + offsets[None, :, :]).reshape(-1, 2)
+            q, p = self._candidates(np.repeat(active, len(offsets)), cells)
+            if q.size:
+                d = np.hypot(*(queries[q] - self.points[p]).T)
+                # Closest candidate of each query
+                order = np.lexsort((d, q))
+                q, p, d = q[order], p[order], d[order]
+                first = np.ones(q.size, dtype=bool)
+                first[1:] = q[1:] != q[:-1]
+                q, p, d = q[first], p[first], d[first]
+                closer = d < distances[q]
+                indices[q[closer]] = p[closer]
+                distances[q[closer]] = d[closer]
+            bound = self._unvisited_distance(queries[active], centers[active],
+                                             radius)
+            active = active[distances[active] > bound]
+            radius += 1
+        return indices, distances
+    
+    def within_radius(self, point, radius):
+        """Finds the points within a radius of point.
+
+        :return: the indices of the points, by increasing distance
+        """
+        point = np.asarray(point, dtype=float)
+        low = np.floor((point - radius - self.origin)/self.cell_size).astype(np.int64)
+        high = np.floor((point + radius - self.origin)/self.cell_size).astype(np.int64)
+        low, high = np.maximum(low, 0), np.minimum(high, self.shape - 1)
+        if (low > high).any():
+            return np.empty(0, dtype=np.int64)
+        rows, cols = np.meshgrid(np.arange(low[0], high[0] + 1),
+                                 np.arange(low[1], high[1] + 1), indexing='ij')
+        cells = np.stack([rows.ravel(), cols.ravel()], axis=1)
+        _, p = self._candidates(np.zeros(len(cells), dtype=np.int64), cells)
+        d = np.hypot(*(self.points[p] - point).T)
+        order = np.argsort(d, kind='stable')
+        return p[order][d[order] <= radius]
+
+
+def _located_transports(site):
+    """Yields (TransportActivity, Building) for the transport activities of
+    the buildings having a location.
+    """
+    # (node, closest located building)
+    stack = [(site, None)]
+    # Shared valuables, and cycles of references, are walked once per
+    # building
+    visited = set()
+    while stack:
+        node, building = stack.pop()
+        if (id(node), id(building)) in visited:
+            continue
+        visited.add((id(node), id(building)))
+        if isinstance(node, Building) and node.location is not None:
+            building = node
+        if isinstance(node, TransportActivity) and building is not None:
+            yield node, building
+        stack.extend((getattr(i, 'input_valuable', i), building)
+                     for i in node.inputs)
+
+
+def locate_transports(site, overwrite=False):
+    """Sets the transport activities of the located buildings of a site to
+    bring their material from the nearest source of the site (with the
+    resource of the activity, if it has one) to their building. Without
+    terrain, their distance is the straight distance.
+
+    :param overwrite: also set the activities already having a source
+    :return: the number of activities set
+    """
+    groups = OrderedDict()
+    locations = {}
+    for activity, building in _located_transports(site):
+        if activity.source is not None and not overwrite:
+            continue
+        if locations.setdefault(id(activity), building.location) != building.location:
+            raise ValueError('A transport activity is shared by buildings at '
+                             'different locations (load the site without '
+                             'sharing): ' + activity.name)
+        groups.setdefault(activity.resource, []).append((activity, building))
+    count = 0
+    for resource, pairs in groups.items():
+        sources = [s for s in site.sources if not resource or s.resource == resource]
+        if not sources:
+            continue
+        index = GridIndex(to_meters([s.location for s in sources]))
+        destinations = to_meters([building.location for _, building in pairs])
+        nearest, distances = index.nearest(destinations)
+        for (activity, building), j, distance in zip(pairs, nearest, distances):
+            activity.source = sources[j].location
+            activity.destination = building.location
+            if site.terrain is None:
+                activity.distance = BoundedQuantity(float(distance)*ureg.meter)
+            count += 1
+    return count
@@ -0,0 +1,234 @@
+"""
+    kampach.terrain
+    ~~~~~~~~~~~~~~~
+
+    Elevation rasters and least-cost paths on them, used to compute the
+    transport distances on a sloped terrain.
+
+    The travel cost of a step between two neighbouring cells is its length
+    divided by a slope-dependent speed factor (Tobler's hiking function by
+    default), i.e. an equivalent distance on flat ground. The cost-distance
+    field from a source is computed on the whole grid by fast sweeping (each
+    line of cells is relaxed at once from the previous one), and cached so
+    that all the buildings supplied by a source reuse it. The step costs are
+    computed line by line during the sweeps, from the (memory-mapped)
+    elevations, so that only the cost-distance fields are held in memory.
+
+    :copyright: 2019 by Kampach Authors, see AUTHORS for more details.
+    :license: CeCILL, see LICENSE for more details.
+"""
+
+from . import ureg, xmlio
+from collections import OrderedDict
+import xml.etree.ElementTree as ET
+import numpy as np
+import math
+
+"""Neighbour offsets (row, column) of the 8-connected grid.
+"""
+NEIGHBOURS = ((0, 1), (0, -1), (1, 0), (-1, 0),
+              (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def tobler_factor(slope):
+    """Walking speed relative to the speed on flat ground, according to
+    Tobler's hiking function. slope is the elevation gain over the
+    horizontal distance (negative downhill).
+    """
+    return np.exp(-3.5*(np.abs(slope + 0.05) - 0.05))
+
+
+def load_elevations(filename, shape=None, dtype='float32'):
+    """Memory-maps an elevation raster from a .npy file, or from a raw binary
+    file of the given shape (rows, columns) and dtype.
+    """
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    if shape is None:
+        raise ValueError('The shape of a raw elevation file is required: '
+                         + filename)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+"""Number of lines whose step costs are computed at once in a sweep.
+"""
+SWEEP_BLOCK = 64
+
+
+def _lateral(array, offset):
+    """Views (target, source) of the last axis of array such that
+    target[..., j] is the neighbour of source[..., j] at the lateral offset.
+    """
+    if offset > 0:
+        return array[..., 1:], array[..., :-1]
+    if offset < 0:
+        return array[..., :-1], array[..., 1:]
+    return array, array
+
+
+def _sweep(dist, elevations, offsets, step_cost):
+    """Relaxes dist line by line, each line from the previous one: a sweep
+    of the fast sweeping method. offsets are the lateral offsets of the
+    neighbours in the previous line. The costs of the steps between two
+    lines are computed from their elevations by step_cost(rise, length),
+    rise being the elevation of the reached cell minus the elevation of the
+    neighbour, for blocks of SWEEP_BLOCK lines.
+    """
+    for start in range(1, len(dist), SWEEP_BLOCK):
+        stop = min(start + SWEEP_BLOCK, len(dist))
+        z = np.asarray(elevations[start-1:stop], dtype=float)
+        costs = []
+        for offset in offsets:
+            z_target, _ = _lateral(z[1:], offset)
+            _, z_source = _lateral(z[:-1], offset)
+            costs.append(step_cost(z_target - z_source, math.hypot(1, offset)))
+        for i in range(start, stop):
+            line, previous = dist[i], dist[i-1]
+            for offset, cost in zip(offsets, costs):
+                target, _ = _lateral(line, offset)
+                _, source = _lateral(previous, offset)
+                np.minimum(target, source + cost[i-start], out=target)
+
+
+class ElevationGrid:
+    """A regular grid of elevations.
+
+    :param elevations: 2D array of the elevations, in the units of
+        cell_size; row i is at y = y + i*cell_size, column j at x = x + j*cell_size
+    :param cell_size: distance between two neighbouring cells (Quantity)
+    :param x: x coordinate of the first column (Quantity)
+    :param y: y coordinate of the first row (Quantity)
+    :param speed_factor: function giving the speed relative to flat ground
+        from an array of slopes
+    :param max_fields: maximum number of cost-distance fields kept in cache
+    """
+    
+    def __init__(self, elevations, cell_size=1*ureg.meter, x=0*ureg.meter,
+                 y=0*ureg.meter, speed_factor=tobler_factor, max_fields=16):
+        self.elevations = elevations
+        self.cell_size = cell_size
+        self.x = x
+        self.y = y
+        self.speed_factor = speed_factor
+        self.max_fields = max_fields
+        self.filename = ''
+        self._fields = OrderedDict()
+    
+    def __repr__(self):
+        return "<ElevationGrid: {0}x{1}>".format(*self.elevations.shape)
+    
+    def cell(self, point):
+        """Returns the (row, column) of the cell closest to point (x, y).
+        """
+        size = self.cell_size.to(ureg.meter).magnitude
+        col = round((point[0] - self.x).to(ureg.meter).magnitude/size)
+        row = round((point[1] - self.y).to(ureg.meter).magnitude/size)
+        rows, cols = self.elevations.shape
+        if not (0 <= row < rows and 0 <= col < cols):
+            raise ValueError('Point outside the terrain: {}'.format(point))
+        return row, col
+    
+    def step_cost(self, rise, length):
+        """Equivalent flat distances (in cell sizes) of steps of the given
+        length (in cell sizes) and elevation rises (array, in the units of
+        cell_size).
+        """
+        size = self.cell_size.magnitude
+        return length/self.speed_factor(rise/(length*size))
+    
+    def _relax(self, dist, direction):
+        """Shortest path relaxation until convergence. The step to a cell
+        from its neighbours is taken in this direction for 1 (outward from
+        the source), and reversed for -1 (back to the source).
+        """
+        def step_cost(rise, length):
+            return self.step_cost(direction*rise, length)
+        # Sweeps down, up, right and left. The lines of each sweep are the
+        # contiguous rows, of the transposed arrays for the columns.
+        offsets = {}
+        for axis in (0, 1):
+            for step in (1, -1):
+                offsets[axis, step] = [offset[1-axis] for offset in NEIGHBOURS
+                                       if offset[axis] == step]
+        dist = dist.copy()
+        while True:
+            previous = dist.copy()
+            for (axis, step), lateral in offsets.items():
+                z = self.elevations
+                if axis == 1:
+                    dist = np.ascontiguousarray(dist.T)
+                    z = z.T
+                _sweep(dist[::step], z[::step], lateral, step_cost)
+                if axis == 1:
+                    dist = np.ascontiguousarray(dist.T)
+            if np.array_equal(dist, previous):
+                return dist
+    
+    def cost_fields(self, source):
+        """Returns the equivalent flat distances (in cell sizes) from the
+        source cell to every cell, and from every cell back to the source.
+        The fields are cached per source.
+        """
+        if source in self._fields:
+            self._fields.move_to_end(source)
+            return self._fields[source]
+        start = np.full(self.elevations.shape, np.inf)
+        start[source] = 0
+        # Outward: reaching (i, j) from its neighbour n costs the step
+        # n -> (i, j). Back: in the reversed graph, it costs (i, j) -> n.
+        fields = self._relax(start, 1), self._relax(start, -1)
+        self._fields[source] = fields
+        if len(self._fields) > self.max_fields:
+            self._fields.popitem(last=False)
+        return fields
+    
+    def compute_distances(self, source, destination):
+        """Computes the equivalent flat distances of the least-cost paths from
+        source to destination (loaded) and from destination to source
+        (empty), given as (x, y) points.
+        """
+        forward, back = self.cost_fields(self.cell(source))
+        cell = self.cell(destination)
+        size = self.cell_size.to(ureg.meter)
+        return (float(forward[cell])*size).to(self.cell_size.units), \
+               (float(back[cell])*size).to(self.cell_size.units)
+    
+    def export_to_xml(self, parent):
+        elem = ET.SubElement(parent, 'Terrain')
+        elem.set('file', self.filename)
+        elem.set('cell_size', str(self.cell_size))
+        elem.set('x', str(self.x))
+        elem.set('y', str(self.y))
+        if not self.filename.endswith('.npy'):
+            elem.set('rows', str(self.elevations.shape[0]))
+            elem.set('columns', str(self.elevations.shape[1]))
+            elem.set('dtype', str(self.elevations.dtype))
+        return elem
+    
+    @classmethod
+    def create_from_xml_element(cls, elem):
+        filename = xmlio.resolve_path(elem.get('file'))
+        shape = None
+        if 'rows' in elem.attrib:
+            shape = int(elem.get('rows')), int(elem.get('columns'))
+        elevations = load_elevations(filename, shape,
+                                     elem.get('dtype', 'float32'))
+        grid = cls(elevations)
+        grid.filename = filename
+        for name in ('cell_size', 'x', 'y'):
+            if name in elem.attrib:
+                setattr(grid, name, ureg(elem.get(name)))
+        return grid
+
+
+def parse_point(string):
+    """Parses a point given as 'x; y', e.g. '120 m; 45 m'.
+    """
+    coordinates = string.split(';')
+    if len(coordinates) != 2:
+        raise ValueError('A point must have two coordinates: ' + string)
+    return tuple(ureg(c) for c in coordinates)
+
+
+def format_point(point):
+    return '{0}; {1}'.format(*point)
@@ -1,13 +1,45 @@
 import unittest
 
 from . import ureg
-from .arithmetic import BoundedQuantity as BQ_, parse_quantity
+from .arithmetic import BoundedQuantity as BQ_, parse_quantity, PiecewiseLinear
 from .geometry import TruncatedPyramid, Cuboid, Superstructure, Prism,\
-    Stairs
-from .site import Site, Building, TransportActivity, ProductionActivity
-from .valuable import LinearQuantitativeValuableInput as LQVI
+    Stairs, Cylinder
+from .site import Site, Building, TransportActivity, ProductionActivity, Source,\
+    Carrier
+from .parameters import find_parameter
+from .valuable import LinearQuantitativeValuableInput as LQVI, iter_evaluation
+from . import bounds
+from .gradient import compute_gradient
+from .mesh import MeshShape
+from .schedule import build_tasks, critical_path, schedule, sweep_workforce
+from .region import load_region, evaluate_site
+from . import cache
+from .inventory import BuildingInventory
+from .server import EvaluationServer
+from .aggregate import aggregate
+from .siting import optimize_sources
+from .index import XMLIndex
+from .montecarlo import MonteCarlo
+from .parallel import ParallelMonteCarlo
+from .spatial import GridIndex, locate_transports
+from .terrain import ElevationGrid
+from .leontief import InputOutputModel
+from .csg import Placed, Union, Intersection, Difference
+from .query import select, total
+from .incremental import IncrementalEvaluation
+import threading
+import urllib.request
+import urllib.error
+import json
+import io
+import contextlib
+import numpy as np
+import tempfile
+import os
+import itertools
+from . import xmlio
 from .xmlio import create_object_from_xml_element, save_xml_file,\
-    load_xml_file
+    load_xml_file, sharing
 import xml.etree.ElementTree as ET
 
 m = 1*ureg.meter
@@ -71,6 +103,28 @@ class TestArithmetic(unittest.TestCase):
         bq1 = BQ_(1*m, (0.9, 1.1))
         bq2 = parse_quantity(str(bq1))
         self.assertEqual(bq1, bq2)
+    
+    def test_hash(self):
+        bq1 = BQ_(1*m, (0.9, 1.1))
+        bq2 = BQ_(1*m, (0.9, 1.1))
+        self.assertEqual(hash(bq1), hash(bq2))
+        self.assertEqual(len({bq1, bq2, BQ_(1*m)}), 2)
+        # Equal in other units
+        self.assertEqual(BQ_(0*m), BQ_(0*ureg.centimeter))
+        self.assertEqual(hash(BQ_(0*m)), hash(BQ_(0*ureg.centimeter)))
+    
+    def test_piecewise_linear(self):
+        scale = PiecewiseLinear([(100*m3, BQ_(40*wd, (30, 50))), (0*m3, 0*wd),
+                                 (1000*m3, 300*wd)])
+        cost = scale(BQ_(50*m3, (0, 200)))
+        self.assertAlmostEqual(cost.mean, 20*wd)
+        self.assertAlmostEqual(cost.lower, 0)
+        self.assertAlmostEqual(cost.upper, 50 + 250*100/900)
+        # Extended linearly beyond the last point
+        self.assertAlmostEqual(scale(2000*m3).mean, (300 + 1000*260/900)*wd)
+        # The minimum of a non-monotone curve is between the bounds
+        fatigue = PiecewiseLinear([(0*m, 10), (10*m, 5), (20*m, 10)])
+        self.assertEqual(fatigue(BQ_(10*m, (5, 15))).as_list(), [5, 5, 7.5])
 
 class TestValuable(unittest.TestCase):
     
@@ -98,6 +152,198 @@ class TestXML(unittest.TestCase):
         with self.assertRaises(ValueError):
             elem = ET.Element('BadTag')
             create_object_from_xml_element(elem)
+    
+    def test_sharing(self):
+        building = ('<Building name="House"><Shape>'
+                    '<Cuboid length="5 meter, [4 ; 6]" width="4 meter" height="3 meter"/>'
+                    '</Shape></Building>')
+        elem = ET.fromstring('<Site><Inputs>' + 2*building + '</Inputs></Site>')
+        with sharing():
+            site = create_object_from_xml_element(elem)
+        self.assertIs(site.inputs[0], site.inputs[1])
+        with sharing():
+            site = create_object_from_xml_element(elem)
+        self.assertIsNot(site.inputs[0], create_object_from_xml_element(elem[0][0]))
+        unshared = create_object_from_xml_element(elem)
+        self.assertIsNot(unshared.inputs[0], unshared.inputs[1])
+        self.assertEqual(unshared.inputs[0].shape, unshared.inputs[1].shape)
+        self.assertEqual(site.inputs[0].fill_volume, unshared.inputs[0].fill_volume)
+        # Equal quantities are shared, but not modified by in-place operations
+        elem = ET.fromstring('<Site><Inputs>' + building
+                             + building.replace('4 meter', '2 meter') + '</Inputs></Site>')
+        with sharing():
+            site = create_object_from_xml_element(elem)
+        first, second = site.inputs[0].shape, site.inputs[1].shape
+        self.assertIs(first.bottom_length, second.bottom_length)
+        first.bottom_length += 1*ureg.meter
+        self.assertEqual(first.bottom_length, BQ_(6*ureg.meter, (5, 7)))
+        self.assertEqual(second.bottom_length, BQ_(5*ureg.meter, (4, 6)))
+        # Quantities in different units are not shared, shapes are mutable
+        first = building.replace('width', 'finish_thickness="1 meter" width')
+        second = building.replace('width', 'finish_thickness="100 centimeter" width')
+        elem = ET.fromstring('<Site><Inputs>' + first + second.replace('4 meter', '2 meter')
+                             + '</Inputs></Site>')
+        with sharing():
+            site = create_object_from_xml_element(elem)
+        self.assertEqual(str(site.inputs[1].shape.finish_thickness.units), 'centimeter')
+        with self.assertRaises(TypeError):
+            hash(site.inputs[0].shape)
+    
+    def test_include(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def write(filename, content):
+                with open(os.path.join(directory, filename), 'w') as f:
+                    f.write(content)
+            os.mkdir(os.path.join(directory, 'sectors'))
+            write('library.xml', '<Templates><ProductionActivity name="Filling" '
+                  'marginal_cost="2 work_day / meter ** 3"/></Templates>')
+            write('sectors/house.xml', '<Building name="House"><Inputs>'
+                  '<LinearInput target_amount="fill_volume">'
+                  '<ProductionActivity template="Filling"/></LinearInput>'
+                  '</Inputs><Shape><Cuboid length="5 meter" width="4 meter" '
+                  'height="3 meter"/></Shape></Building>')
+            write('sectors/north.xml', '<SuperBuilding name="North"><Inputs>'
+                  '<Include href="house.xml"/><Include href="house.xml"/>'
+                  '</Inputs></SuperBuilding>')
+            write('site.xml', '<Site><Templates><Include href="library.xml"/>'
+                  '</Templates><Inputs><Include href="sectors/north.xml"/>'
+                  '</Inputs></Site>')
+            parses = xmlio.include_cache.parses
+            site = load_xml_file(os.path.join(directory, 'site.xml'))
+            self.assertEqual(site.compute_total_cost(), BQ_(240*wd))
+            self.assertEqual(xmlio.include_cache.parses, parses + 3)
+            # Only the modified file is parsed again
+            path = os.path.join(directory, 'sectors/house.xml')
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+            load_xml_file(os.path.join(directory, 'site.xml'))
+            self.assertEqual(xmlio.include_cache.parses, parses + 4)
+            write('sectors/house.xml', '<Include href="../site.xml"/>')
+            with self.assertRaises(ValueError):
+                load_xml_file(os.path.join(directory, 'site.xml'))
+            # Identical files including different files are not shared
+            for sector, cost in (('a', 1), ('b', 9)):
+                os.mkdir(os.path.join(directory, sector))
+                write(sector + '/house.xml', '<Building name="House"><Inputs>'
+                      '<LinearInput target_amount="fill_volume">'
+                      '<Include href="filling.xml"/></LinearInput></Inputs>'
+                      '<Shape><Cuboid length="5 meter" width="4 meter" '
+                      'height="3 meter"/></Shape></Building>')
+                write(sector + '/filling.xml', '<ProductionActivity name="Filling" '
+                      'marginal_cost="{} work_day / meter ** 3"/>'.format(cost))
+            write('site.xml', '<Site><Inputs><Include href="a/house.xml"/>'
+                  '<Include href="b/house.xml"/></Inputs></Site>')
+            for share in (False, True):
+                site = load_xml_file(os.path.join(directory, 'site.xml'), share)
+                self.assertEqual(site.compute_total_cost(), BQ_(600*wd))
+            # The files of a template are relative to its library
+            os.mkdir(os.path.join(directory, 'lib'))
+            write('lib/cube.obj', 'v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\n'
+                  'v 0 0 1\nv 1 0 1\nv 1 1 1\nv 0 1 1\n'
+                  'f 1 4 3 2\nf 5 6 7 8\nf 1 2 6 5\nf 2 3 7 6\nf 3 4 8 7\nf 4 1 5 8\n')
+            write('lib/templates.xml', '<Templates><Building name="Cube"><Shape>'
+                  '<MeshShape file="cube.obj"/></Shape></Building></Templates>')
+            write('site.xml', '<Site><Templates><Include href="lib/templates.xml"/>'
+                  '</Templates><Inputs><Building template="Cube" name="A"/>'
+                  '<Building template="Cube" name="B"/></Inputs></Site>')
+            for share in (False, True):
+                site = load_xml_file(os.path.join(directory, 'site.xml'), share)
+                self.assertAlmostEqual(site.inputs[1].shape.compute_total_volume().mean, 1*m3)
+            self.assertIs(site.inputs[0].shape, site.inputs[1].shape)
+    
+    def test_tabulated(self):
+        elem = ET.fromstring(
+            '<Building name="House"><Inputs>'
+            '<LinearInput target_amount="fill_volume"><TabulatedActivity name="Filling">'
+            '<Point amount="0 meter ** 3" cost="0 work_day"/>'
+            '<Point amount="100 meter ** 3" cost="100 work_day, [80 ; 120]"/>'
+            '<Point amount="1000 meter ** 3" cost="500 work_day"/>'
+            '</TabulatedActivity></LinearInput>'
+            '<TabulatedInput target_amount="fill_volume">'
+            '<Point target="0 meter ** 3" amount="0 kilogram"/>'
+            '<Point target="100 meter ** 3" amount="1000 kilogram"/>'
+            '<ProductionActivity name="Lifting" marginal_cost="0.1 work_day / kilogram"/>'
+            '</TabulatedInput></Inputs><Shape>'
+            '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+            '</Shape></Building>')
+        building = create_object_from_xml_element(elem)
+        cost = building.compute_total_cost()
+        self.assertAlmostEqual(cost.mean, 120*wd)
+        self.assertAlmostEqual(cost.upper, 132)
+        self.assertAlmostEqual(building.inputs[1].input_valuable.amount.mean, 600*kg)
+        exported = ET.fromstring(ET.tostring(building.export_to_xml()))
+        self.assertEqual(create_object_from_xml_element(exported).compute_total_cost(),
+                         cost)
+        # Derivatives through the tables are their slopes
+        _, gradients = compute_gradient(building)
+        self.assertAlmostEqual(gradients['House/Shape.height'], 40*wd/m)
+    
+    def test_index(self):
+        building = ('<Building name="House {0}"><Inputs><LinearInput target_amount="fill_volume">'
+                    '<ProductionActivity template="Filling"/></LinearInput></Inputs>'
+                    '<Shape><Cuboid length="5 meter" width="4 meter" height="{0} meter"/>'
+                    '</Shape></Building>\n')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'Site.xml')
+            with open(filename, 'w') as f:
+                f.write('<?xml version="1.0"?>\n<Site name="Site"><Templates>'
+                        '<ProductionActivity name="Filling" '
+                        'marginal_cost="2 work_day / meter ** 3"/></Templates><Inputs>')
+                f.write(''.join(building.format(i) for i in range(1, 4)))
+                f.write('<Building name="House 1"><Shape><Cuboid length="1 meter" '
+                        'width="1 meter" height="1 meter"/></Shape></Building>')
+                f.write('</Inputs></Site>')
+            with XMLIndex(filename) as index:
+                self.assertEqual(index.find(tag='Building'),
+                                 ['Site/House 1', 'Site/House 2', 'Site/House 3',
+                                  'Site/House 1[1]'])
+                self.assertEqual(index.get_element('Site/#Templates/Filling').tag,
+                                 'ProductionActivity')
+                house = index.load_object('Site/House 2')
+                self.assertEqual(house.compute_total_cost(), BQ_(80*wd))
+            site = load_xml_file(filename)
+            self.assertEqual(site.inputs[1].compute_total_cost(), BQ_(80*wd))
+            with XMLIndex(filename) as index:
+                self.assertTrue(index.is_up_to_date())
+            os.utime(filename, ns=(0, 0))
+            with XMLIndex(filename) as index:
+                self.assertTrue(index.is_up_to_date())
+                self.assertEqual(len(index.find(name='House 1')), 2)
+            # Names like the paths, in a latin-1 file
+            with open(filename, 'w', encoding='latin-1') as f:
+                f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<Site name="Site">'
+                        '<Templates><ProductionActivity name="Filling" '
+                        'marginal_cost="2 work_day / meter ** 3"/></Templates><Inputs>')
+                for name in ('A', 'A[1]', 'A', 'B/C', 'Château'):
+                    f.write(building.replace('House {0}', name).format(1))
+                f.write('</Inputs></Site>')
+            with XMLIndex(filename) as index:
+                self.assertEqual(index.find(tag='Building'),
+                                 ['Site/A', 'Site/A\\[1]', 'Site/A[1]', 'Site/B\\/C',
+                                  'Site/Château'])
+                for path in index.find(tag='Building'):
+                    self.assertEqual(index.load_object(path).compute_total_cost(),
+                                     BQ_(40*wd))
+                self.assertEqual(index.get_element('Site/B\\/C').get('name'), 'B/C')
+    
+    def test_deep_model(self):
+        # Supply chains much deeper than the recursion limit
+        def load_chain(depth):
+            level = '<ProductionActivity><Inputs><LinearInput>'
+            xml = level*depth + '<ProductionActivity/>' + \
+                '</LinearInput></Inputs></ProductionActivity>'*depth
+            chain = create_object_from_xml_element(ET.fromstring(xml))
+            activity = chain
+            while activity.inputs:
+                activity.fixed_cost = 1
+                activity = activity.inputs[0].input_valuable
+            return chain
+        self.assertEqual(load_chain(100000).compute_total_cost(), 100000)
+        chain = load_chain(5000)
+        with cache.ResultCache(':memory:') as results:
+            self.assertEqual(cache.compute_total_cost(chain, results), 5000)
+            self.assertEqual(cache.compute_total_cost(chain, results), 5000)
+            self.assertEqual(results.hits, 1)
+
 
 class TestSite(unittest.TestCase):
     
@@ -201,6 +447,653 @@ class TestSite(unittest.TestCase):
         
         site_loaded = load_xml_file("tests/Site.xml")
         save_xml_file(site_loaded, "tests/Site_reloaded.xml")
+    
+    def test_templates(self):
+        elem = ET.fromstring(
+            '<Site><Templates><Building name="House"><Inputs>'
+            '<LinearInput target_amount="fill_volume">'
+            '<ProductionActivity marginal_cost="2 work_day / meter ** 3" name="Filling"/>'
+            '</LinearInput></Inputs><Shape>'
+            '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+            '</Shape></Building></Templates><Inputs>'
+            '<Building template="House" name="Row" count="3"/>'
+            '<Building template="House" name="Tall house"><Shape>'
+            '<Cuboid length="5 meter" width="4 meter" height="6 meter"/>'
+            '</Shape></Building>'
+            '</Inputs></Site>')
+        site = create_object_from_xml_element(elem)
+        row, tall = site.inputs
+        self.assertEqual(row.count, 3)
+        self.assertEqual(tall.count, 1)
+        self.assertEqual(row.compute_total_cost(), BQ_(360.*wd))
+        self.assertEqual(tall.compute_total_cost(), BQ_(240.*wd))
+        self.assertEqual([b.name for b in row.expand_instances()],
+                         ['Row #1', 'Row #2', 'Row #3'])
+        with self.assertRaises(ValueError):
+            create_object_from_xml_element(ET.fromstring('<Building template="Unknown"/>'))
+        # Self-referring, cyclic and mismatched templates
+        for templates in ('<Building name="A" template="A"/>',
+                          '<Building name="A" template="B"/><Building name="B" template="A"/>',
+                          '<Site name="A"/>'):
+            elem = ET.fromstring('<Site><Templates>' + templates + '</Templates><Inputs>'
+                                 '<Building template="A"/></Inputs></Site>')
+            with self.assertRaises(ValueError):
+                create_object_from_xml_element(elem)
+    
+    def test_gradient(self):
+        site = Site('Site')
+        house = Building('House', Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m)))
+        site.inputs.append(house)
+        filling = ProductionActivity('Filling')
+        filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+        house.inputs.append(LQVI(house, filling, 'fill_volume'))
+        cost, gradients = compute_gradient(site)
+        self.assertEqual(cost, 120*wd)
+        self.assertAlmostEqual(gradients['Site/House/Shape.height'], 40*wd/m)
+        self.assertAlmostEqual(gradients['Site/House/Filling.marginal_cost'], 60*m3)
+        self.assertAlmostEqual(gradients['Site/House/Filling.marginal_amount'], 120*wd)
+        # The model is restored after the evaluation
+        self.assertEqual(filling.marginal_cost, BQ_(2*wd/m3, (1, 3)))
+    
+    def test_terrain(self):
+        # A ramp rising by 0.1 m per meter along x
+        elevations = np.tile(0.1*np.arange(21.), (5, 1))
+        with tempfile.TemporaryDirectory() as directory:
+            np.save(os.path.join(directory, 'ramp.npy'), elevations)
+            with open(os.path.join(directory, 'Site.xml'), 'w') as f:
+                f.write('<Site><Terrain file="ramp.npy" cell_size="1 meter"/>'
+                        '<Inputs><TransportActivity name="Earth transporting" '
+                        'amount_per_travel="50 kilogram" speed_loaded="2 kph" '
+                        'speed_empty="5 kph" source="0 meter; 2 meter" '
+                        'destination="10 meter; 2 meter"/></Inputs></Site>')
+            site = load_xml_file(os.path.join(directory, 'Site.xml'))
+            transport = site.inputs[0]
+            self.assertIs(transport.terrain, site.terrain)
+            loaded, empty = transport.compute_distances()
+            self.assertAlmostEqual(loaded, 10*np.exp(0.35)*m)
+            self.assertAlmostEqual(empty, 10*m)
+            # The cost-distance fields are computed once per source
+            transport.destination = (20*m, 4*m)
+            transport.compute_distances()
+            self.assertEqual(len(site.terrain._fields), 1)
+            transport.terrain = None
+            transport.distance = BQ_(10*m)
+            self.assertEqual(transport.compute_distances(), (BQ_(10*m), BQ_(10*m)))
+            # The references are resolved before the terrain is attached, and
+            # the walks stop on cycles of references
+            with open(os.path.join(directory, 'Cyclic.xml'), 'w') as f:
+                f.write('<Site><Terrain file="ramp.npy" cell_size="1 meter"/>'
+                        '<Source name="Quarry" location="20 meter; 2 meter"/><Inputs>'
+                        '<Building name="House" location="10 meter; 2 meter"><Inputs>'
+                        '<LinearInput target_amount="fill_volume" '
+                        'marginal_amount="2 kilogram / meter ** 3">'
+                        '<TransportActivity name="Earth" amount_per_travel="50 kilogram" '
+                        'speed_loaded="2 kph" speed_empty="5 kph"><Inputs>'
+                        '<LinearInput ref="Earth"/></Inputs></TransportActivity>'
+                        '</LinearInput></Inputs><Shape>'
+                        '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+                        '</Shape></Building></Inputs></Site>')
+            site = load_xml_file(os.path.join(directory, 'Cyclic.xml'))
+            transport = site.inputs[0].inputs[0].input_valuable
+            self.assertIs(transport.inputs[0].input_valuable, transport)
+            self.assertIs(transport.terrain, site.terrain)
+            self.assertEqual(locate_transports(site), 1)
+            self.assertEqual(transport.source, (20*m, 2*m))
+            with self.assertRaisesRegex(ValueError, 'own inputs'):
+                cache.subtree_hashes(site)
+        # Sweeps over several blocks of lines: the path from a to b costs the
+        # same in the outward field of a and in the back field of b
+        rng = np.random.default_rng(0)
+        grid = ElevationGrid(np.cumsum(rng.normal(size=(80, 70)), axis=0))
+        a, b = (3, 60), (75, 5)
+        self.assertAlmostEqual(grid.cost_fields(a)[0][b], grid.cost_fields(b)[1][a])
+    
+    def test_siting(self):
+        site = Site('Site')
+        for x in (0, 10, 100):
+            site.inputs.append(TransportActivity(
+                'Transport', BQ_(1000*kg), BQ_(50*kg), BQ_(2*kph), BQ_(5*kph),
+                BQ_(0*m), destination=(x*m, 0*m)))
+        candidates = [(x*m, 0*m) for x in (0, 10, 100, 50)]
+        sources, cost = optimize_sources(site, candidates, max_sources=1)
+        self.assertEqual(sources, [1])
+        self.assertEqual(site.inputs[2].source, (10*m, 0*m))
+        self.assertAlmostEqual(cost, site.compute_total_cost().mean)
+        # Opening a source costs less than supplying the farthest building
+        sources, _ = optimize_sources(site, candidates, opening_costs=0.1)
+        self.assertEqual(sources, [1, 2])
+        # The relative bounds of the distances are kept
+        site.inputs[0].distance = BQ_(10*m, (9, 12))
+        optimize_sources(site, candidates, max_sources=1)
+        self.assertEqual(site.inputs[0].distance, BQ_(10.*m, (9, 12)))
+        site.inputs[0].distance = BQ_(20*m, (18, 24))
+        optimize_sources(site, candidates[2:3])
+        self.assertEqual(site.inputs[0].distance, BQ_(100.*m, (90, 120)))
+        # Activities that can't be evaluated are refused
+        site.inputs[1].distance = None
+        site.inputs[1].source = None
+        with self.assertRaises(ValueError):
+            optimize_sources(site, candidates)
+    
+    def test_fleet_transport(self):
+        transport = create_object_from_xml_element(ET.fromstring(
+            '<FleetTransportActivity name="Stones">'
+            '<Carrier name="Boat" capacity="1000 kilogram" speed_loaded="4 kph" '
+            'speed_empty="4 kph" loading_time="1 hour" unloading_time="1 hour" '
+            'crew="2"/>'
+            '<Carrier name="Porter" capacity="25 kilogram" speed_loaded="2 kph" '
+            'speed_empty="4 kph"/>'
+            '<Leg carrier="Boat" distance="8 kilometer, [6 ; 10]"/>'
+            '<Leg carrier="Porter" distance="1 kilometer" fleet_size="10"/>'
+            '</FleetTransportActivity>'))
+        transport.amount = BQ_(10000*kg)
+        # The boat is the bottleneck: 6 hours per travel, 12 workers
+        cost = transport.compute_total_cost()
+        self.assertEqual(cost.units, ureg.work_day)
+        np.testing.assert_allclose(cost.as_list(), [75, 90, 105])
+        self.assertAlmostEqual(transport.compute_duration().mean, 7.5*wd)
+        costs = transport.compare_fleets([[1, 10], [2, 10], [2, 20]])
+        np.testing.assert_allclose(costs.magnitude[1], [0.009, 0.00525, 0.009])
+        self.assertEqual(costs.units, ureg.work_day/ureg.kilogram)
+        # A single leg is a TransportActivity
+        transport.legs = transport.legs[1:]
+        transport.legs[0].fleet_size = 1
+        single = TransportActivity('Stones', BQ_(10000*kg), BQ_(25*kg), BQ_(2*kph),
+                                   BQ_(4*kph), BQ_(1000*m))
+        np.testing.assert_allclose(transport.compute_total_cost().as_list(),
+                                   single.compute_total_cost().as_list())
+        elem = transport.export_to_xml()
+        self.assertEqual(len(elem.findall('Carrier')), 2)
+        self.assertEqual(create_object_from_xml_element(elem).legs[0].carrier.name,
+                         'Porter')
+        # Undefined values are not exported
+        transport.carriers.append(Carrier('Cart'))
+        elem = transport.export_to_xml()
+        self.assertNotIn('capacity', elem.findall('Carrier')[2].attrib)
+        self.assertIsNone(create_object_from_xml_element(elem).carriers[2].capacity)
+        # The carriers and legs are parameters
+        param = find_parameter(transport, 'Stones/Legs[0].distance')
+        param.value = BQ_(2000*m)
+        np.testing.assert_allclose(transport.compute_total_cost().as_list(),
+                                   2*np.array(single.compute_total_cost().as_list()))
+        self.assertEqual(find_parameter(transport, 'Stones/Carriers[0].capacity').value,
+                         BQ_(1000*kg))
+    
+    def test_monte_carlo(self):
+        site = Site('Site')
+        house = Building('House', Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m, (2, 4))),
+                         count=2)
+        site.inputs.append(house)
+        filling = ProductionActivity('Filling')
+        filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+        house.inputs.append(LQVI(house, filling, 'fill_volume'))
+        with tempfile.TemporaryDirectory() as directory:
+            run = MonteCarlo(site, os.path.join(directory, 'a'), 5000, chunk_size=1000)
+            self.assertFalse(run.run(max_chunks=2))
+            # Resumed from the checkpoint
+            run = MonteCarlo(site, os.path.join(directory, 'a'), 5000, chunk_size=1000)
+            self.assertEqual(run.done_chunks, 2)
+            self.assertTrue(run.run())
+            self.assertEqual(run.paths, ['Site', 'Site/House', 'Site/House/Filling'])
+            other = MonteCarlo(site, os.path.join(directory, 'b'), 5000, chunk_size=1000)
+            other.run()
+            np.testing.assert_array_equal(run.samples, other.samples)
+            samples = run.node_samples('Site')
+            np.testing.assert_allclose(samples, 2*run.node_samples('Site/House/Filling'))
+            self.assertAlmostEqual(samples.mean(), 240, delta=5)
+            quantiles = run.quantiles((0.1, 0.9))['Site'].magnitude
+            np.testing.assert_allclose(quantiles, np.quantile(samples, (0.1, 0.9)),
+                                       rtol=0.02)
+            with self.assertRaises(ValueError):
+                MonteCarlo(site, os.path.join(directory, 'a'), 6000)
+            # Same results with worker processes, resumed with another number
+            parallel = ParallelMonteCarlo(site, os.path.join(directory, 'c'), 5000,
+                                          chunk_size=1000, max_workers=2)
+            parallel.run(max_chunks=2)
+            parallel = ParallelMonteCarlo(site, os.path.join(directory, 'c'), 5000,
+                                          chunk_size=1000, max_workers=3)
+            self.assertTrue(parallel.run())
+            np.testing.assert_array_equal(run.samples, parallel.samples)
+        self.assertIsInstance(filling.marginal_cost, BQ_)
+    
+    def test_monte_carlo_tables(self):
+        def house(cost):
+            return create_object_from_xml_element(ET.fromstring(
+                '<Building name="House"><Inputs><LinearInput target_amount="fill_volume">'
+                '<TabulatedActivity name="Filling">'
+                '<Point amount="0 meter ** 3" cost="0 work_day"/>'
+                '<Point amount="100 meter ** 3" cost="{}"/>'
+                '</TabulatedActivity></LinearInput>'
+                '<TabulatedInput target_amount="fill_volume">'
+                '<Point target="0 meter ** 3" amount="0 kilogram"/>'
+                '<Point target="100 meter ** 3" amount="1000.0004 kilogram"/>'
+                '<FleetTransportActivity name="Stones">'
+                '<Carrier name="Boat" capacity="1000 kilogram" speed_loaded="4.0004 kph" '
+                'speed_empty="4 kph" loading_time="1 hour" unloading_time="1 hour" crew="2"/>'
+                '<Leg carrier="Boat" distance="8 kilometer, [6 ; 10]"/>'
+                '</FleetTransportActivity></TabulatedInput></Inputs><Shape>'
+                '<Cuboid length="5 meter" width="4 meter" height="3 meter, [2 ; 4]"/>'
+                '</Shape></Building>'.format(cost)))
+        with tempfile.TemporaryDirectory() as directory:
+            run = MonteCarlo(house('100 work_day'), os.path.join(directory, 'a'), 4000,
+                             chunk_size=1000)
+            self.assertEqual([p.path for p in run.parameters if p.value.lower != p.value.upper],
+                             ['House/Shape.height', 'House/Stones/Legs[0].distance'])
+            run.run()
+            # 60 m3 of filling, 10 kg of stones per m3, 12 worker hours per
+            # 1000 kg at 8 km
+            self.assertAlmostEqual(run.node_samples('House/Filling').mean(), 60, delta=0.5)
+            self.assertAlmostEqual(run.node_samples('House/Stones').mean(), 0.9, delta=0.01)
+            # The workers evaluate the exact values, not rounded by an XML export
+            parallel = ParallelMonteCarlo(run.root, os.path.join(directory, 'c'), 4000,
+                                          chunk_size=1000, max_workers=2)
+            parallel.run()
+            np.testing.assert_array_equal(run.samples, parallel.samples)
+            with self.assertRaises(ValueError):
+                MonteCarlo(house('100 work_day, [80 ; 120]'), os.path.join(directory, 'b'),
+                           4000)
+    
+    def test_spatial_index(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(0, 100, (50, 2))
+        queries = rng.uniform(-20, 120, (200, 2))
+        index = GridIndex(points)
+        distances = np.hypot(*(queries[:, None, :] - points[None, :, :]).T).T
+        nearest, nearest_distances = index.nearest(queries)
+        np.testing.assert_array_equal(nearest, distances.argmin(axis=1))
+        np.testing.assert_allclose(nearest_distances, distances.min(axis=1))
+        within = index.within_radius(queries[0], 30)
+        self.assertEqual(sorted(within), list(np.nonzero(distances[0] <= 30)[0]))
+        self.assertTrue((np.diff(distances[0][within]) >= 0).all())
+    
+    def test_locate_transports(self):
+        site = Site('Site', sources=[Source('North quarry', (0*m, 100*m)),
+                                     Source('South quarry', (0*m, -100*m)),
+                                     Source('Clay pit', (500*m, 0*m), 'Clay')])
+        for name, location in (('A', (0*m, 80*m)), ('B', (0*m, -30*m)), ('C', None)):
+            building = Building(name, Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m)),
+                                location=location)
+            site.inputs.append(building)
+            for material in ('Earth', 'Clay'):
+                transport = TransportActivity(material, BQ_(1000*kg), BQ_(50*kg),
+                                              BQ_(2*kph), BQ_(5*kph))
+                transport.resource = 'Clay' if material == 'Clay' else ''
+                building.inputs.append(transport)
+        self.assertEqual(locate_transports(site), 4)
+        a, b, c = [building.inputs for building in site.inputs]
+        self.assertEqual(a[0].source, (0*m, 100*m))
+        self.assertEqual(a[0].destination, (0*m, 80*m))
+        self.assertAlmostEqual(a[0].distance.mean, 20*m)
+        self.assertAlmostEqual(b[0].distance.mean, 70*m)
+        self.assertEqual(b[1].source, (500*m, 0*m))
+        self.assertIsNone(c[0].source)
+        # Activities with a source are kept
+        self.assertEqual(locate_transports(site), 0)
+        loaded = create_object_from_xml_element(site.export_to_xml())
+        self.assertEqual([s.resource for s in loaded.sources],
+                         ['North quarry', 'South quarry', 'Clay'])
+        self.assertEqual(loaded.inputs[1].location, (0*m, -30*m))
+    
+    def test_leontief(self):
+        site = Site('Site')
+        house = Building('House', Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m)),
+                         count=2)
+        site.inputs.append(house)
+        filling = ProductionActivity('Filling')
+        filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+        filling.fixed_cost = BQ_(5*wd)
+        house.inputs.append(LQVI(house, filling, 'fill_volume'))
+        transport = ProductionActivity('Transport')
+        transport.marginal_cost = BQ_(1*wd/m3)
+        filling.inputs.append(LQVI(filling, transport, fixed_amount=BQ_(10*m3)))
+        cost = InputOutputModel(site).evaluate()
+        np.testing.assert_allclose(cost.as_list(),
+                                   site.compute_total_cost().as_list())
+        # Transport needs tools, whose making needs transport
+        cyclic = create_object_from_xml_element(ET.fromstring(
+            '<Site name="Site"><Inputs><Building name="House"><Inputs>'
+            '<LinearInput target_amount="fill_volume">'
+            '<ProductionActivity name="Filling" '
+            'marginal_cost="2 work_day / meter ** 3"><Inputs><LinearInput>'
+            '<ProductionActivity name="Transport" '
+            'marginal_cost="1 work_day / meter ** 3"><Inputs>'
+            '<LinearInput marginal_amount="0.1 kilogram / meter ** 3">'
+            '<ProductionActivity name="Tools" marginal_cost="1 work_day / kilogram">'
+            '<Inputs><LinearInput marginal_amount="2 meter ** 3 / kilogram" '
+            'ref="Transport"/></Inputs></ProductionActivity></LinearInput>'
+            '</Inputs></ProductionActivity></LinearInput></Inputs>'
+            '</ProductionActivity></LinearInput></Inputs><Shape>'
+            '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+            '</Shape></Building></Inputs></Site>'))
+        model = InputOutputModel(cyclic)
+        self.assertAlmostEqual(model.evaluate().mean, 202.5*wd)
+        tools = model.sectors[model.index(
+            cyclic.inputs[0].inputs[0].input_valuable.inputs[0].input_valuable
+            .inputs[0].input_valuable)]
+        self.assertEqual(tools.name, 'Tools')
+        self.assertAlmostEqual(tools.amount.mean, 7.5*kg)
+        # Several scenarios at once: doubling the demand doubles the costs
+        demands = np.stack([model.demand[1], 2*model.demand[1]], axis=1)
+        np.testing.assert_allclose(model.compute_total_costs(demands), [202.5, 405])
+        loaded = create_object_from_xml_element(cyclic.export_to_xml())
+        self.assertAlmostEqual(InputOutputModel(loaded).evaluate().mean, 202.5*wd)
+        # The tree evaluations refuse the cycle
+        with self.assertRaisesRegex(ValueError, 'InputOutputModel'):
+            cyclic.compute_total_cost(quiet=True)
+        # A transport has a marginal cost before any amount is set
+        fresh = create_object_from_xml_element(ET.fromstring(
+            '<Site name="Site"><Inputs><Building name="House"><Inputs>'
+            '<LinearInput target_amount="fill_volume" marginal_amount="2 kilogram / meter ** 3">'
+            '<TransportActivity name="Earth" amount_per_travel="20 kilogram" '
+            'speed_loaded="2 kph" speed_empty="4 kph" distance="1 kilometer"/>'
+            '</LinearInput></Inputs><Shape>'
+            '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+            '</Shape></Building></Inputs></Site>'))
+        cost = InputOutputModel(fresh).evaluate()
+        self.assertAlmostEqual(cost.mean, 0.5625*wd)
+        np.testing.assert_allclose(cost.as_list(),
+                                   fresh.compute_total_cost(quiet=True).as_list())
+        with self.assertRaisesRegex(ValueError, 'InputOutputModel'):
+            aggregate(cyclic)
+    
+    def test_schedule(self):
+        site = Site('Site')
+        house = Building('House', Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m)),
+                         count=2)
+        site.inputs.append(house)
+        filling = ProductionActivity('Filling')
+        filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+        house.inputs.append(LQVI(house, filling, 'fill_volume'))
+        transport = ProductionActivity('Transport')
+        transport.marginal_cost = BQ_(1*wd/m3)
+        filling.inputs.append(LQVI(filling, transport))
+        tasks = build_tasks(site)
+        self.assertEqual([t.name for t in tasks],
+                         ['Site/House #2/Filling/Transport', 'Site/House #2/Filling',
+                          'Site/House #2', 'Site/House #1/Filling/Transport',
+                          'Site/House #1/Filling', 'Site/House #1', 'Site'])
+        self.assertEqual(sum(t.work for t in tasks), 360)
+        length, path = critical_path(tasks)
+        self.assertEqual(length, 180*wd)
+        self.assertEqual(path[-1].name, 'Site')
+        self.assertEqual(schedule(tasks, 1), 360*wd)
+        self.assertEqual(sweep_workforce(tasks, [2, 4], team_size=2),
+                         [(2, 180*wd), (4, 90*wd)])
+        self.assertEqual(tasks[-1].finish, 90)
+        self.assertEqual(build_tasks(site, 'upper')[1].work, 180)
+    
+    def test_region(self):
+        site = ('<Site><Inputs><Building name="House" count="{0}"><Inputs>'
+                '<LinearInput target_amount="fill_volume">'
+                '<ProductionActivity marginal_cost="2 work_day / meter ** 3" '
+                'name="Filling" resource="Quarry"/></LinearInput></Inputs>'
+                '<Shape><Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+                '</Shape></Building></Inputs></Site>')
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(1, 4):
+                with open(os.path.join(directory, 'site{}.xml'.format(i)), 'w') as f:
+                    f.write(site.format(i))
+            with open(os.path.join(directory, 'Region.xml'), 'w') as f:
+                f.write('<Region name="Valley">'
+                        '<Resource name="Quarry" capacity="300 meter ** 3"/>'
+                        '<Site file="site1.xml"/><Site file="site2.xml"/>'
+                        '<Site file="site3.xml"/></Region>')
+            region = load_region(os.path.join(directory, 'Region.xml'))
+            self.assertEqual(len(region.sites), 3)
+            serial = region.evaluate(max_workers=1)
+            report = region.evaluate(max_workers=2)
+        for r in (serial, report):
+            self.assertEqual(list(r.site_costs.values()),
+                             [BQ_(120.*wd), BQ_(240.*wd), BQ_(360.*wd)])
+            self.assertEqual(r.total_cost, BQ_(720.*wd))
+            self.assertEqual(r.resources['Quarry'].amount, BQ_(360.*m3))
+            self.assertEqual(r.resources['Quarry'].cost, BQ_(720.*wd))
+            self.assertTrue(r.resources['Quarry'].is_over_capacity())
+        # The quiet evaluation gives the same cost as compute_total_cost
+        site = create_object_from_xml_element(ET.fromstring(site.format(2)))
+        self.assertEqual(evaluate_site(site)[0], site.compute_total_cost())
+        # Instances counts and parents of the valuables
+        self.assertEqual([(item.name, count, parent) for item, _, count, parent
+                          in iter_evaluation(site)],
+                         [('', 1, -1), ('House', 2, 0), ('Filling', 2, 1)])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            evaluate_site(site)
+            site.compute_total_cost(quiet=True)
+            self.assertEqual(output.getvalue(), '')
+            site.compute_total_cost()
+        self.assertIn('Fill volume', output.getvalue())
+    
+    def test_cache(self):
+        def make_site(height):
+            site = Site('Site')
+            for name, h in (('House', 3*m), ('Tower', height)):
+                house = Building(name, Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(h)))
+                filling = ProductionActivity('Filling')
+                filling.marginal_cost = BQ_(2*wd/m3)
+                house.inputs.append(LQVI(house, filling, 'fill_volume'))
+                site.inputs.append(house)
+            return site
+        old, new = make_site(6*m), make_site(9*m)
+        self.assertEqual(cache.diff(old, make_site(6*m)), [])
+        self.assertEqual(cache.diff(old, new), [('Site/Tower/shape', 'changed')])
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cache.sqlite')
+            with cache.ResultCache(filename) as results:
+                self.assertEqual(cache.compute_total_cost(old, results), BQ_(360.*wd))
+            with cache.ResultCache(filename) as results:
+                self.assertEqual(cache.compute_total_cost(new, results),
+                                 new.compute_total_cost())
+                # The house is not recomputed
+                house = cache.subtree_hashes(new)[id(new.inputs[0])]
+                self.assertIsNotNone(results.get('cost:' + house))
+                self.assertEqual(results.hits, 3)
+        # In-memory terrains are hashed by content
+        sites = [Site('Site', ElevationGrid(z))
+                 for z in (np.zeros((3, 3)), np.zeros((3, 3)), np.ones((3, 3)))]
+        hashes = [cache.subtree_hashes(s)[id(s)] for s in sites]
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertNotEqual(hashes[0], hashes[2])
+    
+    def test_inventory(self):
+        template = Building('House')
+        filling = ProductionActivity('Filling')
+        filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+        template.inputs.append(LQVI(template, filling, 'fill_volume'))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'inventory.csv')
+            with open(filename, 'w') as f:
+                f.write('name,shape,count,finish_thickness,length,width,height,'
+                        'height_min,height_max,diameter\n'
+                        'A,Cuboid,1,0.5,5,4,3,2,4,\n'
+                        'B,Cylinder,2,0.2,,,6,,,3\n'
+                        'C,Cuboid,,,5,4,6,,,\n')
+            inventory = BuildingInventory()
+            inventory.read_csv(filename, chunk_size=2)
+        self.assertEqual(list(inventory.tables), ['Cuboid', 'Cylinder'])
+        results = inventory.evaluate(template)
+        buildings = [Building('A', Cuboid(BQ_(0.5*m), BQ_(5*m), BQ_(4*m),
+                                          BQ_(3*m, (2, 4)))),
+                     Building('B', Cylinder(BQ_(0.2*m), BQ_(3*m), BQ_(6*m)), count=2),
+                     Building('C', Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(6*m)))]
+        total = 0
+        for building in buildings:
+            building.inputs.append(LQVI(building, filling, 'fill_volume'))
+            total = total + evaluate_site(building)[0]
+        cost = results.compute_total_cost()
+        self.assertAlmostEqual(cost.mean, total.mean)
+        self.assertAlmostEqual(cost.lower, total.lower)
+        self.assertAlmostEqual(cost.upper, total.upper)
+        geom = io.StringIO()
+        results.write_geom_csv(geom)
+        rows = geom.getvalue().splitlines()
+        self.assertEqual(rows[0].split(','), Building.make_geom_csv_header())
+        for row, building in zip(rows[1:], buildings):
+            values = [float(v) for v in row.split(',')[1:]]
+            for value, expected in zip(values, building.format_geom_data()[1:]):
+                self.assertAlmostEqual(value, expected)
+        costs = io.StringIO()
+        results.write_cost_csv(costs)
+        self.assertEqual(costs.getvalue().splitlines()[1:3],
+                         ['A', 'Filling,4.0,33.0,62.0,4.0,66.0,186.0'])
+    
+    def test_server(self):
+        server = EvaluationServer(('127.0.0.1', 0), max_models=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        def request(path, data=None):
+            with urllib.request.urlopen(url + path, data) as response:
+                return json.loads(response.read().decode())
+        try:
+            xml = ('<Site name="Site"><Inputs><Building name="House"><Inputs>'
+                   '<LinearInput target_amount="fill_volume">'
+                   '<ProductionActivity marginal_cost="2 work_day / meter ** 3" '
+                   'name="Filling"/></LinearInput></Inputs><Shape>'
+                   '<Cuboid length="5 meter" width="4 meter" height="3 meter"/>'
+                   '</Shape></Building></Inputs></Site>')
+            model = request('/models', xml.encode())
+            self.assertEqual(model['cost']['mean'], 120)
+            overrides = {'model': model['model'],
+                         'overrides': {'Site/House/Shape.height': '6 meter, [5 ; 7]'}}
+            result = request('/evaluate', json.dumps(overrides).encode())
+            self.assertEqual((result['cost']['mean'], result['cost']['upper']),
+                             (240, 280))
+            # The cached model is unchanged
+            parameters = request('/models/{}/parameters'.format(model['model']))
+            self.assertEqual(parameters['Site/House/Shape.height']['mean'], 3)
+            overrides['overrides'] = {'Site/House/Shape.depth': '1 meter'}
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                request('/evaluate', json.dumps(overrides).encode())
+            self.assertEqual(error.exception.code, 404)
+            # Other errors of the model are reported too
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                request('/models', xml.replace('2 work_day', '2 / 0 work_day').encode())
+            self.assertEqual(error.exception.code, 500)
+            with error.exception as response:
+                self.assertIn('ZeroDivisionError',
+                              json.loads(response.read().decode())['error'])
+            # The failed model did not evict the first one. Numbers are in
+            # the units of the parameter.
+            overrides['overrides'] = {'Site/House/Shape.height': 6}
+            result = request('/evaluate', json.dumps(overrides).encode())
+            self.assertEqual(result['cost']['mean'], 240)
+            overrides['overrides'] = {'Site/House/Shape.height': [6]}
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                request('/evaluate', json.dumps(overrides).encode())
+            self.assertEqual(error.exception.code, 400)
+            # The first model is evicted by a second one
+            request('/models', xml.replace('3 meter', '4 meter').encode())
+            with self.assertRaises(urllib.error.HTTPError):
+                request('/evaluate', json.dumps({'model': model['model']}).encode())
+            metrics = request('/metrics')
+            self.assertEqual(metrics['endpoints']['/evaluate']['requests'], 5)
+            self.assertEqual(metrics['endpoints']['/models']['errors'], 1)
+            self.assertEqual(metrics['cache']['models'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+    
+    def test_aggregate(self):
+        filling = ('<LinearInput target_amount="fill_volume">'
+                   '<ProductionActivity name="Filling" '
+                   'marginal_cost="2 work_day / meter ** 3"/></LinearInput>')
+        plastering = ('<LinearInput target_amount="top_finish_area" '
+                      'marginal_amount="3 kilogram / meter ** 2">'
+                      '<ProductionActivity name="Plastering" '
+                      'marginal_cost="0.5 work_day / kilogram"/></LinearInput>')
+        shape = '<Shape><Cuboid length="5 meter" width="4 meter" height="3 meter"/></Shape>'
+        site = create_object_from_xml_element(ET.fromstring(
+            '<Site name="Site"><Inputs>'
+            '<Building name="A" count="2"><Inputs>' + filling + plastering +
+            '</Inputs>' + shape + '</Building>'
+            '<Building name="B"><Inputs>' + filling + '</Inputs>' + shape +
+            '</Building></Inputs></Site>'))
+        aggregates = aggregate(site)
+        self.assertEqual(aggregates.total_cost, site.compute_total_cost())
+        by_building = aggregates.pivot(('building',), ('name',))
+        self.assertEqual(by_building[('A',)][('Filling',)], BQ_(240.*wd))
+        self.assertEqual(by_building[('A',)][('Plastering',)], BQ_(60.*wd))
+        self.assertEqual(by_building[('B',)][('Filling',)], BQ_(120.*wd))
+        amounts = aggregates.pivot(('dimension',), value='amount')
+        self.assertEqual(amounts[('[mass]',)][()], BQ_(120.*kg))
+        self.assertEqual(amounts[('[length] ** 3',)][()], BQ_(180.*m3))
+        with self.assertRaises(ValueError):
+            aggregates.pivot(('name',), value='amount')
+        output = io.StringIO()
+        aggregates.write_csv(output, ('name',))
+        self.assertIn('Plastering,[mass],kilogram,120.0,120.0,120.0,60.0,60.0,60.0',
+                      output.getvalue().splitlines())
+
+    def test_query(self):
+        filling = ('<LinearInput target_amount="fill_volume">'
+                   '<ProductionActivity name="Filling" '
+                   'marginal_cost="2 work_day / meter ** 3"/></LinearInput>')
+        plastering = ('<LinearInput target_amount="top_finish_area" '
+                      'marginal_amount="3 kilogram / meter ** 2">'
+                      '<ProductionActivity name="Plastering" '
+                      'marginal_cost="0.5 work_day / kilogram"/></LinearInput>')
+        shape = '<Shape><Cuboid length="5 meter" width="4 meter" height="3 meter"/></Shape>'
+        site = create_object_from_xml_element(ET.fromstring(
+            '<Site name="Site"><Inputs>'
+            '<Building name="A" count="2"><Inputs>' + filling + plastering +
+            '</Inputs>' + shape + '</Building>'
+            '<Building name="B"><Inputs>' + filling + '</Inputs>' + shape +
+            '</Building></Inputs></Site>'))
+        self.assertEqual([r.path for r in select(site, 'Site/*/Filling')],
+                         ['Site/A/Filling', 'Site/B/Filling'])
+        # Only the ancestors of the selected valuables are evaluated
+        other = site.inputs[1].inputs[0].input_valuable
+        other.amount = None
+        self.assertEqual(total(site, 'Plastering'), BQ_(60.*wd))
+        self.assertEqual(total(site, 'Plastering', 'amount'), BQ_(120.*kg))
+        self.assertIsNone(other.amount)
+        self.assertEqual(total(site, '**/Fill*'), BQ_(360.*wd))
+        self.assertEqual(next(select(site, 'Site/B')).get('fill_volume'), BQ_(60.*m3))
+        self.assertEqual(total(site, 'Site/A', 'total_cost'), BQ_(300.*wd))
+        self.assertEqual(total(site, 'Site', 'total_cost'), site.compute_total_cost())
+        self.assertEqual(total(site, 'Site/C'), 0)
+        # References are not followed, even forming a cycle
+        cyclic = create_object_from_xml_element(ET.fromstring(
+            '<Site name="Site"><Inputs><ProductionActivity name="Transport">'
+            '<Inputs><LinearInput><ProductionActivity name="Tools"><Inputs>'
+            '<LinearInput ref="Transport"/></Inputs></ProductionActivity>'
+            '</LinearInput></Inputs></ProductionActivity></Inputs></Site>'))
+        self.assertEqual([r.path for r in select(cyclic, 'T*')],
+                         ['Site/Transport', 'Site/Transport/Tools'])
+
+    def test_incremental(self):
+        site = Site('Site')
+        for name in ('A', 'B', 'C'):
+            house = Building(name, Cuboid(0*m, BQ_(5*m), BQ_(4*m), BQ_(3*m, (2, 4))),
+                             count=2)
+            filling = ProductionActivity('Filling')
+            filling.marginal_cost = BQ_(2*wd/m3, (1, 3))
+            house.inputs.append(LQVI(house, filling, 'fill_volume'))
+            transport = ProductionActivity('Transport')
+            transport.marginal_cost = BQ_(1*wd/m3)
+            filling.inputs.append(LQVI(filling, transport))
+            site.inputs.append(house)
+        evaluation = IncrementalEvaluation(site)
+        self.assertEqual(evaluation.total_cost(), site.compute_total_cost())
+        b = evaluation.paths.index('Site/B')
+        height, = [p for p in evaluation.node_parameters(b) if p.attribute == 'height']
+        evaluation.set_parameter(height, BQ_(6*m, (5, 7)))
+        # Only the building and its inputs are evaluated again
+        self.assertEqual(evaluation.update(), 3)
+        self.assertEqual(evaluation.total_cost(b), BQ_(720.*wd, (400, 1120)))
+        self.assertEqual(evaluation.total_cost(), site.compute_total_cost())
+        transport = evaluation.paths.index('Site/C/Filling/Transport')
+        cost, = [p for p in evaluation.node_parameters(transport)
+                 if p.attribute == '_marginal_cost']
+        evaluation.set_parameter(cost, BQ_(2*wd/m3))
+        self.assertEqual(evaluation.update(), 1)
+        self.assertEqual(evaluation.total_cost(), site.compute_total_cost())
+        cyclic = create_object_from_xml_element(ET.fromstring(
+            '<ProductionActivity name="Transport"><Inputs><LinearInput>'
+            '<ProductionActivity name="Tools"><Inputs><LinearInput ref="Transport"/>'
+            '</Inputs></ProductionActivity></LinearInput></Inputs></ProductionActivity>'))
+        with self.assertRaisesRegex(ValueError, 'InputOutputModel'):
+            IncrementalEvaluation(cyclic)
 
 
 class TestGeometry(unittest.TestCase):
@@ -253,3 +1146,115 @@ class TestGeometry(unittest.TestCase):
         vol = pyr.compute_total_volume()
         self.assertEqual(walls_area, BQ_(4.*m**2))
         self.assertEqual(vol, BQ_(1.*m**3))
+    
+    def test_tight_bounds(self):
+        pyr = TruncatedPyramid(BQ_(0.5*m, (0.4, 0.6)), BQ_(30*m, (28, 32)),
+                               BQ_(20*m, (18, 22)), BQ_(10*m, (8, 12)),
+                               BQ_(5*m, (4, 6)), BQ_(10*m, (9, 11)))
+        naive = pyr.compute_total_volume()
+        pyr.tight_bounds = True
+        tight = pyr.compute_total_volume()
+        corners = [TruncatedPyramid(0*m, *(v*m for v in c)).compute_total_volume().magnitude
+                   for c in itertools.product((28, 32), (18, 22), (8, 12),
+                                              (4, 6), (9, 11))]
+        self.assertEqual(tight.mean, naive.mean)
+        self.assertAlmostEqual(tight.lower, min(corners))
+        self.assertAlmostEqual(tight.upper, max(corners))
+        self.assertGreater(tight.lower, naive.lower)
+        # Interval subdivision encloses the exact range
+        lower, upper = bounds.subdivision_extrema(pyr, 'compute_total_volume',
+                                                  bounds.bounded_parameters(pyr),
+                                                  tight.units)
+        self.assertLessEqual(lower, tight.lower)
+        self.assertGreaterEqual(upper, tight.upper)
+        self.assertAlmostEqual(lower, tight.lower, delta=0.01*tight.lower)
+        # Overlapping bottom and top widths: the slant height is minimal
+        # inside the box, where the corners miss it
+        pyr = TruncatedPyramid(BQ_(0.1*m), BQ_(20*m, (19, 21)), BQ_(10*m, (9, 11)),
+                               BQ_(20*m), BQ_(11*m, (10, 12)), BQ_(1*m))
+        pyr.tight_bounds = True
+        walls = pyr.compute_walls_finish_area()
+        samples = [TruncatedPyramid(0*m, L*m, W*m, 20*m, w*m, 1*m)
+                   .compute_walls_finish_area().magnitude
+                   for L, W, w in itertools.product((19, 20, 21), np.linspace(9, 11, 9),
+                                                    np.linspace(10, 12, 9))]
+        self.assertLessEqual(walls.lower, min(samples))
+        self.assertGreaterEqual(walls.upper, max(samples))
+        # Extrema found on a fine grid
+        self.assertAlmostEqual(walls.lower, 59.849, delta=0.01)
+        self.assertAlmostEqual(walls.upper, 97.393, delta=0.01)
+        # Division by an interval containing 0 is unbounded
+        ratio = bounds._Intervals([1.], [2.])/bounds._Intervals([-1.], [1.])
+        self.assertEqual((ratio.lower[0], ratio.upper[0]), (-np.inf, np.inf))
+    
+    def test_mesh_shape(self):
+        vertices = np.array([[0, 0, 0], [2, 0, 0], [2, 3, 0], [0, 3, 0],
+                             [0, 0, 4], [2, 0, 4], [2, 3, 4], [0, 3, 4]])
+        quads = [[1, 4, 3, 2], [5, 6, 7, 8], [1, 2, 6, 5],
+                 [2, 3, 7, 6], [3, 4, 8, 7], [4, 1, 5, 8]]
+        triangles = np.array([[q[0], q[i], q[i+1]] for q in quads
+                              for i in (1, 2)]) - 1
+        with tempfile.TemporaryDirectory() as directory:
+            obj = os.path.join(directory, 'cube.obj')
+            with open(obj, 'w') as f:
+                f.writelines('v {} {} {}\n'.format(*v) for v in vertices)
+                f.writelines('f {} {} {} {}\n'.format(*q) for q in quads)
+            ply = os.path.join(directory, 'cube.ply')
+            with open(ply, 'wb') as f:
+                f.write('ply\nformat binary_little_endian 1.0\n'
+                        'element vertex 8\nproperty double x\n'
+                        'property double y\nproperty double z\n'
+                        'element face 12\n'
+                        'property list uchar int vertex_indices\n'
+                        'end_header\n'.encode('ascii'))
+                f.write(vertices.astype('<f8').tobytes())
+                faces = np.zeros(12, dtype=[('n', 'u1'), ('i', '<i4', 3)])
+                faces['n'] = 3
+                faces['i'] = triangles
+                f.write(faces.tobytes())
+            for filename in (obj, ply):
+                shape = MeshShape(filename=filename)
+                self.assertAlmostEqual(shape.compute_total_volume().mean, 24*m3)
+                self.assertAlmostEqual(shape.compute_walls_finish_area().mean, 40*m2)
+                self.assertAlmostEqual(shape.compute_top_finish_area().mean, 6*m2)
+            # Tight bounds: only the finish thickness is a parameter
+            shape = MeshShape(BQ_(0.1*m, (0.05, 0.2)), obj)
+            shape.tight_bounds = True
+            volume = shape.compute_finish_volume()
+            self.assertAlmostEqual(volume.mean, 4*m3)
+            self.assertAlmostEqual(volume.lower, 2)
+            self.assertAlmostEqual(volume.upper, 8)
+            self.assertEqual(shape.compute_top_finish_area(), BQ_(6.*m2))
+            # Gradient of a cost: the top angle only classifies the faces
+            house = Building('House', MeshShape(BQ_(0.1*m), obj))
+            plaster = ProductionActivity('Plaster')
+            plaster.marginal_cost = BQ_(2*wd/m3)
+            house.inputs.append(LQVI(house, plaster, 'finish_volume'))
+            cost, gradients = compute_gradient(house)
+            self.assertAlmostEqual(cost, 8*wd)
+            self.assertAlmostEqual(gradients['House/Shape.finish_thickness'], 80*wd/m)
+            self.assertAlmostEqual(gradients['House/Shape.top_angle'].magnitude, 0)
+    
+    def test_csg(self):
+        cube = Placed(Cuboid(0*m, BQ_(4*m, (3, 5)), 4*m, 4*m))
+        shifted = Placed(Cuboid(0*m, 4*m, 4*m, 4*m), (2*m, 0*m, 0*m))
+        self.assertEqual(Union([cube, shifted]).compute_volume(), 96)
+        self.assertEqual(Intersection([cube, shifted]).compute_volume(), 32)
+        difference = Difference(cube, [shifted]).compute_total_volume()
+        self.assertEqual(difference.as_list(), [24, 32, 40])
+        # Disjoint solids and a solid inside another one are exact
+        far = Placed(Cylinder(0*m, 2*m, 1*m), (10*m, 0*m, 0*m), 30*ureg.degree)
+        self.assertAlmostEqual(Union([cube, far]).compute_volume(), 64 + np.pi)
+        small = Placed(Cuboid(0*m, 1*m, 1*m, 1*m), (0*m, 0*m, 1*m))
+        self.assertEqual(Intersection([cube, small]).compute_volume(), 1)
+        # A phase sticking out of the building and two overlapping phases
+        house = Building('House', Cuboid(0*m, BQ_(10*m), BQ_(10*m), BQ_(4*m)))
+        house.substructures = [
+            Placed(Cuboid(0*m, 4*m, 4*m, 4*m), (5*m, 0*m, 0*m)),
+            Union([Placed(Cuboid(0*m, 2*m, 2*m, 2*m), (-2*m, 0*m, 0*m)),
+                   Placed(Cuboid(0*m, 2*m, 2*m, 2*m), (-1*m, 0*m, 0*m))])]
+        self.assertAlmostEqual(house.fill_volume.mean.magnitude, 400 - 32 - 12,
+                               delta=0.5)
+        loaded = create_object_from_xml_element(house.export_to_xml())
+        self.assertIsInstance(loaded.substructures[1], Union)
+        self.assertEqual(loaded.fill_volume, house.fill_volume)
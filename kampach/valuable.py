@@ -12,7 +12,7 @@
 from . import xmlio
 from abc import ABCMeta, abstractmethod
 import xml.etree.ElementTree as ET
-from .arithmetic import parse_quantity
+from .arithmetic import parse_quantity, PiecewiseLinear
 from pint.errors import UndefinedUnitError
 
 
@@ -49,17 +49,52 @@ class Valuable(metaclass=ABCMeta):
     def inputs(self, vals):
         self._inputs = vals
     
-    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                           quiet=False):
         """Computes the total cost of this valuable, including the cost of its
-        inputs.
+        inputs, scaled by its number of instances (count attribute) if any.
+        
+        The tree is walked with an explicit stack rather than by recursion,
+        so that the depth of a model is not limited by the Python stack.
+        A ValueError is raised if a valuable is one of its own inputs.
+        
+        :param quiet: don't print the report of the valuables
         """
-        cost = self.compute_own_cost(print_depth, geom_csv, cost_csv)
-        cost += sum(map(lambda i: i.compute_total_cost(print_depth+1, geom_csv, cost_csv), self.inputs))
-        return cost
+        # Frames of the valuables being evaluated:
+        # [valuable, own cost, sum of the inputs' costs, remaining inputs]
+        own_cost = self.compute_own_cost(print_depth, geom_csv, cost_csv, quiet)
+        stack = [[self, own_cost, 0, iter(self.inputs)]]
+        # Valuables being evaluated, to detect the cycles of references
+        active = {id(self)}
+        while True:
+            frame = stack[-1]
+            item = next(frame[3], None)
+            if item is None:
+                stack.pop()
+                active.discard(id(frame[0]))
+                cost = frame[1] + frame[2]
+                count = getattr(frame[0], 'count', 1)
+                if count != 1:
+                    cost = cost*count
+                if not stack:
+                    return cost
+                stack[-1][2] = stack[-1][2] + cost
+                continue
+            if id(getattr(item, 'input_valuable', item)) in active:
+                raise cycle_error(getattr(item, 'input_valuable', item))
+            if isinstance(item, QuantitativeValuableInput):
+                item.input_valuable.amount = item.compute_input_amount()
+                item = item.input_valuable
+            active.add(id(item))
+            own_cost = item.compute_own_cost(print_depth + len(stack), geom_csv,
+                                             cost_csv, quiet)
+            stack.append([item, own_cost, 0, iter(item.inputs)])
     
     @abstractmethod
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
-        """Computes the cost of this valuable without its inputs.
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
+        """Computes the cost of this valuable without its inputs, and prints
+        its report unless quiet.
         """
         pass
 
@@ -84,10 +119,59 @@ class Valuable(metaclass=ABCMeta):
             for i in inputs:
                 input_val = xmlio.create_object_from_xml_element(i)
                 self.inputs.append(input_val)
-                if isinstance(input_val, LinearQuantitativeValuableInput):
+                if isinstance(input_val, QuantitativeValuableInput):
                     input_val.target_valuable = self
 
 
+def cycle_error(valuable):
+    """Error of the evaluations of a tree in which valuable is one of its own
+    inputs, through references.
+    """
+    return ValueError('{!r} is one of its own inputs: cyclic models are '
+                      'evaluated by kampach.leontief.InputOutputModel'
+                      .format(valuable.name))
+
+
+def iter_evaluation(root, count=None):
+    """Evaluates root like compute_total_cost(), without printing, and yields
+    (valuable, own cost, count, parent) for all the valuables of the tree, in
+    evaluation order (pre-order). The amounts of the valuables are set when
+    they are yielded.
+    
+    The own cost is the cost of one instance, and count the number of
+    instances of the valuable: the product of the instances counts of the
+    valuable and of its ancestors. parent is the index of the parent of the
+    valuable in the evaluation order, -1 for root.
+    
+    :param count: instances count of root, its own by default
+    """
+    if count is None:
+        count = getattr(root, 'count', 1)
+    stack = [(root, 0, -1)]
+    # (valuable, count) from the root down to the current one, the valuables
+    # being also in active to detect the cycles
+    ancestors = []
+    active = set()
+    index = 0
+    while stack:
+        item, depth, parent = stack.pop()
+        valuable = getattr(item, 'input_valuable', item)
+        while len(ancestors) > depth:
+            active.discard(id(ancestors.pop()[0]))
+        if id(valuable) in active:
+            raise cycle_error(valuable)
+        if ancestors:
+            count = ancestors[-1][1]*getattr(valuable, 'count', 1)
+        ancestors.append((valuable, count))
+        active.add(id(valuable))
+        if isinstance(item, QuantitativeValuableInput):
+            valuable.amount = item.compute_input_amount()
+            item = valuable
+        yield item, item.compute_own_cost(quiet=True), count, parent
+        stack.extend((i, depth+1, index) for i in reversed(item.inputs))
+        index += 1
+
+
 class QuantitativeValuable(Valuable, metaclass=ABCMeta):
     """Abstract class representing an object having a proper cost related to
     its quantity.
@@ -95,9 +179,10 @@ class QuantitativeValuable(Valuable, metaclass=ABCMeta):
     Implementation classes must override compute_own_cost()
     """
     
-    def __init__(self, name='', amount=0):
+    def __init__(self, name='', amount=0, resource=''):
         super().__init__(name)
         self.amount = amount
+        self.resource = resource
     
     @property
     def amount(self):
@@ -105,10 +190,46 @@ class QuantitativeValuable(Valuable, metaclass=ABCMeta):
         """
         return self._amount
     
+    @property
+    def resource(self):
+        """Name of the resource (quarry, labour pool...) this valuable draws
+        on, shared between the sites of a region, or ''.
+        """
+        return self._resource
+    
     @amount.setter
     def amount(self, val):
         self._amount = val
+    
+    @resource.setter
+    def resource(self, val):
+        self._resource = val
+    
+    def export_to_xml(self, parent=None):
+        elem = super().export_to_xml(parent)
+        if self.resource:
+            elem.set('resource', self.resource)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        super().add_data_from_xml_element(elem)
+        if 'resource' in elem.attrib:
+            self.resource = elem.get('resource')
 
+    def print_cost(self, cost, print_depth=0, cost_csv=None):
+        """Prints the amount and cost of this valuable, and writes them to
+        cost_csv, if it has a name.
+        """
+        if self.name:
+            blank = " "*2*print_depth
+            print()
+            print(blank + self.name)
+            print(blank + '='*len(self.name))
+            print(blank + 'Amount: {}'.format(self.amount))
+            print(blank + 'Cost: {}'.format(cost))
+            if cost_csv:
+                cost_csv.writerow([self.name] + self.amount.as_list() + cost.as_list())
+    
     @staticmethod
     def make_cost_csv_header():
         return ['Name', 'Amount min', 'Amount int', 'Amount max',
@@ -119,7 +240,8 @@ class DefaultQuantitativeValuable(QuantitativeValuable):
     """Default implementation of QuantitativeValuable with null proper cost.
     """
     
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
         return 0
 
 
@@ -127,8 +249,9 @@ class LinearQuantitativeValuable(QuantitativeValuable):
     """Object having a proper cost linearly related to its quantity.
     """
     
-    def __init__(self, name='', amount=0, marginal_cost=1, fixed_cost=0):
-        super().__init__(name, amount)
+    def __init__(self, name='', amount=0, marginal_cost=1, fixed_cost=0,
+                 resource=''):
+        super().__init__(name, amount, resource)
         self.marginal_cost = marginal_cost
         self.fixed_cost = fixed_cost
     
@@ -152,17 +275,11 @@ class LinearQuantitativeValuable(QuantitativeValuable):
     def fixed_cost(self, val):
         self._fixed_cost = val
     
-    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
         cost = self.amount*self.marginal_cost + self.fixed_cost
-        if self.name:
-            blank = " "*2*print_depth
-            print()
-            print(blank + self.name)
-            print(blank + '='*len(self.name))
-            print(blank + 'Amount: {}'.format(self.amount))
-            print(blank + 'Cost: {}'.format(cost))
-            if cost_csv:
-                cost_csv.writerow([self.name] + self.amount.as_list() + cost.as_list())
+        if not quiet:
+            self.print_cost(cost, print_depth, cost_csv)
         return cost
     
     def export_to_xml(self, parent=None):
@@ -181,6 +298,58 @@ class LinearQuantitativeValuable(QuantitativeValuable):
             self.fixed_cost = parse_quantity(elem.get('fixed_cost'))
 
 
+def export_points(elem, function, x_name, y_name):
+    """Exports the points of a PiecewiseLinear as Point elements.
+    """
+    for x, y in function.points:
+        ET.SubElement(elem, 'Point', {x_name: str(x), y_name: str(y)})
+
+
+def load_points(elem, x_name, y_name):
+    """Loads a PiecewiseLinear from the Point elements of elem.
+    """
+    return PiecewiseLinear([(parse_quantity(p.get(x_name)),
+                             parse_quantity(p.get(y_name)))
+                            for p in elem.findall('Point')])
+
+
+class TabulatedQuantitativeValuable(QuantitativeValuable):
+    """Object having a proper cost given by a piecewise-linear function of
+    its quantity, e.g. for economies of scale.
+    """
+    
+    def __init__(self, name='', amount=0, cost_function=None, resource=''):
+        super().__init__(name, amount, resource)
+        self.cost_function = cost_function
+    
+    @property
+    def cost_function(self):
+        """PiecewiseLinear giving the cost of an amount of this valuable
+        object.
+        """
+        return self._cost_function
+    
+    @cost_function.setter
+    def cost_function(self, val):
+        self._cost_function = val
+    
+    def compute_own_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                         quiet=False):
+        cost = self.cost_function(self.amount)
+        if not quiet:
+            self.print_cost(cost, print_depth, cost_csv)
+        return cost
+    
+    def export_to_xml(self, parent=None):
+        elem = super().export_to_xml(parent)
+        export_points(elem, self.cost_function, 'amount', 'cost')
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        super().add_data_from_xml_element(elem)
+        self.cost_function = load_points(elem, 'amount', 'cost')
+
+
 class QuantitativeValuableInput(metaclass=ABCMeta):
     """Abstract class representing the input of a target valuable object.
     It used when the required amount of input is related to the target.
@@ -225,8 +394,31 @@ class QuantitativeValuableInput(metaclass=ABCMeta):
     def target_amount(self, val):
         self._target_amount = val
     
+    def get_target_amount(self):
+        """Returns the value of the target amount.
+        """
+        if isinstance(self.target_amount, str):
+            return getattr(self.target_valuable, self.target_amount)
+        return self.target_amount
+    
+    def load_target_amount(self, elem):
+        if 'target_amount' in elem.attrib.keys():
+            try:
+                # For custom target amount directly specified in XML file
+                self.target_amount = parse_quantity(elem.get('target_amount'))
+            except UndefinedUnitError:
+                # Normal behaviour
+                self.target_amount = elem.get('target_amount')
+    
+    @abstractmethod
+    def compute_input_amount(self):
+        """Computes the amount of input required by the target valuable.
+        """
+        pass
+    
     @abstractmethod
-    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
+    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                           quiet=False):
         """Computes the total cost of the input valuable.
         """
         pass
@@ -246,10 +438,12 @@ class LinearQuantitativeValuableInput(QuantitativeValuableInput):
     """
     
     def __init__(self, target_valuable=None, input_valuable=None,
-                 target_amount='amount', marginal_amount=1., fixed_amount=0.):
+                 target_amount='amount', marginal_amount=1., fixed_amount=0.,
+                 reference=False):
         super().__init__(target_valuable, input_valuable, target_amount)
         self.marginal_amount = marginal_amount
         self.fixed_amount = fixed_amount
+        self.reference = reference
     
     @property
     def marginal_amount(self):
@@ -263,22 +457,39 @@ class LinearQuantitativeValuableInput(QuantitativeValuableInput):
         """
         return self._fixed_amount
     
+    @property
+    def reference(self):
+        """Whether the input valuable is defined elsewhere in the model, and
+        referred to by its name (ref attribute in XML). References may form
+        cycles (e.g. tools needing transport needing tools), that only
+        kampach.leontief can evaluate.
+        """
+        return self._reference
+    
     @marginal_amount.setter
     def marginal_amount(self, val):
         self._marginal_amount = val
     
+    @reference.setter
+    def reference(self, val):
+        self._reference = val
+    
     @fixed_amount.setter
     def fixed_amount(self, val):
         self._fixed_amount = val
     
-    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None):
-        if isinstance(self.target_amount, str):
-            target_amount = getattr(self.target_valuable, self.target_amount)
-        else:
-            target_amount = self.target_amount
-        self.input_valuable.amount = target_amount*self.marginal_amount
-        self.input_valuable.amount += self.fixed_amount
-        return self.input_valuable.compute_total_cost(print_depth, geom_csv, cost_csv)
+    def compute_input_amount(self):
+        """Computes the amount of input required by the target valuable.
+        """
+        amount = self.get_target_amount()*self.marginal_amount
+        amount += self.fixed_amount
+        return amount
+    
+    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                           quiet=False):
+        self.input_valuable.amount = self.compute_input_amount()
+        return self.input_valuable.compute_total_cost(print_depth, geom_csv, cost_csv,
+                                                      quiet)
     
     def export_to_xml(self, parent):
         tag = xmlio.get_tag_from_class(type(self))
@@ -286,22 +497,74 @@ class LinearQuantitativeValuableInput(QuantitativeValuableInput):
         if self.marginal_amount != 1:
             elem.set('marginal_amount', str(self.marginal_amount))
         if self.target_amount != 'amount':
-            elem.set('target_amount', self.target_amount)
+            elem.set('target_amount', str(self.target_amount))
         if self.fixed_amount != 0:
             elem.set('fixed_amount', str(self.fixed_amount))
-        self.input_valuable.export_to_xml(elem)
+        if self.reference:
+            elem.set('ref', self.input_valuable.name)
+        else:
+            self.input_valuable.export_to_xml(elem)
         return elem
     
     def add_data_from_xml_element(self, elem):
-        if 'target_amount' in elem.attrib.keys():
-            try:
-                # For custom target amount directly specified in XML file
-                self.target_amount = parse_quantity(elem.get('target_amount'))
-            except UndefinedUnitError:
-                # Normal behaviour
-                self.target_amount = elem.get('target_amount')
+        self.load_target_amount(elem)
         if 'marginal_amount' in elem.attrib.keys():
             self.marginal_amount = parse_quantity(elem.get('marginal_amount'))
         if 'fixed_amount' in elem.attrib.keys():
             self.fixed_amount = parse_quantity(elem.get('fixed_amount'))
-        self.input_valuable = xmlio.create_object_from_xml_element(elem[0])
+        if 'ref' in elem.attrib:
+            self.reference = True
+            xmlio.resolve_reference(elem.get('ref'), self._set_input_valuable)
+        else:
+            self.input_valuable = xmlio.create_object_from_xml_element(elem[0])
+    
+    def _set_input_valuable(self, val):
+        self.input_valuable = val
+
+
+class TabulatedQuantitativeValuableInput(QuantitativeValuableInput):
+    """Input of a target valuable object. The required amount of input is
+    a piecewise-linear function of the target, e.g. the lifting effort
+    depending on the height.
+    """
+    
+    def __init__(self, target_valuable=None, input_valuable=None,
+                 target_amount='amount', amount_function=None):
+        super().__init__(target_valuable, input_valuable, target_amount)
+        self.amount_function = amount_function
+    
+    @property
+    def amount_function(self):
+        """PiecewiseLinear giving the amount required for a target amount.
+        """
+        return self._amount_function
+    
+    @amount_function.setter
+    def amount_function(self, val):
+        self._amount_function = val
+    
+    def compute_input_amount(self):
+        """Computes the amount of input required by the target valuable.
+        """
+        return self.amount_function(self.get_target_amount())
+    
+    def compute_total_cost(self, print_depth=0, geom_csv=None, cost_csv=None,
+                           quiet=False):
+        self.input_valuable.amount = self.compute_input_amount()
+        return self.input_valuable.compute_total_cost(print_depth, geom_csv, cost_csv,
+                                                      quiet)
+    
+    def export_to_xml(self, parent):
+        tag = xmlio.get_tag_from_class(type(self))
+        elem = ET.SubElement(parent, tag)
+        if self.target_amount != 'amount':
+            elem.set('target_amount', str(self.target_amount))
+        export_points(elem, self.amount_function, 'target', 'amount')
+        self.input_valuable.export_to_xml(elem)
+        return elem
+    
+    def add_data_from_xml_element(self, elem):
+        self.load_target_amount(elem)
+        self.amount_function = load_points(elem, 'target', 'amount')
+        valuables = [e for e in elem if e.tag != 'Point']
+        self.input_valuable = xmlio.create_object_from_xml_element(valuables[0])
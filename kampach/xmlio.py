@@ -10,11 +10,23 @@
 
 # Import all the classes that can be instantiated
 from .geometry import BuildingShape, Cuboid, Prism, Cylinder, TruncatedPyramid, Stairs, Superstructure
-from .site import Building, ProductionActivity, Site, SuperBuilding, TransportActivity
-from .valuable import LinearQuantitativeValuableInput
+from .mesh import MeshShape
+from .csg import Placed, Union, Intersection, Difference
+from .site import Building, ProductionActivity, Site, SuperBuilding, TransportActivity,\
+    TabulatedActivity, FleetTransportActivity
+from .valuable import QuantitativeValuableInput, LinearQuantitativeValuableInput,\
+    TabulatedQuantitativeValuableInput
+from .arithmetic import BoundedQuantity, FrozenBoundedQuantity
+from . import ureg
 
 import xml.etree.ElementTree as ET
 import xml.dom.minidom
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import hashlib
+import copy
+import os
 
 
 """List (XMLTagName, Class)
@@ -26,14 +38,26 @@ XML_NAMES = (('BuildingShape', BuildingShape),
              ('TruncatedPyramid', TruncatedPyramid),
              ('Stairs', Stairs),
              ('Superstructure', Superstructure),
+             ('MeshShape', MeshShape),
+             ('Placed', Placed),
+             ('Union', Union),
+             ('Intersection', Intersection),
+             ('Difference', Difference),
              ('Building', Building),
              ('SuperBuilding', SuperBuilding),
              ('ProductionActivity', ProductionActivity),
              ('Site', Site),
              ('TransportActivity', TransportActivity),
+             ('FleetTransportActivity', FleetTransportActivity),
+             ('TabulatedActivity', TabulatedActivity),
              ('LinearInput', LinearQuantitativeValuableInput),
+             ('TabulatedInput', TabulatedQuantitativeValuableInput),
              )
 
+"""Attributes naming a file, relative to the directory of their element
+"""
+FILE_ATTRIBUTES = ('href', 'file')
+
 
 def get_tag_from_class(cls):
     for tag, _cls in XML_NAMES:
@@ -48,9 +72,370 @@ def get_class_from_tag(tag):
     raise ValueError('Unrecognized XML tag: ' + tag)
 
 
+class SharingTable:
+    """Table used while loading a file to share identical objects
+    (hash-consing): elements with the same content give the same shape or
+    valuable object, and equal quantities are stored once.
+    
+    Inputs are never shared, because they refer to their target valuable.
+    The files referred to by the elements are identified by their absolute
+    path, so that identical elements in different directories are distinct.
+    """
+    
+    def __init__(self):
+        self.objects = {}
+        self.quantities = {}
+        self.digests = {}
+    
+    def digest(self, elem):
+        """Content hash of an XML element, including its children.
+        """
+        if elem not in self.digests:
+            # Reversed document order visits children before their parent
+            for e in reversed(list(elem.iter())):
+                if e in self.digests:
+                    continue
+                attrib = sorted((k, os.path.abspath(resolve_path(v))
+                                 if k in FILE_ATTRIBUTES else v)
+                                for k, v in e.attrib.items())
+                h = hashlib.sha1(repr((e.tag, attrib,
+                                       (e.text or '').strip())).encode())
+                for child in e:
+                    h.update(self.digests[child])
+                self.digests[e] = h.digest()
+        return self.digests[elem]
+    
+    def share_quantities(self, obj):
+        """Replace the quantities held by obj by their shared instance. The
+        quantities are shared when they have the same magnitude and units (a
+        meter is not shared with 100 centimeters), and the bounded quantities
+        are shared as frozen copies, unaltered by in-place operations.
+        """
+        for name, val in vars(obj).items():
+            if isinstance(val, BoundedQuantity):
+                key = (val.mean.magnitude, str(val.units), val.lower, val.upper)
+                if key not in self.quantities:
+                    self.quantities[key] = FrozenBoundedQuantity(
+                        copy.copy(val.mean), (val.lower, val.upper))
+                obj.__dict__[name] = self.quantities[key]
+            elif isinstance(val, ureg.Quantity):
+                key = (val.magnitude, str(val.units))
+                obj.__dict__[name] = self.quantities.setdefault(key, val)
+    
+    def create_object(self, elem):
+        """Returns the object of elem, and whether it is new and must be
+        filled with fill_object().
+        """
+        cls = get_class_from_tag(elem.tag)
+        if issubclass(cls, QuantitativeValuableInput):
+            return cls(), True
+        key = self.digest(elem)
+        if key in self.objects:
+            return self.objects[key], False
+        obj = cls()
+        self.objects[key] = obj
+        return obj, True
+    
+    def fill_object(self, obj, elem):
+        obj.add_data_from_xml_element(elem)
+        self.share_quantities(obj)
+
+
+_context = threading.local()
+
+
+@contextmanager
+def sharing():
+    """Context in which create_object_from_xml_element shares identical
+    objects.
+    """
+    previous = getattr(_context, 'sharing', None)
+    _context.sharing = SharingTable()
+    try:
+        yield _context.sharing
+    finally:
+        _context.sharing = previous
+
+
+@contextmanager
+def directory(path):
+    """Context in which the file names given in the elements are relative to
+    path.
+    """
+    previous = getattr(_context, 'directory', '')
+    _context.directory = path
+    try:
+        yield
+    finally:
+        _context.directory = previous
+
+
+def resolve_path(filename):
+    """Returns the path of a file referred to by an element.
+    """
+    return os.path.join(getattr(_context, 'directory', ''), filename)
+
+
+class IncludeCache:
+    """Parsed files referred to by Include elements, by path. A file is
+    parsed again only when its modification time or size changes, and by one
+    thread at a time.
+    """
+    
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+        # Locks of the files being parsed, by path
+        self.file_locks = {}
+        # Number of files parsed, for statistics
+        self.parses = 0
+    
+    def _cached(self, path, signature):
+        with self.lock:
+            cached = self.files.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        return None
+    
+    def get(self, path):
+        """Returns the root element of a file.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = stat.st_mtime_ns, stat.st_size
+        root = self._cached(path, signature)
+        if root is not None:
+            return root
+        with self.lock:
+            file_lock = self.file_locks.setdefault(path, threading.Lock())
+        with file_lock:
+            # The file may have been parsed while waiting for the lock
+            root = self._cached(path, signature)
+            if root is None:
+                root = ET.parse(path).getroot()
+                with self.lock:
+                    self.files[path] = signature, root
+                    self.parses += 1
+        return root
+    
+    def _get_includes(self, path, chain):
+        """Parses a file and returns the files it includes, with the chain of
+        files including them.
+        """
+        chain = chain + (path,)
+        base = os.path.dirname(path)
+        includes = []
+        for include in self.get(path).iter('Include'):
+            included = os.path.abspath(os.path.join(base, include.get('href')))
+            if included in chain:
+                raise ValueError('Circular include: ' + included)
+            includes.append((included, chain))
+        return includes
+    
+    def preload(self, elem, base='', max_workers=None):
+        """Parses the files included by elem, and by the files they include,
+        concurrently.
+        
+        :param base: directory of the file names
+        """
+        includes = [(os.path.abspath(os.path.join(base, include.get('href'))), ())
+                    for include in elem.iter('Include')]
+        if not includes:
+            return
+        # Files included several times from the same chain are parsed once
+        submitted = set()
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = []
+            while True:
+                for included in includes:
+                    if included not in submitted:
+                        submitted.add(included)
+                        futures.append(executor.submit(self._get_includes, *included))
+                if not futures:
+                    break
+                includes = futures.pop().result()
+
+
+"""Cache of the included files, shared by all the loadings.
+"""
+include_cache = IncludeCache()
+
+
+def resolve_include(elem):
+    """Returns the root element of the file referred to by an Include
+    element, and the directory of this file.
+    """
+    href = elem.get('href')
+    if href is None:
+        raise ValueError('Include without href')
+    path = os.path.abspath(resolve_path(href))
+    return include_cache.get(path), os.path.dirname(path)
+
+
+def _relocated(elem, path):
+    """Copy of elem and its descendants in which the file names are relative
+    to path, made absolute so that they can be used from any directory.
+    """
+    elem = copy.deepcopy(elem)
+    for e in elem.iter():
+        for name in FILE_ATTRIBUTES:
+            if name in e.attrib:
+                e.set(name, os.path.abspath(os.path.join(path, e.get(name))))
+    return elem
+
+
+@contextmanager
+def templates(elem):
+    """Context in which the templates defined in elem (a Templates element,
+    or None) can be referred to by a 'template' attribute. Templates may be
+    included from a file whose root is a Templates element. The file names
+    of a template are relative to the directory of its file, wherever it is
+    used.
+    """
+    previous = getattr(_context, 'templates', {})
+    _context.templates = dict(previous)
+    if elem is not None:
+        stack = [(template, getattr(_context, 'directory', ''))
+                 for template in elem]
+        while stack:
+            template, path = stack.pop(0)
+            if template.tag == 'Include':
+                with directory(path):
+                    root, included = resolve_include(template)
+                stack[:0] = [(t, included) for t in root]
+                continue
+            _context.templates[template.get('name')] = _relocated(template, path)
+    try:
+        yield
+    finally:
+        _context.templates = previous
+
+
+def resolve_template(elem, names=()):
+    """Return the element obtained by applying the attributes and sections of
+    elem on the template it refers to. Sections of elem (e.g. Shape or Inputs)
+    replace those of the template. The template must have the tag of elem.
+    
+    :param names: names of the templates being resolved, to detect cycles
+    """
+    if 'template' not in elem.attrib:
+        return elem
+    name = elem.get('template')
+    if name in names:
+        raise ValueError('Circular template: ' + name)
+    try:
+        template = getattr(_context, 'templates', {})[name]
+    except KeyError:
+        raise ValueError('Unknown template: ' + name)
+    if template.tag != elem.tag:
+        raise ValueError('Template {0} is a {1}, not a {2}'
+                         .format(name, template.tag, elem.tag))
+    template = resolve_template(template, names + (name,))
+    merged = ET.Element(elem.tag, template.attrib)
+    merged.attrib.update(elem.attrib)
+    del merged.attrib['template']
+    sections = set(child.tag for child in elem)
+    for child in template:
+        if child.tag not in sections:
+            merged.append(child)
+    for child in elem:
+        merged.append(child)
+    return merged
+
+
+def when_loaded(callback):
+    """Calls callback once the objects being loaded are complete, e.g. to
+    walk the descendants of an object from its add_data_from_xml_element().
+    The references (see resolve_reference()) are resolved before. Calls it
+    immediately if no object is being loaded.
+    """
+    loading = getattr(_context, 'loading', None)
+    if loading is None:
+        callback()
+    else:
+        loading[1].append(callback)
+
+
+def resolve_reference(name, callback):
+    """Calls callback with the object named name (e.g. a valuable) once the
+    objects being loaded are complete, so that an element can refer to an
+    object defined later in the file. The name must be unique.
+    """
+    loading = getattr(_context, 'loading', None)
+    objects = {} if loading is None else loading[2]
+    
+    def resolve():
+        found = objects.get(name, [])
+        if len(found) != 1:
+            raise ValueError('{0} objects named {1!r} for a reference'
+                             .format(len(found), name))
+        callback(found[0])
+    if loading is None:
+        resolve()
+    else:
+        loading[3].append(resolve)
+
+
+def _fill(obj, elem, table):
+    if table is None:
+        obj.add_data_from_xml_element(elem)
+    else:
+        table.fill_object(obj, elem)
+
+
 def create_object_from_xml_element(elem):
-    obj = get_class_from_tag(elem.tag)()
-    obj.add_data_from_xml_element(elem)
+    """Creates the object described by elem and its descendants.
+    
+    The objects are created when their parent is filled, but are filled
+    later from an explicit stack rather than by recursion, so that the depth
+    of a model is not limited by the Python stack. The contexts (templates,
+    directory) are restored when filling each object.
+    
+    An Include element is replaced by the root element of the file it
+    refers to (href attribute, relative to the current directory). The
+    included files are parsed concurrently beforehand, and cached.
+    """
+    if elem.tag == 'Include':
+        root, path = resolve_include(elem)
+        with directory(path):
+            return create_object_from_xml_element(root)
+    elem = resolve_template(elem)
+    table = getattr(_context, 'sharing', None)
+    if table is None:
+        obj, new = get_class_from_tag(elem.tag)(), True
+    else:
+        obj, new = table.create_object(elem)
+    loading = getattr(_context, 'loading', None)
+    if loading is not None:
+        # Nested call, from the add_data_from_xml_element() of the parent
+        if new:
+            loading[0].append((obj, elem, getattr(_context, 'templates', {}),
+                               getattr(_context, 'directory', '')))
+            if 'name' in elem.attrib:
+                loading[2].setdefault(elem.get('name'), []).append(obj)
+        return obj
+    include_cache.preload(elem, getattr(_context, 'directory', ''))
+    # Stack of (object, element, templates, directory), callbacks, named
+    # objects and callbacks resolving the references
+    _context.loading = loading = ([], [], {}, [])
+    if 'name' in elem.attrib:
+        loading[2][elem.get('name')] = [obj]
+    try:
+        if new:
+            _fill(obj, elem, table)
+        contexts = (getattr(_context, 'templates', {}),
+                    getattr(_context, 'directory', ''))
+        try:
+            while loading[0]:
+                pending, pending_elem, _context.templates, _context.directory =\
+                    loading[0].pop()
+                _fill(pending, pending_elem, table)
+        finally:
+            _context.templates, _context.directory = contexts
+    finally:
+        _context.loading = None
+    for callback in loading[3] + loading[1]:
+        callback()
     return obj
 
 
@@ -64,10 +449,20 @@ def save_xml_file(root, filename):
     f.close()
 
 
-def load_xml_file(filename):
+def load_xml_file(filename, share=False):
+    """Load an object from an XML file.
+    
+    :param share: share identical shapes, valuables and quantities, so that
+        their results are computed once
+    :type share: bool
+    """
     tree = ET.parse(filename)
     root = tree.getroot()
-    return create_object_from_xml_element(root)
+    with directory(os.path.dirname(os.path.abspath(filename))):
+        if share:
+            with sharing():
+                return create_object_from_xml_element(root)
+        return create_object_from_xml_element(root)
 
 
 